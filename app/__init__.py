@@ -8,6 +8,7 @@ __all_ = ['app', 'assets', 'breadcrumbs', 'sql']
 
 
 import os
+import threading
 
 
 from flask import (
@@ -100,14 +101,60 @@ def create_app(config_name):
 
     # Initialize spark.
     with app.app_context():
+        if app.config['RS_ENSURE_INDEXES']:
+            from pymongo.errors import OperationFailure
+            from .rs.indexes import ensure_indexes
+            # An index which cannot be created, such as the unique reactions
+            # index over duplicates, must not keep the app or the commands
+            # which fix the data from starting.
+            try:
+                for collection, name, created, seconds in ensure_indexes():
+                    if created:
+                        app.logger.info(
+                            'Created index {0}.{1} in {2:.3f}s'.format(
+                                collection, name, seconds))
+            except OperationFailure:
+                app.logger.exception(
+                    'Recommender system indexes not ensured, run manage.py '
+                    'ensure-indexes once the data is fixed')
+
+        # Snapshot restored on boot by the in-memory backends.
+        snapshot = app.config['RS_SNAPSHOT'] \
+            if app.config['RS_SNAPSHOT_BOOT'] else None
+
         if app.config['RS_BACKEND'] == 'mongo':
             from .rs.mongo import MongoRecommenderSystem
-            app.rs = MongoRecommenderSystem()
+            app.rs = MongoRecommenderSystem(
+                storage=app.config['RS_STORAGE'],
+                rebuild=app.config['RS_REBUILD'],
+                layout=app.config['RS_LAYOUT'],
+                buckets=app.config['RS_BUCKETS'],
+                topk=app.config['RS_TOPK'],
+                sparse=app.config['RS_SPARSE'],
+                min_similarity=app.config['RS_MIN_SIMILARITY'],
+                min_shared=app.config['RS_MIN_SHARED'],
+                batch_size=app.config['RS_BATCH_SIZE'],
+                write_concern=app.config['RS_WRITE_CONCERN'],
+                write_workers=app.config['RS_WRITE_WORKERS'],
+                lease_seconds=app.config['RS_LEASE_SECONDS'])
         elif app.config['RS_BACKEND'] == 'spark':
             from .rs.spark import SparkRecommenderSystem
             app.rs = SparkRecommenderSystem(
-                SparkContext(conf=SparkConf().setAppName("krs")))
-            app.rs.load_data()
+                SparkContext(conf=SparkConf().setAppName("krs")),
+                topk=app.config['RS_TOPK'],
+                sparse=app.config['RS_SPARSE'],
+                min_similarity=app.config['RS_MIN_SIMILARITY'],
+                batch_size=app.config['RS_BATCH_SIZE'],
+                snapshot=snapshot)
+        elif app.config['RS_BACKEND'] == 'numpy':
+            from .rs.dense import NumpyRecommenderSystem
+            app.rs = NumpyRecommenderSystem(
+                block_size=app.config['RS_BLOCK_SIZE'],
+                pairs=app.config['RS_PAIRS'],
+                store=app.config['RS_STORE'],
+                store_delay=app.config['RS_STORE_DELAY'],
+                lease_seconds=app.config['RS_LEASE_SECONDS'],
+                snapshot=snapshot)
 
     # Register assets
     app_js = Bundle(
@@ -160,3 +207,31 @@ def create_app(config_name):
 def get_app_prefix():
     """Return the application prefix."""
     return config.APP_PREFIX
+
+
+def warm_up_rs(app):
+    """Warm the recommender system of an app serving requests up, blocking
+    or in the background as configured. Management commands do not warm it
+    up, they load what they need themselves.
+    """
+    if app.config['RS_WARM_UP'] == 'blocking':
+        with app.app_context():
+            app.rs.warm_up()
+    else:
+        start_warm_up(app)
+
+
+def start_warm_up(app):
+    """Warm the recommender system up in a background thread, so the app can
+    serve requests meanwhile. Failures are logged and leave it not ready.
+    """
+    def warm_up():
+        with app.app_context():
+            try:
+                app.rs.warm_up()
+            except Exception:
+                app.logger.exception('Recommender system warm-up failed')
+
+    thread = threading.Thread(target=warm_up, name='rs-warm-up')
+    thread.daemon = True
+    thread.start()
@@ -9,6 +9,8 @@ from bson.errors import InvalidId
 from flask import (
     current_app, jsonify, request,
 )
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import validictory
 
 from app import (
@@ -16,7 +18,9 @@ from app import (
 )
 from app.api_v1_0 import api_v1_0
 from app.api_v1_0.schemata import schemata
-from app.utils.decorators import async
+from app.rs import buckets
+from app.rs.marks import advance_mark
+from app.utils.decorators import run_async
 
 
 @api_v1_0.route('/', methods=['GET'])
@@ -30,9 +34,36 @@ def index():
     }), HTTPStatus.OK
 
 
+@api_v1_0.route('/ready', methods=['GET'])
+def get_ready():
+    """Readiness of the recommender system, for load balancers to poll.
+    Responds with 503 until its warm-up is complete. The status of the
+    rebuild shared by the workers is reported either way.
+    """
+    if not current_app.rs.ready:
+        return jsonify({
+            'status': HTTPStatus.SERVICE_UNAVAILABLE,
+            'ready': False,
+            'rebuild': current_app.rs.rebuild_status(),
+            'message': '{0}. Recommender system warming up.'.format(HTTPStatus.SERVICE_UNAVAILABLE.description)
+        }), HTTPStatus.SERVICE_UNAVAILABLE
+
+    return jsonify({
+        'status': HTTPStatus.OK,
+        'ready': True,
+        'version': current_app.rs.similarity_version(),
+        'rebuild': current_app.rs.rebuild_status()
+    }), HTTPStatus.OK
+
+
 @api_v1_0.route('/matches/<string:_id>', methods=['GET', 'POST'])
 @op.require_oauth('api')
 def get_matches(_id):
+    """Get the matches of a profile. Matches sorted by descending similarity
+    with a limit up to RS_TOPK, asked for by the sort_similarity and limit
+    query arguments of a GET or fields of a POST, are served from the kept
+    best matches, any other request reads every match of the profile.
+    """
     profile = mongo.db.profiles
 
     try:
@@ -40,9 +71,13 @@ def get_matches(_id):
         # If the profile was found, return it's matches.
         if check is not None:
             output = []
+            version = current_app.rs.similarity_version()
 
             if request.method == 'GET':
-                matches = current_app.rs.get_matches(ObjectId(_id))
+                matches = current_app.rs.get_matches(
+                    ObjectId(_id),
+                    sort_sim=request.args.get('sort_similarity', type=int),
+                    limit=request.args.get('limit', type=int))
                 for match in matches:
                     mp = profile.find_one({'_id': match[0]})
                     output.append({
@@ -71,7 +106,8 @@ def get_matches(_id):
 
                 if 'sort_similarity' in data:
                     matches = current_app.rs.get_matches(
-                        ObjectId(_id), sort_sim=data['sort_similarity'])
+                        ObjectId(_id), sort_sim=data['sort_similarity'],
+                        limit=data.get('limit'))
                 else:
                     matches = current_app.rs.get_matches(ObjectId(_id))
 
@@ -88,6 +124,7 @@ def get_matches(_id):
 
             return jsonify({
                 'status': HTTPStatus.OK,
+                'version': version,
                 'result': output
             }), HTTPStatus.OK
 
@@ -125,9 +162,12 @@ def statements():
 def get_inaction_statement(_id):
     """Randomly select a statement with no reaction and return it."""
     try:
-        reaction = mongo.db.reactions
-        reacted = [a['statement']
-                   for a in reaction.find({'profile': ObjectId(_id)})]
+        if buckets.readable():
+            reacted = list(buckets.profile_reactions(ObjectId(_id)))
+        else:
+            reaction = mongo.db.reactions
+            reacted = [a['statement'] for a in reaction.find(
+                {'profile': ObjectId(_id)}, {'statement': 1})]
 
         statement = mongo.db.statements
         inaction = []
@@ -202,24 +242,49 @@ def post_reaction():
             'message': '{0}. Invalid data schema.'.format(HTTPStatus.BAD_REQUEST.description)
         }), HTTPStatus.BAD_REQUEST
 
-    # Insert reaction.
-    result = reaction.insert_one({
+    # Upsert reaction, there is at most one per profile and statement.
+    query = {
         'profile': ObjectId(data['profile']),
-        'statement': ObjectId(data['statement']),
-        'reaction': data['reaction']
-    })
-    output = {
-        'inserted_id': str(result.inserted_id)
+        'statement': ObjectId(data['statement'])
     }
+    update = {'$set': {'reaction': data['reaction']}}
+    try:
+        document = reaction.find_one_and_update(
+            query, update, upsert=True,
+            return_document=ReturnDocument.BEFORE)
+    except DuplicateKeyError:
+        # A concurrent request inserted the reaction first.
+        document = reaction.find_one_and_update(
+            query, update, return_document=ReturnDocument.BEFORE)
+
+    created = document is None
+    changed = not created and document['reaction'] != data['reaction']
+    _id = reaction.find_one(query, {'_id': 1})['_id'] if created \
+        else document['_id']
 
-    # Notify recommender system.
-    @async
-    def update_sims():
-        with app.app_context():
-            up = current_app.rs.add_reaction(result.inserted_id)
-            current_app.rs.update_similarity(filter_by=up)
+    output = {
+        '_id': str(_id),
+        'created': created,
+        'changed': changed
+    }
+    if created:
+        output['inserted_id'] = str(_id)
+
+    # Notify recommender system, only if the value is new.
+    if created or changed:
+        buckets.set_reaction(query['profile'], query['statement'],
+                             data['reaction'])
+        advance_mark()
+
+        @run_async
+        def update_sims():
+            with app.app_context():
+                if created:
+                    current_app.rs.add_reaction(_id)
+                else:
+                    current_app.rs.change_reaction(document, data['reaction'])
 
-    update_sims()
+        update_sims()
 
     return jsonify({
         'status': HTTPStatus.OK,
@@ -259,18 +324,29 @@ def put_reaction(_id):
                 'message': '{0}.'.format(HTTPStatus.NOT_FOUND.description)
             }), HTTPStatus.NOT_FOUND
 
-        changes = {}
-        for key, value in data.items():
-            changes[key] = value
-
-        # Perform update.
+        # Perform update, of the reaction value only.
         stat = reaction.update_one(
             {'_id': ObjectId(_id)},
-            {'$set': changes}
+            {'$set': {'reaction': data['reaction']}}
         )
 
         # Update successful.
         if stat.acknowledged:
+
+            # Notify recommender system.
+            if data['reaction'] != document['reaction']:
+                buckets.set_reaction(document['profile'],
+                                     document['statement'], data['reaction'])
+                advance_mark()
+
+                @run_async
+                def update_sims():
+                    with app.app_context():
+                        current_app.rs.change_reaction(
+                            document, data['reaction'])
+
+                update_sims()
+
             return jsonify({
                 'status': HTTPStatus.OK,
                 'result': {'updated_id': _id}
@@ -381,6 +457,17 @@ def delete_reaction(_id):
 
         # Delete was successful.
         if stat.deleted_count == 1:
+            buckets.unset_reaction(document['profile'], document['statement'])
+            advance_mark()
+
+            # Notify recommender system.
+            @run_async
+            def update_sims():
+                with app.app_context():
+                    current_app.rs.remove_reaction(document)
+
+            update_sims()
+
             return jsonify({
                 'status': HTTPStatus.OK,
                 'result': {'deleted_id': _id}
@@ -582,12 +669,17 @@ def delete_profile(_id):
         # Delete was successful.
         if stat.deleted_count == 1:
 
-            # Notify recommender system.
-            @async
+            # Delete reactions, so they are not picked up by later updates.
+            mongo.db.reactions.delete_many({'profile': ObjectId(_id)})
+            buckets.drop_profile(ObjectId(_id))
+            advance_mark()
+
+            # Notify recommender system. Removing the profile's pairs leaves
+            # all other pairs untouched, no recompute is needed.
+            @run_async
             def update_sims():
                 with app.app_context():
                     current_app.rs.clear_orphans(ObjectId(_id))
-                    current_app.rs.update_similarity()
 
             update_sims()
 
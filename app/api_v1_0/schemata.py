@@ -32,9 +32,14 @@ class Schemata(object):
         }
     }
 
+    # Only the value of a reaction can change, the profile and statement
+    # it belongs to cannot.
     put_reaction = {
         'type': 'object',
-        'properties': {}
+        'properties': {
+            'reaction': {'type': 'integer'}
+        },
+        'additionalProperties': False
     }
 
     get_inaction = {
@@ -12,13 +12,30 @@ from flask import (
 from flask_breadcrumbs import register_breadcrumb
 
 
-from app import mongo
+from app import (
+    app, mongo,
+)
 from app.confirm import confirm_required
 from app.dash import dash
 from app.dash.category_forms import (
     EditCategoryForm, NewCategoryForm,
 )
-from app.utils.decorators import admin_required
+from app.rs.marks import advance_mark
+from app.utils.decorators import (
+    admin_required, run_async,
+)
+
+
+def update_weights():
+    """Notify the recommender system of changed category weights."""
+    advance_mark()
+
+    @run_async
+    def update_sims():
+        with app.app_context():
+            current_app.rs.update_weights()
+
+    update_sims()
 
 
 @dash.route('/categories', methods=['GET', 'POST'])
@@ -44,6 +61,7 @@ def categories():
                         '$set': {'weight': weight}
                     }
                 )
+            update_weights()
             flash('Weights successfully updated.', 'success')
         return redirect(url_for('dash.categories'))
 
@@ -116,6 +134,8 @@ def category(cid):
         )
 
         if stat['updatedExisting']:
+            if float(form.weight.data) != c['weight']:
+                update_weights()
             flash('Changes saved.', 'success')
         else:
             flash('Could not save changes.', 'danger')
@@ -154,6 +174,7 @@ def delete_category(cid):
     # Remove the category.
     category = mongo.db.categories
     category.remove({'_id': ObjectId(cid)}, True)
+    update_weights()
     flash('Category successfully deleted.', 'success')
     return redirect(url_for('dash.categories'))
 
@@ -168,6 +189,7 @@ def purge_categories():
     """Purge all categories from the document database."""
     category = mongo.db.categories
     category.remove({})
+    update_weights()
     flash('Categories successfully purged.', 'success')
     return redirect(url_for('dash.categories'))
 
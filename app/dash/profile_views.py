@@ -19,6 +19,8 @@ from app.dash import dash
 from app.dash.profile_forms import (
     EditProfileForm, NewProfileForm,
 )
+from app.rs import buckets
+from app.rs.marks import advance_mark
 from app.utils.decorators import admin_required
 from app.utils.models import (
     OAuth2Client, Profile,
@@ -132,6 +134,8 @@ def delete_profile(pid):
         reactions = [r['_id']
                      for r in reaction.find({'profile': ObjectId(p.rs_id)})]
         reaction.delete_many({'_id': {'$in': reactions}})
+        buckets.drop_profile(ObjectId(p.rs_id))
+        advance_mark()
 
         # Remove ophaned similarities
         current_app.rs.clear_orphans(ObjectId(p.rs_id))
@@ -194,6 +198,8 @@ def pull_profile(pid):
     reactions = [r['_id']
                  for r in reaction.find({'profile': ObjectId(p.rs_id)})]
     reaction.delete_many({'_id': {'$in': reactions}})
+    buckets.drop_profile(ObjectId(p.rs_id))
+    advance_mark()
 
     # Remove ophaned similarities
     current_app.rs.clear_orphans(ObjectId(p.rs_id))
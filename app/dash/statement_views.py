@@ -12,13 +12,19 @@ from flask import (
 from flask_breadcrumbs import register_breadcrumb
 
 
-from app import mongo
+from app import (
+    app, mongo,
+)
 from app.confirm import confirm_required
 from app.dash import dash
 from app.dash.statement_forms import (
     EditStatementForm, NewStatementForm,
 )
-from app.utils.decorators import admin_required
+from app.rs import buckets
+from app.rs.marks import advance_mark
+from app.utils.decorators import (
+    admin_required, run_async,
+)
 
 
 @dash.route('/statements')
@@ -118,6 +124,18 @@ def statement(sid):
         )
 
         if stat['updatedExisting']:
+            # Notify recommender system if the statement changed category.
+            if ObjectId(form.category.data) != s['category']:
+                advance_mark()
+
+                @run_async
+                def update_sims():
+                    with app.app_context():
+                        current_app.rs.move_statement(
+                            s, ObjectId(form.category.data))
+
+                update_sims()
+
             flash('Changes saved.', 'success')
         else:
             flash('Could not save changes.', 'danger')
@@ -147,14 +165,29 @@ def statement(sid):
 )
 def delete_statement(sid):
     """Remove a statement from the document database."""
+    statement = mongo.db.statements
+    s = statement.find_one({'_id': ObjectId(sid)})
+
     # Remove all reactions associated with this statement, as they are no
     # longer valid.
     reaction = mongo.db.reactions
+    reactions = list(reaction.find({"statement": ObjectId(sid)}))
     reaction.remove({"statement": ObjectId(sid)})
+    buckets.drop_statement(ObjectId(sid))
+    advance_mark()
 
     # Remove the statement.
-    statement = mongo.db.statements
     statement.remove({'_id': ObjectId(sid)}, True)
+
+    # Notify recommender system.
+    if s is not None:
+        @run_async
+        def update_sims():
+            with app.app_context():
+                current_app.rs.remove_statement(s, reactions)
+
+        update_sims()
+
     flash('Statement successfully deleted.', 'success')
     return redirect(url_for('dash.statements'))
 
@@ -170,11 +203,16 @@ def purge_statements():
     # Remove all reactions as they are no longer valid.
     reaction = mongo.db.reactions
     reaction.remove({})
+    buckets.purge_buckets()
+    advance_mark()
 
     # Remove all statements.
     statement = mongo.db.statements
     statement.remove({})
 
+    # With no reactions left there are no similarities either.
+    current_app.rs.purge_similarity()
+
     flash('Statements successfully purged.', 'success')
     return redirect(url_for('dash.statements'))
 
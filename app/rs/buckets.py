@@ -0,0 +1,258 @@
+"""Reactions bucketed by statement and by profile.
+
+Kept alongside the reactions collection, sbuckets holds one document per
+statement with a {profile: reaction} map and pbuckets one document per
+profile with a {statement: reaction} map. Map keys are the string form of
+the ObjectIds.
+
+The buckets are only read once build-buckets has bucketed the existing
+reactions, which it records in the buckets document of the versions
+collection. Until then they are maintained but the reactions collection is
+read instead, as the buckets may lack reactions written before they were
+enabled.
+
+build-buckets writes into staging collections which are then renamed over
+the buckets. The bucket changes made meanwhile are logged in bucketlog and
+synced again from the reactions collection once the buckets are swapped in.
+"""
+
+
+__all__ = [
+    'build_buckets', 'drop_profile', 'drop_statement', 'enabled',
+    'profile_reactions', 'readable', 'purge_buckets', 'set_reaction',
+    'statement_reactors', 'unset_reaction',
+]
+
+
+from bson import ObjectId
+from flask import current_app
+from pymongo import UpdateOne
+
+
+from app import mongo
+from app.rs.scan import statement_reactions
+
+
+# _id of the document recording the build of the buckets in the versions
+# collection.
+BUILT = 'buckets'
+
+# _id of the document marking a build of the buckets in progress in the
+# versions collection.
+BUILDING = 'buckets-building'
+
+# Staging collection of each bucket collection.
+STAGING = {'sbuckets': 'sbuckets_build', 'pbuckets': 'pbuckets_build'}
+
+# Whether the buckets were found built, which they stay once they are.
+_built = False
+
+
+def enabled():
+    """Check whether the buckets are maintained."""
+    return current_app.config.get('RS_BUCKETS', False)
+
+
+def readable():
+    """Check whether the buckets are maintained and were built, so they hold
+    every reaction and can be read in place of the reactions collection.
+    """
+    global _built
+    if not enabled():
+        return False
+    if not _built:
+        _built = mongo.db.versions.find_one({'_id': BUILT}) is not None
+    return _built
+
+
+def log_change(profile=None, statement=None):
+    """Log a change of the buckets of a profile, a statement or both if they
+    are being built.
+    """
+    if mongo.db.versions.find_one({'_id': BUILDING}) is None:
+        return
+
+    entry = dict((k, v) for k, v in (('profile', profile),
+                                     ('statement', statement))
+                 if v is not None)
+    mongo.db.bucketlog.insert_one(entry)
+
+
+def set_reaction(profile, statement, reaction):
+    """Set the reaction of a profile to a statement in both buckets."""
+    if not enabled():
+        return
+
+    log_change(profile, statement)
+    write_reaction(profile, statement, reaction)
+
+
+def write_reaction(profile, statement, reaction):
+    """Write the reaction of a profile to a statement, None for no reaction,
+    to both buckets.
+    """
+    if reaction is None:
+        mongo.db.sbuckets.update_one(
+            {'_id': statement},
+            {'$unset': {'reactions.{0}'.format(profile): ''}})
+        mongo.db.pbuckets.update_one(
+            {'_id': profile},
+            {'$unset': {'reactions.{0}'.format(statement): ''}})
+        return
+
+    mongo.db.sbuckets.update_one(
+        {'_id': statement},
+        {'$set': {'reactions.{0}'.format(profile): reaction}},
+        upsert=True)
+    mongo.db.pbuckets.update_one(
+        {'_id': profile},
+        {'$set': {'reactions.{0}'.format(statement): reaction}},
+        upsert=True)
+
+
+def unset_reaction(profile, statement):
+    """Remove the reaction of a profile to a statement from both buckets."""
+    if not enabled():
+        return
+
+    log_change(profile, statement)
+    write_reaction(profile, statement, None)
+
+
+def drop_profile(profile):
+    """Remove a profile and its reactions from the buckets."""
+    if not enabled():
+        return
+
+    log_change(profile=profile)
+    bucket = mongo.db.pbuckets.find_one({'_id': profile})
+    if bucket is None:
+        return
+
+    ops = [UpdateOne({'_id': ObjectId(s)},
+                     {'$unset': {'reactions.{0}'.format(profile): ''}})
+           for s in bucket.get('reactions', {})]
+    if ops != []:
+        mongo.db.sbuckets.bulk_write(ops)
+    mongo.db.pbuckets.delete_one({'_id': profile})
+
+
+def drop_statement(statement):
+    """Remove a statement and its reactions from the buckets."""
+    if not enabled():
+        return
+
+    log_change(statement=statement)
+    bucket = mongo.db.sbuckets.find_one({'_id': statement})
+    if bucket is None:
+        return
+
+    ops = [UpdateOne({'_id': ObjectId(p)},
+                     {'$unset': {'reactions.{0}'.format(statement): ''}})
+           for p in bucket.get('reactions', {})]
+    if ops != []:
+        mongo.db.pbuckets.bulk_write(ops)
+    mongo.db.sbuckets.delete_one({'_id': statement})
+
+
+def purge_buckets():
+    """Remove all buckets."""
+    mongo.db.sbuckets.remove({})
+    mongo.db.pbuckets.remove({})
+
+
+def statement_reactors(statement):
+    """Get the (profile, reaction) tuples of a statement with a single
+    document read.
+    """
+    bucket = mongo.db.sbuckets.find_one({'_id': statement})
+    if bucket is None:
+        return []
+    return [(ObjectId(p), r) for p, r in bucket.get('reactions', {}).items()]
+
+
+def profile_reactions(profile):
+    """Get the reactions of a profile as a {statement: reaction} dict with a
+    single document read.
+    """
+    bucket = mongo.db.pbuckets.find_one({'_id': profile})
+    if bucket is None:
+        return {}
+    return dict((ObjectId(s), r)
+                for s, r in bucket.get('reactions', {}).items())
+
+
+def build_buckets():
+    """Rebuild both buckets from a single scan of the reactions collection
+    into the staging collections, swap them in and record that they were
+    built.
+
+    Returns the number of statement and profile buckets written.
+    """
+    mongo.db.bucketlog.remove({})
+    for staging in STAGING.values():
+        mongo.db[staging].drop()
+    mongo.db.versions.update_one(
+        {'_id': BUILDING}, {'$currentDate': {'started': True}}, upsert=True)
+
+    try:
+        statements, profiles = [], {}
+        for s, reactions in statement_reactions():
+            statements.append({
+                '_id': s,
+                'reactions': dict((str(p), r) for p, r in reactions)
+            })
+            for p, r in reactions:
+                profiles.setdefault(p, {})[str(s)] = r
+
+        if statements != []:
+            mongo.db[STAGING['sbuckets']].insert_many(statements)
+        if profiles != {}:
+            mongo.db[STAGING['pbuckets']].insert_many(
+                [{'_id': p, 'reactions': r} for p, r in profiles.items()])
+
+        swap_buckets()
+        sync_logged()
+    finally:
+        mongo.db.versions.delete_one({'_id': BUILDING})
+
+    # Changes which found the build in progress are logged until it ends.
+    sync_logged()
+
+    mongo.db.versions.update_one(
+        {'_id': BUILT}, {'$currentDate': {'built': True}}, upsert=True)
+
+    return len(statements), len(profiles)
+
+
+def swap_buckets():
+    """Rename the staging collections over the buckets."""
+    names = set(mongo.db.collection_names())
+    for name, staging in STAGING.items():
+        if staging in names:
+            mongo.db[staging].rename(name, dropTarget=True)
+        else:
+            mongo.db[name].remove({})
+
+
+def sync_logged():
+    """Sync the buckets of the logged changes from the reactions collection
+    and clear the log.
+    """
+    for entry in mongo.db.bucketlog.find():
+        query = dict((k, entry[k]) for k in ('profile', 'statement')
+                     if k in entry)
+        keys = set((r['profile'], r['statement'])
+                   for r in mongo.db.reactions.find(query))
+        if 'statement' not in entry:
+            keys.update((entry['profile'], s)
+                        for s in profile_reactions(entry['profile']))
+        if 'profile' not in entry:
+            keys.update((p, entry['statement'])
+                        for p, _ in statement_reactors(entry['statement']))
+
+        for p, s in keys:
+            found = mongo.db.reactions.find_one(
+                {'profile': p, 'statement': s}, sort=[('_id', 1)])
+            write_reaction(p, s, found['reaction'] if found else None)
+        mongo.db.bucketlog.delete_one({'_id': entry['_id']})
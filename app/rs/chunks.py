@@ -0,0 +1,112 @@
+"""Chunked writes of generated rows.
+
+The rebuilds generate their rows lazily and hand them to write_chunks, so
+at most one chunk of rows is held in memory at a time, whatever the size of
+the matrices.
+
+Derived rows, which can always be recomputed from the reactions, are
+written through a DerivedWriter: unordered bulk writes with a relaxed write
+concern, several chunks in flight at once.
+"""
+
+
+__all__ = ['DerivedWriter', 'chunked', 'write_chunks']
+
+
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, wait,
+)
+import itertools
+import logging
+
+
+from pymongo import InsertOne
+from pymongo.write_concern import WriteConcern
+
+
+logger = logging.getLogger(__name__)
+
+
+def chunked(rows, size):
+    """Split an iterable into lists of at most size items."""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if chunk == []:
+            return
+        yield chunk
+
+
+def write_chunks(rows, size, write, label):
+    """Pass generated rows to write in chunks of at most size rows, logging
+    the progress after every chunk.
+
+    Returns the number of rows written.
+    """
+    total = 0
+    for n, chunk in enumerate(chunked(rows, size), 1):
+        write(chunk)
+        total += len(chunk)
+        logger.info('{0}: chunk {1} written, {2} rows'.format(label, n, total))
+
+    return total
+
+
+class DerivedWriter(object):
+    """Write function for write_chunks submitting unordered bulk writes of
+    derived rows to a collection.
+
+    Chunks are written with write concern w and without waiting for the
+    journal, by up to workers threads. Submitting blocks while workers
+    chunks are in flight, so memory stays bounded by workers chunks. Used
+    as a context manager, which waits for the chunks in flight on exit and
+    raises the first write error, unless it exits on an error already.
+
+    Chunks may hold documents, which are inserted, or bulk write operations.
+    """
+
+    def __init__(self, collection, w=1, workers=1):
+        """"""
+        self.collection = collection.with_options(
+            write_concern=WriteConcern(w=w, j=False))
+        self.workers = max(1, int(workers))
+        self.executor = None
+        self.pending = set()
+
+    def __enter__(self):
+        """"""
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """"""
+        try:
+            for future in self.pending:
+                # Waited for either way, only raised if nothing else was.
+                if exc_type is None:
+                    future.result()
+                else:
+                    future.exception()
+        finally:
+            self.pending = set()
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def __call__(self, chunk):
+        """Write or submit a chunk."""
+        ops = [InsertOne(x) if isinstance(x, dict) else x for x in chunk]
+        if self.executor is None:
+            return self.write(ops)
+
+        if len(self.pending) >= self.workers:
+            done, self.pending = wait(
+                self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        self.pending.add(self.executor.submit(self.write, ops))
+
+    def write(self, ops):
+        """Write a chunk of operations as one unordered bulk write."""
+        self.collection.bulk_write(ops, ordered=False)
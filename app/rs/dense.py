@@ -0,0 +1,933 @@
+"""In-memory NumPy based recommender system."""
+
+
+from flask import current_app
+
+
+from app import mongo
+from app.rs.interning import registry
+from app.rs.leases import (
+    Lease, lease_status,
+)
+from app.rs.scan import statement_categories
+from app.rs.snapshots import restore_on_boot
+from app.rs.store import (
+    SimilarityStore, write_store,
+)
+
+
+from datetime import datetime
+import os
+import socket
+import threading
+import time
+import numpy as np
+
+
+class NumpyRecommenderSystem(object):
+    """NumPy based recommender system.
+
+    The reactions collection is loaded once into a dense profiles x
+    statements array and all similarities are computed as blocked
+    broadcasts over that array. Category sums and counts are kept
+    unweighted, category weights are applied when the overall similarity
+    matrix is formed.
+
+    Statement and category columns are addressed by the interned indices of
+    their ObjectIds. Profile rows are allocated by the backend: a full load
+    only gives rows to the profiles with reactions, and the rows of removed
+    profiles are reused by the next new profile.
+
+    With a store, the overall similarity is served from a memory-mapped
+    file shared by the workers instead. A single worker at a time, holding
+    the store lease, loads the data, writes the store and drops its arrays
+    again; the others map the new store without recomputing. Incremental
+    updates are not applied to the store: they schedule a full rebuild,
+    published store_delay seconds after the first of them, so the changes
+    made meanwhile are published together.
+
+    With a snapshot, warm_up restores the state of the snapshot instead of
+    loading the data if the snapshot is still current.
+
+    Full loads and rebuilds build their arrays aside, in a scratch backend,
+    and only take the lock to swap them in, so get_matches keeps serving the
+    current arrays meanwhile. The changes of the state are serialized by the
+    update lock.
+
+    With 'buckets' pairs the category sums are aggregated one reaction value
+    bucket at a time with matrix products, instead of broadcasting every
+    pair of reactions, which pays off for reactions of a few distinct
+    values.
+    """
+
+    # Arrays making up the state of a snapshot, which also holds the
+    # interned index of the profile of every row as profiles.
+    SNAPSHOT = ('weights', 'statement_categories', 'reactions', 'csum', 'ccnt',
+                'osm')
+
+    # Arrays and rows making up the whole state, swapped in at once.
+    STATE = SNAPSHOT + ('reactors', 'active', 'profile_ids', 'rows', 'free')
+
+    # Profile ObjectId of every row, None for free rows.
+    profile_ids = None
+
+    # Row of every profile ObjectId with one.
+    rows = None
+
+    # Rows freed by removed profiles, reused by new ones.
+    free = None
+
+    # Category weights by category index.
+    weights = None
+
+    # Category index of every statement column, -1 if uncategorized.
+    statement_categories = None
+
+    # Reaction matrix (profiles x statements), NaN where there is no reaction.
+    reactions = None
+
+    # Per category sums of 1 / (1 + distance) (categories x profiles x profiles).
+    csum = None
+
+    # Per category counts of shared statements (categories x profiles x profiles).
+    ccnt = None
+
+    # Overall Similarity Matrix (profiles x profiles).
+    osm = None
+
+    # Number of profiles which reacted to every statement column.
+    reactors = None
+
+    # Flags of the profiles which share a statement with another, kept up to
+    # date by the incremental changes.
+    active = None
+
+    # Number of full rebuilds of the similarity, served as its version.
+    version = 0
+
+    # Whether the data was loaded by warm_up.
+    ready = False
+
+    def __init__(self, block_size=64, pairs='combinations', store=None,
+                 store_delay=10, lease_seconds=60, snapshot=None):
+        """"""
+        # Number of profile rows broadcast against the matrix at once. Bounds
+        # the temporary (block x profiles x statements) array.
+        self.block_size = max(1, int(block_size))
+
+        # Aggregation of the pairs, 'combinations' or 'buckets'.
+        self.pairs = pairs
+
+        # The lock guards the state read by get_matches, the update lock is
+        # held for every change of the state, taken first.
+        self.lock = threading.RLock()
+        self.update_lock = threading.RLock()
+        self.ids = registry()
+
+        # Shared similarity store, None to keep the similarity in memory.
+        self.store = SimilarityStore(store) if store else None
+        self.store_delay = store_delay
+        self.lease_seconds = lease_seconds
+        self.building = False
+
+        # Time of the first incremental change waiting for the scheduled
+        # store, None if none is scheduled.
+        self.pending = None
+
+        # Snapshot restored by warm_up, None to always load the data.
+        self.snapshot_path = snapshot
+
+    def get_matches(self, pid, sort_sim=None, limit=None):
+        """Get and return all matches for the given profile."""
+        if self.store is not None:
+            return self.store.matches(pid, sort_sim, limit)
+
+        with self.lock:
+            i = self.profile_row(pid)
+            if self.osm is None or i is None:
+                return []
+
+            active = self.active.copy()
+            if not active[i]:
+                return []
+
+            active[i] = False
+            candidates = np.flatnonzero(active)
+            sims = self.osm[i, candidates]
+            if sort_sim is not None:
+                order = np.argsort(sims * sort_sim, kind='mergesort')
+                candidates = candidates[order]
+                sims = sims[order]
+
+            if limit is not None:
+                candidates, sims = candidates[:limit], sims[:limit]
+
+            return [(self.profile_ids[j], float(s))
+                    for j, s in zip(candidates, sims)]
+
+    def warm_up(self):
+        """Load the data, or map the store, then mark the backend as ready.
+        A store which cannot be mapped is built, whatever the builds that ran
+        before, as its file may be gone. Workers warming up together wait for
+        the one building it.
+        """
+        if self.store is None:
+            self.warm_load()
+        elif not self.store.refresh():
+            self.publish(load=self.warm_load)
+        self.ready = True
+
+    def warm_load(self):
+        """Restore the snapshot if it is still current, otherwise load the
+        data.
+        """
+        if self.snapshot_path is None or \
+                not restore_on_boot(self, self.snapshot_path):
+            self.load_data()
+
+    def snapshot(self):
+        """Load the data and return the state of a snapshot as arrays."""
+        with self.update_lock:
+            self.building = True
+            try:
+                self.load_data()
+                arrays = dict((name, getattr(self, name))
+                              for name in self.SNAPSHOT)
+                arrays['profiles'] = np.array([
+                    -1 if oid is None else self.ids.index('profile', oid)
+                    for oid in self.profile_ids], dtype=np.int32)
+                return arrays
+            finally:
+                self.building = False
+                if self.store is not None:
+                    self.drop()
+
+    def restore(self, arrays):
+        """Replace the state by the one of a snapshot. With a store, it is
+        published as the next version of the store.
+        """
+        if self.store is not None and not self.building:
+            self.publish(load=lambda: self.restore(arrays))
+            return
+
+        with self.update_lock:
+            state = self.scratch()
+            state.reset()
+            for name in self.SNAPSHOT:
+                setattr(state, name, np.array(arrays[name]))
+
+            # Snapshots taken before the rows were compacted use the interned
+            # indices as rows.
+            profiles = arrays.get('profiles')
+            if profiles is None:
+                profiles = np.arange(state.reactions.shape[0])
+            for i, j in enumerate(profiles):
+                state.assign_row(
+                    i, self.ids.object_id('profile', j) if j >= 0 else None)
+
+            state.grow()
+            state.count_reactors()
+            self.swap(state)
+
+    def similarity_version(self):
+        """Get the version of the similarity served by get_matches."""
+        if self.store is not None:
+            return self.store.version()
+        return self.version
+
+    def rebuild_status(self):
+        """Get the state of the store lease, None without a store: rebuilds
+        are then local to every worker, there is no shared status.
+        """
+        if self.store is None:
+            return None
+
+        status = lease_status(self.lease_name())
+        if status is None:
+            return None
+        return dict((k, v) for k, v in status.items() if k != '_id')
+
+    def lease_name(self):
+        """Name of the store lease, one per store file and host."""
+        return 'store:{0}:{1}'.format(socket.gethostname(),
+                                      os.path.abspath(self.store.path))
+
+    def publish(self, since=None, load=None):
+        """Build the similarity, by default by loading the data, and
+        publish it to the store under the store lease, so a single worker
+        builds at a time.
+
+        A worker asking for a build while another one runs keeps serving
+        the current store and waits. It skips its own build if one completed
+        meanwhile which started after since, by default the time of the
+        request.
+        """
+        since = since or datetime.utcnow()
+        lease = Lease(self.lease_name(), self.lease_seconds)
+        while not self.published_since(since):
+            if not lease.acquire():
+                time.sleep(self.lease_seconds / 10.0)
+                continue
+
+            last = None
+            try:
+                # A build may have completed just before the lease was taken.
+                if not self.published_since(since):
+                    version = self.build_store(load, lease)
+                    last = {
+                        'started': lease.started,
+                        'finished': datetime.utcnow(),
+                        'version': version
+                    }
+            finally:
+                if last is not None:
+                    lease.release(last=last)
+                else:
+                    lease.release()
+
+            # With the lease lost, wait for the worker which took it over.
+            if not lease.lost:
+                break
+
+        self.store.refresh()
+
+    def schedule_publish(self):
+        """Schedule a store publish after an incremental change, unless one
+        is scheduled already, which will publish this change too.
+        """
+        with self.lock:
+            if self.pending is not None:
+                return
+            self.pending = datetime.utcnow()
+
+        app = current_app._get_current_object()
+
+        def publish():
+            with app.app_context():
+                with self.lock:
+                    since, self.pending = self.pending, None
+                try:
+                    self.publish(since=since)
+                except Exception:
+                    app.logger.exception('Publishing the store failed')
+
+        timer = threading.Timer(self.store_delay, publish)
+        timer.daemon = True
+        timer.start()
+
+    def published_since(self, since):
+        """Check whether a store build completed after starting no earlier
+        than since.
+        """
+        status = lease_status(self.lease_name())
+        last = status.get('last') if status is not None else None
+        return last is not None and last['started'] >= since
+
+    def build_store(self, load=None, lease=None):
+        """Load the data, or run load, write the overall similarity to the
+        store as its next version, then drop the in-memory arrays. Nothing
+        is written if the lease it was built under was lost.
+
+        Returns the version written, None if the lease was lost.
+        """
+        version = self.store.version() + 1
+        with self.update_lock:
+            self.building = True
+            try:
+                (load or self.load_data)()
+                if lease is not None and not lease.held():
+                    return None
+                write_store(self.store.path, version, self.profile_ids,
+                            self.active, self.osm)
+            finally:
+                self.building = False
+                self.drop()
+
+        return version
+
+    def load_data(self):
+        """Load all reactions into memory and build the similarity matrices.
+        They are built aside and swapped in.
+        """
+        if self.store is not None and not self.building:
+            self.publish()
+            return
+
+        with self.update_lock:
+            state = self.scratch()
+            state.load_state()
+            self.swap(state)
+
+    def load_state(self):
+        """Load all reactions into the arrays of this backend and build its
+        similarity matrices in place.
+        """
+        self.reset()
+
+        categories = list(mongo.db.categories.find())
+        self.ids.intern_many('category', [c['_id'] for c in categories])
+
+        statements = statement_categories()
+        self.ids.intern_many('statement', list(statements))
+
+        found = list(mongo.db.reactions.find(
+            {}, {'profile': 1, 'statement': 1, 'reaction': 1}))
+
+        # Rows are allocated to the profiles with reactions only, in the
+        # order of their interned indices.
+        indices, rows = np.unique(
+            self.ids.array('profile', [r['profile'] for r in found]),
+            return_inverse=True)
+        for i, j in enumerate(indices):
+            self.assign_row(i, self.ids.object_id('profile', j))
+
+        cols = self.ids.array('statement', [r['statement'] for r in found])
+        self.grow()
+
+        self.weights[:] = 0.0
+        for c in categories:
+            self.weights[self.ids.index('category', c['_id'])] = c.get(
+                'weight', 0.0)
+
+        for sid, cid in statements.items():
+            self.statement_categories[self.ids.index('statement', sid)] = \
+                self.category_column(cid)
+
+        if found != []:
+            self.reactions[rows, cols] = [r['reaction'] for r in found]
+
+        self.count_reactors()
+        self.build_similarity()
+
+    def scratch(self):
+        """Make a backend sharing the state of this one, to build a new
+        state aside. Arrays must be replaced on it, not changed in place.
+        """
+        state = type(self)(block_size=self.block_size, pairs=self.pairs)
+        for name in self.STATE:
+            setattr(state, name, getattr(self, name))
+        return state
+
+    def swap(self, state):
+        """Swap in the state built by a scratch backend as the next version
+        of the similarity.
+        """
+        with self.lock:
+            for name in self.STATE:
+                setattr(self, name, getattr(state, name))
+            self.version += 1
+
+    def drop(self):
+        """Drop the state, unloading the data."""
+        with self.lock:
+            self.reset()
+            self.reactions = None
+
+    def add_reaction(self, rid):
+        """Add a new reaction to the reaction matrix.
+        Only the pairs formed with the other profiles that reacted to the
+        statement are updated, and only in the statement's category.
+        """
+        r = mongo.db.reactions.find_one({'_id': rid})
+        if self.store is not None:
+            self.schedule_publish()
+            return r['profile']
+
+        with self.update_lock:
+            if self.reactions is None:
+                self.load_data()
+                return r['profile']
+
+            with self.lock:
+                i = self.ensure_profile(r['profile'])
+                s = self.ensure_statement(r['statement'])
+                self.reactions[i, s] = r['reaction']
+                self.update_active([s], [i])
+                self.update_pairs(i, self.co_reactors(i, s),
+                                  self.statement_categories[s])
+
+        return r['profile']
+
+    def change_reaction(self, reaction, value):
+        """Update the reaction matrix after the value of a reaction changed.
+        Only the pairs formed with the other profiles that reacted to the
+        statement are updated, and only in the statement's category.
+        """
+        if self.store is not None:
+            self.schedule_publish()
+            return
+
+        with self.update_lock, self.lock:
+            if self.reactions is None:
+                return
+
+            i = self.ensure_profile(reaction['profile'])
+            s = self.ensure_statement(reaction['statement'])
+            self.reactions[i, s] = value
+            self.update_pairs(i, self.co_reactors(i, s),
+                              self.statement_categories[s])
+
+    def remove_reaction(self, reaction):
+        """Update the reaction matrix after a reaction was removed. Only the
+        pairs formed with the other profiles that reacted to the statement are
+        updated, and only in the statement's category.
+        """
+        if self.store is not None:
+            self.schedule_publish()
+            return
+
+        with self.update_lock, self.lock:
+            i = self.profile_row(reaction['profile'])
+            s = self.statement_column(reaction['statement'])
+            if self.reactions is None or i is None or s is None:
+                return
+
+            self.reactions[i, s] = np.nan
+            self.update_active([s], [i])
+            self.update_pairs(i, self.co_reactors(i, s),
+                              self.statement_categories[s])
+
+    def remove_statement(self, statement, reactions):
+        """Update the similarities after a statement and its reactions were
+        removed. Only the pairs which co-reacted to the statement are updated,
+        and only in the statement's category.
+        """
+        if self.store is not None:
+            self.schedule_publish()
+            return
+
+        with self.update_lock, self.lock:
+            s = self.statement_column(statement['_id'])
+            if self.reactions is None or s is None:
+                return
+
+            rows = np.flatnonzero(~np.isnan(self.reactions[:, s]))
+            c = self.statement_categories[s]
+            self.reactions[:, s] = np.nan
+            self.statement_categories[s] = -1
+            self.update_active([s], rows)
+            self.update_group(rows, c)
+
+    def move_statement(self, statement, category):
+        """Update the similarities after a statement was moved to another
+        category. Only the pairs which co-reacted to the statement are
+        updated, in the old and the new category.
+        """
+        if self.store is not None:
+            self.schedule_publish()
+            return
+
+        with self.update_lock, self.lock:
+            s = self.statement_column(statement['_id'])
+            if self.reactions is None or s is None:
+                return
+
+            rows = np.flatnonzero(~np.isnan(self.reactions[:, s]))
+            c = self.statement_categories[s]
+            self.statement_categories[s] = self.ensure_category(category)
+            self.update_group(rows, c)
+            self.update_group(rows, self.statement_categories[s])
+
+    def update_group(self, rows, c):
+        """Recompute the category similarity of every pair among the given
+        profile rows in category c, then their overall similarity.
+        """
+        if c < 0 or rows.size < 2 or self.csum is None:
+            return
+
+        cols = np.flatnonzero(self.statement_categories == c)
+        sub = self.reactions[:, cols]
+        block = np.ix_(rows, rows)
+        sums, counts = self.pair_block(sub[rows], sub[rows])
+        self.csum[c][block] = sums
+        self.ccnt[c][block] = counts
+        self.csum[c, rows, rows] = 0
+        self.ccnt[c, rows, rows] = 0
+
+        self.osm[block] = self.overall(rows, rows)
+
+    def update_pairs(self, i, partners, c):
+        """Recompute the category similarity of the pairs formed by profile
+        row i and the given partner rows in category c, then their overall
+        similarity.
+        """
+        if c < 0 or partners.size == 0 or self.csum is None:
+            return
+
+        cols = np.flatnonzero(self.statement_categories == c)
+        sub = self.reactions[:, cols]
+        sums, counts = self.pair_block(sub[[i]], sub[partners])
+        self.csum[c, i, partners] = sums[0]
+        self.csum[c, partners, i] = sums[0]
+        self.ccnt[c, i, partners] = counts[0]
+        self.ccnt[c, partners, i] = counts[0]
+
+        sims = self.overall([i], partners)[0]
+        self.osm[i, partners] = sims
+        self.osm[partners, i] = sims
+
+    def co_reactors(self, i, s):
+        """Rows of the profiles other than i that reacted to statement s."""
+        partners = np.flatnonzero(~np.isnan(self.reactions[:, s]))
+        return partners[partners != i]
+
+    def update_similarity(self, filter_by=None):
+        """Update category and overall similarity matrices. With a store,
+        a full update publishes a new store. A full update builds the
+        matrices aside and swaps them in.
+        """
+        if self.store is not None and not self.building:
+            if filter_by is None:
+                self.publish()
+            else:
+                self.schedule_publish()
+            return
+
+        with self.update_lock:
+            if self.reactions is None:
+                self.load_data()
+                return
+
+            if filter_by is None or self.csum is None:
+                state = self.scratch()
+                state.weights = self.weights.copy()
+                state.refresh_weights()
+                state.build_similarity()
+                self.swap(state)
+                return
+
+            i = self.profile_row(filter_by)
+            if i is None:
+                return
+
+            with self.lock:
+                self.refresh_weights()
+                rows = np.array([i])
+                self.aggregate(rows)
+                sims = self.overall(rows)
+                self.osm[rows, :] = sims
+                self.osm[:, rows] = sims.T
+
+    def build_similarity(self):
+        """Build the category and overall similarity matrices of every
+        profile from scratch, replacing the current ones.
+        """
+        k, n = self.weights.size, self.reactions.shape[0]
+        self.csum = np.zeros((k, n, n))
+        self.ccnt = np.zeros((k, n, n), dtype=np.int32)
+        self.aggregate(np.arange(n))
+        self.osm = self.overall(np.arange(n))
+
+    def aggregate(self, rows):
+        """Recompute the category sums and counts of every pair formed by
+        the given profile rows.
+        """
+        for c in range(self.weights.size):
+            cols = np.flatnonzero(self.statement_categories == c)
+            if cols.size == 0:
+                self.csum[c, rows, :] = 0
+                self.ccnt[c, rows, :] = 0
+                self.csum[c][:, rows] = 0
+                self.ccnt[c][:, rows] = 0
+                continue
+
+            sub = self.reactions[:, cols]
+            for start in range(0, rows.size, self.block_size):
+                block = rows[start:start + self.block_size]
+                sums, counts = self.pair_block(sub[block], sub)
+                self.csum[c, block, :] = sums
+                self.ccnt[c, block, :] = counts
+                self.csum[c][:, block] = sums.T
+                self.ccnt[c][:, block] = counts.T
+
+            self.csum[c, rows, rows] = 0
+            self.ccnt[c, rows, rows] = 0
+
+    def update_weights(self):
+        """Apply the current category weights to the overall similarity
+        matrix. Only the category aggregates are read. With a store, a new
+        store is published.
+        """
+        if self.store is not None:
+            self.publish()
+            return
+
+        with self.update_lock:
+            if self.csum is None:
+                return
+
+            state = self.scratch()
+            state.weights = self.weights.copy()
+            state.refresh_weights()
+            state.osm = state.overall(np.arange(state.reactions.shape[0]))
+            self.swap(state)
+
+    def purge_similarity(self):
+        """Purge all similarity matrices, publishing an empty store."""
+        with self.update_lock:
+            self.drop()
+
+        if self.store is not None:
+            self.publish(load=self.load_empty)
+
+    def load_empty(self):
+        """Load an empty state, without profiles."""
+        self.reset()
+        self.osm = np.zeros((0, 0))
+
+    def clear_orphans(self, profile):
+        """Remove orphaned similarities from all matrices.
+        The profile's row and column are cleared in place, so no other pair
+        is touched, and the row is freed for the next new profile.
+        """
+        if self.store is not None:
+            self.schedule_publish()
+            return
+
+        with self.update_lock, self.lock:
+            i = self.profile_row(profile)
+            if self.reactions is None or i is None:
+                return
+
+            cols = np.flatnonzero(~np.isnan(self.reactions[i]))
+            self.reactions[i, :] = np.nan
+            self.update_active(cols, [i])
+            if self.csum is not None:
+                self.csum[:, i, :] = 0
+                self.csum[:, :, i] = 0
+                self.ccnt[:, i, :] = 0
+                self.ccnt[:, :, i] = 0
+            if self.osm is not None:
+                self.osm[i, :] = 0
+                self.osm[:, i] = 0
+
+            del self.rows[profile]
+            self.profile_ids[i] = None
+            self.free.append(i)
+
+    def profiles(self):
+        """Get all profiles in the datastore and return them as a list."""
+        profile = mongo.db.profiles
+        return [str(x) for x in profile.distinct("_id")]
+
+    def statements(self):
+        """Get all statements and return them in a list."""
+        return [str(x) for x in mongo.db.statements.distinct("_id")]
+
+    def distance_score(self, weight, distance):
+        """Calculate the Euclidean distance score between two users based on
+        the category weight."""
+        return weight / (1 + distance)
+
+    def reset(self):
+        """Drop all in-memory state."""
+        self.weights = np.zeros(0)
+        self.statement_categories = np.zeros(0, dtype=np.int32)
+        self.reactions = np.full((0, 0), np.nan)
+        self.csum = None
+        self.ccnt = None
+        self.osm = None
+        self.reactors = np.zeros(0, dtype=np.int64)
+        self.active = np.zeros(0, dtype=bool)
+        self.profile_ids = []
+        self.rows = {}
+        self.free = []
+
+    def pair_block(self, block, sub):
+        """Aggregate a block of profile rows against all profiles, with the
+        aggregation of the pairs of the backend.
+        """
+        if self.pairs == 'buckets':
+            return self.bucket_block(block, sub)
+        return self.statement_block(block, sub)
+
+    def statement_block(self, block, sub):
+        """Broadcast a block of profile rows against all profiles.
+
+        Returns the unweighted sums of 1 / (1 + |r_i - r_j|) and the number
+        of shared statements for every (block row, profile) pair.
+        """
+        distance = np.abs(block[:, None, :] - sub[None, :, :])
+        valid = ~np.isnan(distance)
+        scores = np.where(valid, self.distance_score(1.0, distance), 0.0)
+        return scores.sum(axis=2), valid.sum(axis=2)
+
+    def bucket_block(self, block, sub):
+        """Aggregate a block of profile rows against all profiles one
+        reaction value bucket of the block at a time.
+
+        Every reaction v of the bucket scores 1 / (1 + |v - r_j|) against
+        the reactions r_j to its statement, so the sums of the bucket are a
+        single product of its indicator matrix with the scores of all
+        profiles against v. No (block x profiles x statements) array is
+        formed.
+
+        Returns the same sums and counts as statement_block.
+        """
+        valid = ~np.isnan(sub)
+        counts = np.dot(~np.isnan(block) * 1.0, valid.T * 1.0)
+
+        sums = np.zeros(counts.shape)
+        for v in np.unique(block[~np.isnan(block)]):
+            scores = np.where(valid, self.distance_score(1.0, np.abs(sub - v)),
+                              0.0)
+            sums += np.dot((block == v) * 1.0, scores.T)
+
+        return sums, np.rint(counts).astype(np.int64)
+
+    def overall(self, rows, cols=None):
+        """Overall similarity of the given profile rows against all profiles,
+        or against the given profile columns only.
+
+        Category similarities are the weighted mean of the statement scores,
+        the overall similarity is their sum.
+        """
+        sums = self.csum[:, rows, :]
+        counts = self.ccnt[:, rows, :]
+        if cols is not None:
+            sums = sums[:, :, cols]
+            counts = counts[:, :, cols]
+        means = np.divide(sums, counts, out=np.zeros(sums.shape),
+                          where=counts > 0)
+        return np.tensordot(self.weights, means, axes=1)
+
+    def active_profiles(self):
+        """Flag profiles which share at least one statement with another."""
+        reacted = ~np.isnan(self.reactions)
+        shared = reacted.sum(axis=0) > 1
+        return (reacted & shared).any(axis=1)
+
+    def count_reactors(self):
+        """Count the reactors of every statement and flag the active
+        profiles from scratch.
+        """
+        self.reactors = (~np.isnan(self.reactions)).sum(axis=0)
+        self.active = self.active_profiles()
+
+    def update_active(self, cols, rows):
+        """Recount the reactors of the statement columns cols after their
+        reactions changed, and flag again the profiles which react to them
+        along with the profile rows.
+        """
+        cols = np.asarray(cols, dtype=np.int64)
+        reacted = ~np.isnan(self.reactions[:, cols])
+        self.reactors[cols] = reacted.sum(axis=0)
+
+        rows = np.union1d(np.flatnonzero(reacted.any(axis=1)),
+                          np.asarray(rows, dtype=np.int64))
+        shared = self.reactors > 1
+        self.active[rows] = (~np.isnan(self.reactions[rows]) & shared).any(
+            axis=1)
+
+    def refresh_weights(self):
+        """Reload category weights from the datastore. Removed categories
+        weigh nothing.
+        """
+        self.weights[:] = 0.0
+        for c in mongo.db.categories.find():
+            k = self.ids.index('category', c['_id'])
+            if k is not None and k < self.weights.size:
+                self.weights[k] = c.get('weight', 0.0)
+
+    def profile_row(self, pid):
+        """Return the matrix row of a profile, None if it has none."""
+        if self.reactions is None:
+            return None
+        return self.rows.get(pid)
+
+    def assign_row(self, i, pid):
+        """Give row i to a profile, or mark it free if pid is None."""
+        while len(self.profile_ids) <= i:
+            self.profile_ids.append(None)
+
+        self.profile_ids[i] = pid
+        if pid is None:
+            self.free.append(i)
+        else:
+            self.rows[pid] = i
+
+    def statement_column(self, sid):
+        """Return the matrix column of a statement, None if it has none."""
+        s = self.ids.index('statement', sid)
+        if s is None or self.reactions is None or \
+                s >= self.reactions.shape[1]:
+            return None
+        return s
+
+    def category_column(self, cid):
+        """Return the index of a category, -1 if it has none."""
+        if cid is None:
+            return -1
+        k = self.ids.index('category', cid)
+        return -1 if k is None or k >= self.weights.size else k
+
+    def grow(self):
+        """Grow every array to the number of profile rows and of interned
+        statements and categories. New cells hold no reaction and no
+        similarity.
+        """
+        n = len(self.profile_ids) - self.reactions.shape[0]
+        m = self.ids.size('statement') - self.reactions.shape[1]
+        k = self.ids.size('category') - self.weights.size
+
+        if n > 0 or m > 0:
+            self.reactions = np.pad(self.reactions, ((0, max(n, 0)),
+                                                     (0, max(m, 0))),
+                                    'constant', constant_values=np.nan)
+        if m > 0:
+            self.statement_categories = np.append(
+                self.statement_categories, np.full(m, -1, dtype=np.int32))
+        if k > 0:
+            self.weights = np.append(self.weights, np.zeros(k))
+        if m > 0:
+            self.reactors = np.append(self.reactors,
+                                      np.zeros(m, dtype=np.int64))
+        if n > 0:
+            self.active = np.append(self.active, np.zeros(n, dtype=bool))
+
+        pad = ((0, max(k, 0)), (0, max(n, 0)), (0, max(n, 0)))
+        if self.csum is not None and (n > 0 or k > 0):
+            self.csum = np.pad(self.csum, pad, 'constant')
+            self.ccnt = np.pad(self.ccnt, pad, 'constant')
+        if self.osm is not None and n > 0:
+            self.osm = np.pad(self.osm, ((0, n), (0, n)), 'constant')
+
+    def ensure_profile(self, pid):
+        """Return the matrix row of a profile, adding it if needed in a freed
+        row, or else in a new one.
+        """
+        if pid not in self.rows:
+            # Interned so snapshots can name the profile of every row.
+            self.ids.intern('profile', pid)
+            if self.free != []:
+                i = self.free.pop()
+            else:
+                i = len(self.profile_ids)
+            self.assign_row(i, pid)
+            self.grow()
+
+        return self.rows[pid]
+
+    def ensure_statement(self, sid):
+        """Return the matrix column of a statement, adding it if needed."""
+        if self.statement_column(sid) is None:
+            s = mongo.db.statements.find_one({'_id': sid}) or {}
+            column = self.ids.intern('statement', sid)
+            self.grow()
+            self.statement_categories[column] = self.ensure_category(
+                s.get('category'))
+
+        return self.statement_column(sid)
+
+    def ensure_category(self, cid):
+        """Return the index of a category, adding it if needed."""
+        if cid is None:
+            return -1
+
+        if self.category_column(cid) < 0:
+            c = mongo.db.categories.find_one({'_id': cid})
+            k = self.ids.intern('category', cid)
+            self.grow()
+            self.weights[k] = c.get('weight', 0.0) if c is not None else 0.0
+
+        return self.category_column(cid)
@@ -0,0 +1,167 @@
+"""Index specification of the recommender system collections."""
+
+
+__all__ = ['INDEXES', 'ensure_indexes', 'remove_duplicate_reactions']
+
+
+import time
+
+
+from pymongo import (
+    ASCENDING, DESCENDING,
+)
+from pymongo.errors import (
+    DuplicateKeyError, OperationFailure,
+)
+
+
+from app import mongo
+from app.rs.marks import advance_mark
+from app.rs.versions import (
+    VERSIONED, current_version, versioned_name,
+)
+
+
+# Indexes per collection, each given as a list of (field, direction) keys and
+# the options passed on to create_index.
+INDEXES = {
+    'ids': [
+        ([('kind', ASCENDING), ('oid', ASCENDING)], {'unique': True}),
+        ([('kind', ASCENDING), ('index', ASCENDING)], {'unique': True}),
+    ],
+    'reactions': [
+        ([('statement', ASCENDING), ('profile', ASCENDING)], {'unique': True}),
+        ([('profile', ASCENDING)], {}),
+    ],
+    'smrows': [
+        ([('key', ASCENDING), ('statement', ASCENDING)], {'unique': True}),
+        ([('pair', ASCENDING)], {}),
+        ([('statement', ASCENDING)], {}),
+    ],
+    'cmrows': [
+        ([('key', ASCENDING), ('category', ASCENDING)], {'unique': True}),
+        ([('pair', ASCENDING)], {}),
+    ],
+    'omrows': [
+        ([('key', ASCENDING)], {'unique': True}),
+        ([('pair', ASCENDING), ('similarity', DESCENDING)], {}),
+    ],
+    'topk': [
+        ([('matches.profile', ASCENDING)], {}),
+    ],
+    'pmrows': [
+        ([('key', ASCENDING)], {'unique': True}),
+        ([('pair', ASCENDING), ('similarity', DESCENDING)], {}),
+    ],
+}
+
+
+def ensure_indexes():
+    """Create any missing index of the specification, on the current version
+    of the versioned collections.
+
+    An existing index on the same keys with other options, such as the
+    plain reactions index which the unique one replaces, is dropped and
+    created again with the options of the specification. An index is only
+    replaced by a unique one once the collection was checked to hold no
+    duplicates, and put back if the unique index still failed.
+
+    Returns a report as a list of (collection, index name, created, seconds)
+    tuples, one per index in the specification.
+
+    Raises OperationFailure, such as DuplicateKeyError, if an index cannot
+    be created.
+    """
+    version = current_version()
+
+    report = []
+    for collection, indexes in sorted(INDEXES.items()):
+        if collection in VERSIONED:
+            collection = versioned_name(collection, version)
+        rows = mongo.db[collection]
+        existing = rows.index_information()
+        for keys, options in indexes:
+            start = time.time()
+            replaced = conflicting_indexes(existing, keys, options)
+            if replaced != [] and options.get('unique') and \
+                    has_duplicates(rows, keys):
+                raise DuplicateKeyError(
+                    'Duplicates of the unique {0} index in {1}, the existing '
+                    'index is kept'.format(
+                        ', '.join(field for field, _ in keys), collection),
+                    11000)
+
+            for index in replaced:
+                rows.drop_index(index)
+            try:
+                name = rows.create_index(keys, **options)
+            except OperationFailure:
+                # Duplicates were written meanwhile.
+                for index in replaced:
+                    rows.create_index(
+                        [(field, int(direction)) for field, direction
+                         in existing[index]['key']],
+                        name=index, unique=bool(existing[index].get('unique')))
+                raise
+
+            for index in replaced:
+                del existing[index]
+            report.append(
+                (collection, name, name not in existing, time.time() - start))
+
+    return report
+
+
+def has_duplicates(collection, keys):
+    """Check whether documents of a collection share the values of the given
+    keys, so no unique index on them can be created.
+    """
+    group = dict((field.replace('.', '_'), '${0}'.format(field))
+                 for field, _ in keys)
+    found = collection.aggregate([
+        {'$group': {'_id': group, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$limit': 1}
+    ], allowDiskUse=True)
+    return any(True for _ in found)
+
+
+def conflicting_indexes(existing, keys, options):
+    """Get the names of the existing indexes on the given keys whose
+    uniqueness differs from the given options, which creating the index
+    would conflict with.
+    """
+    keys = [(field, int(direction)) for field, direction in keys]
+    return [
+        name for name, info in existing.items()
+        if [(field, int(direction)) for field, direction in info['key']] ==
+        keys and bool(info.get('unique')) != bool(options.get('unique'))
+    ]
+
+
+def remove_duplicate_reactions():
+    """Keep only the first reaction of every profile to a statement, so the
+    unique reactions index can be created.
+
+    The statement rows, statistics and buckets still count the removed
+    reactions, so the buckets must be rebuilt and the similarity recounted
+    from the reactions after any was removed.
+
+    Returns the number of reactions removed.
+    """
+    removed = 0
+    for dup in mongo.db.reactions.aggregate([
+        {'$sort': {'_id': 1}},
+        {'$group': {
+            '_id': {'statement': '$statement', 'profile': '$profile'},
+            'ids': {'$push': '$_id'},
+            'count': {'$sum': 1}
+        }},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True):
+        removed += mongo.db.reactions.delete_many(
+            {'_id': {'$in': dup['ids'][1:]}}).deleted_count
+
+    if removed > 0:
+        advance_mark()
+    return removed
@@ -0,0 +1,138 @@
+"""Dense integer indices for the ObjectIds of profiles, statements and
+categories.
+
+Indices are allocated from a counter per kind and stored in the ids
+collection, so they stay the same across restarts and workers. Backends use
+them in place of ObjectIds in their arrays and rows, and translate back at
+the API boundary.
+"""
+
+
+__all__ = ['IdRegistry', 'registry']
+
+
+import threading
+
+
+import numpy as np
+from pymongo import ReturnDocument
+from pymongo.errors import (
+    BulkWriteError, DuplicateKeyError,
+)
+
+
+from app import mongo
+
+
+class IdRegistry(object):
+    """Persistent two-way mapping of ObjectIds to int32 indices per kind."""
+
+    KINDS = ('profile', 'statement', 'category')
+
+    def __init__(self):
+        """"""
+        self.lock = threading.RLock()
+        self.indices = dict((kind, {}) for kind in self.KINDS)
+        self.ids = dict((kind, []) for kind in self.KINDS)
+        self.load()
+
+    def load(self):
+        """Load every stored mapping."""
+        with self.lock:
+            for doc in mongo.db.ids.find({}, {'_id': 0}):
+                self.remember(doc['kind'], doc['oid'], doc['index'])
+
+    def intern(self, kind, oid):
+        """Get the index of an ObjectId, allocating one if it has none."""
+        return self.intern_many(kind, [oid])[0]
+
+    def intern_many(self, kind, oids):
+        """Get the indices of a list of ObjectIds, allocating a block of
+        indices for the ones without.
+        """
+        with self.lock:
+            missing = []
+            for oid in set(oids):
+                if oid not in self.indices[kind]:
+                    missing.append(oid)
+
+            if missing != []:
+                self.allocate(kind, missing)
+
+            return [self.indices[kind][oid] for oid in oids]
+
+    def index(self, kind, oid):
+        """Get the index of an ObjectId, None if it has none."""
+        with self.lock:
+            if oid not in self.indices[kind]:
+                doc = mongo.db.ids.find_one({'kind': kind, 'oid': oid})
+                if doc is None:
+                    return None
+                self.remember(kind, oid, doc['index'])
+
+            return self.indices[kind][oid]
+
+    def object_id(self, kind, index):
+        """Get the ObjectId of an index, None if it is not allocated."""
+        with self.lock:
+            if index >= len(self.ids[kind]) or self.ids[kind][index] is None:
+                doc = mongo.db.ids.find_one({'kind': kind, 'index': int(index)})
+                if doc is None:
+                    return None
+                self.remember(kind, doc['oid'], index)
+
+            return self.ids[kind][index]
+
+    def array(self, kind, oids):
+        """Get the indices of a list of ObjectIds as an int32 array."""
+        return np.array(self.intern_many(kind, oids), dtype=np.int32)
+
+    def size(self, kind):
+        """Get the number of indices known for a kind, one past the largest."""
+        return len(self.ids[kind])
+
+    def allocate(self, kind, oids):
+        """Allocate a block of indices and store the new mappings. ObjectIds
+        allocated concurrently by another worker keep that worker's index.
+        """
+        counter = mongo.db.counters.find_one_and_update(
+            {'_id': 'ids.{0}'.format(kind)},
+            {'$inc': {'next': len(oids)}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        start = counter['next'] - len(oids)
+
+        docs = [{'kind': kind, 'oid': oid, 'index': start + i}
+                for i, oid in enumerate(oids)]
+        try:
+            mongo.db.ids.insert_many(docs, ordered=False)
+        except (BulkWriteError, DuplicateKeyError):
+            pass
+
+        for doc in mongo.db.ids.find(
+                {'kind': kind, 'oid': {'$in': oids}}, {'_id': 0}):
+            self.remember(kind, doc['oid'], doc['index'])
+
+    def remember(self, kind, oid, index):
+        """Keep a mapping in memory."""
+        ids = self.ids[kind]
+        if index >= len(ids):
+            ids.extend([None] * (index + 1 - len(ids)))
+        ids[index] = oid
+        self.indices[kind][oid] = index
+
+
+# Registry shared by the backends of this process, loaded on first use.
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def registry():
+    """Get the registry of this process, loading it once even if several
+    threads ask for it first at the same time.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = IdRegistry()
+    return _registry
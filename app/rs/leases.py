@@ -0,0 +1,136 @@
+"""Leases on named locks shared by the workers.
+
+A lease is a document of the leases collection, owned by one worker until
+it is released or its expiry passes without being renewed, so the lock of a
+worker which died is taken over after at most one lease period. The
+document is kept on release, holding the state of the last run for every
+worker to see.
+"""
+
+
+__all__ = ['Lease', 'lease_status']
+
+
+from datetime import (
+    datetime, timedelta,
+)
+import logging
+import os
+import socket
+import threading
+import uuid
+
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+from app import mongo
+
+
+logger = logging.getLogger(__name__)
+
+
+class Lease(object):
+    """Lease on a named lock, renewed in the background while held. A lease
+    which failed to renew is flagged as lost.
+    """
+
+    def __init__(self, name, seconds=60):
+        """"""
+        self.name = name
+        self.seconds = seconds
+        self.owner = '{0}:{1}:{2}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.started = None
+        self.stopped = threading.Event()
+        self.renewer = None
+        self.lost = False
+
+        # Leases collection, taken on acquire in the application context so
+        # the renewer thread runs without one.
+        self.collection = None
+
+    def acquire(self, **info):
+        """Take the lock if it is free or its lease expired, storing info
+        along with it.
+
+        Returns True if the lock was taken.
+        """
+        now = datetime.utcnow()
+        values = dict(info, owner=self.owner, state='running', started=now,
+                      expires=self.expiry(now))
+        self.collection = mongo.db.leases
+        try:
+            self.collection.find_one_and_update(
+                {
+                    '_id': self.name,
+                    '$or': [{'owner': None}, {'expires': {'$lt': now}}]
+                },
+                {'$set': values},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            return False
+
+        self.started = now
+        self.lost = False
+        self.stopped.clear()
+        self.renewer = threading.Thread(
+            target=self.renew_until_released,
+            name='lease-{0}'.format(self.name))
+        self.renewer.daemon = True
+        self.renewer.start()
+        return True
+
+    def renew(self):
+        """Extend the lease. Returns False if it was lost."""
+        found = self.collection.update_one(
+            {'_id': self.name, 'owner': self.owner},
+            {'$set': {'expires': self.expiry(datetime.utcnow())}})
+        return found.matched_count == 1
+
+    def renew_until_released(self):
+        """Renew the lease three times per period until it is released."""
+        while not self.stopped.wait(self.seconds / 3.0):
+            try:
+                renewed = self.renew()
+            except Exception:
+                # Retried on the next round, the lease is only lost once it
+                # expired and another worker took it.
+                logger.exception('Renewing the {0} lease failed'.format(
+                    self.name))
+                continue
+
+            if not renewed:
+                self.lost = True
+                logger.warning('Lost the {0} lease'.format(self.name))
+                return
+
+    def held(self):
+        """Check that the lease is still held, renewing it, before acting on
+        the work done under it.
+        """
+        if not self.lost and not self.renew():
+            self.lost = True
+        return not self.lost
+
+    def release(self, **info):
+        """Free the lock, storing info along with it."""
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+            self.renewer = None
+
+        now = datetime.utcnow()
+        self.collection.update_one(
+            {'_id': self.name, 'owner': self.owner},
+            {'$set': dict(info, owner=None, state='idle', expires=now)})
+
+    def expiry(self, now):
+        """Get the expiry of a lease taken or renewed now."""
+        return now + timedelta(seconds=self.seconds)
+
+
+def lease_status(name):
+    """Get the lease document of a lock, None if it was never taken."""
+    return mongo.db.leases.find_one({'_id': name})
@@ -0,0 +1,31 @@
+"""High-water mark of the inputs of the similarity.
+
+The mark is a counter in the marks collection, advanced whenever reactions
+are written or removed, a statement changes category or category weights
+change. Snapshots record the mark they were taken at, so a snapshot is known
+to be current as long as the mark did not move past it.
+"""
+
+
+__all__ = ['advance_mark', 'current_mark']
+
+
+from app import mongo
+
+
+# _id of the mark of the reactions in the marks collection.
+REACTIONS = 'reactions'
+
+
+def advance_mark():
+    """Advance the mark after a change to the inputs of the similarity."""
+    mongo.db.marks.update_one(
+        {'_id': REACTIONS},
+        {'$inc': {'seq': 1}, '$currentDate': {'changed': True}},
+        upsert=True)
+
+
+def current_mark():
+    """Get the mark, 0 if the inputs never changed since it was added."""
+    mark = mongo.db.marks.find_one({'_id': REACTIONS})
+    return mark['seq'] if mark is not None else 0
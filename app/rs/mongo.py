@@ -2,28 +2,130 @@
 
 
 from app import mongo
+from app.rs.buckets import (
+    readable, statement_reactors,
+)
+from app.rs.chunks import (
+    DerivedWriter, chunked, write_chunks,
+)
+from app.rs.leases import (
+    Lease, lease_status,
+)
+from app.rs.pairs import (
+    pair_key, unkeyed_pairs, upserts,
+)
+from app.rs.scan import (
+    reaction_pairs, statement_categories, statement_reactions,
+    unique_reactions,
+)
+from app.rs.topk import (
+    best_matches, merge_matches,
+)
+from app.rs.versions import (
+    allocate_version, building_version, collect_versions, copy_version,
+    current_version, discard_changes, drop_version, flip_version, log_changes,
+    logged_changes, start_building, versioned_name,
+)
 
 
+from pymongo import (
+    DESCENDING, DeleteOne, UpdateOne,
+)
+from pymongo.errors import DuplicateKeyError
+
+
+from datetime import datetime
 import itertools
-import numpy as np
+import threading
+import time
+
+
+# Attempts at setting the score of a pair document while other workers add
+# or remove it.
+SCORE_ATTEMPTS = 3
 
 
 class MongoRecommenderSystem(object):
-    """MongoDB based recommender system."""
+    """MongoDB based recommender system.
 
-    def __init__(self):
+    Category rows hold the unweighted mean of the statement scores of a pair
+    and its overall similarity is their weighted sum. The similarity
+    collections are versioned, see app.rs.versions, and the options are
+    described with the RS_ settings of config.py.
+    """
+
+    def __init__(self, storage='rows', rebuild='python', layout='rows',
+                 buckets=False, topk=0, sparse=False,
+                 min_similarity=0.0, min_shared=1, batch_size=1000,
+                 write_concern=1, write_workers=1, lease_seconds=60):
         """"""
-        self.build_statement_similarity()
-        self.update_similarity()
+        self.storage = storage
+        self.rebuild = rebuild
+        self.layout = layout
+        self.buckets = buckets
+        self.topk = topk
+        self.sparse = sparse
+        self.min_similarity = min_similarity
+        self.min_shared = min_shared
+        self.batch_size = max(1, int(batch_size))
+        if write_concern < 1:
+            # Unacknowledged writes could still be applied after the flip.
+            raise ValueError(
+                'write_concern must be at least 1, not {0}'.format(
+                    write_concern))
+        self.write_concern = write_concern
+        self.write_workers = write_workers
+        self.lease_seconds = lease_seconds
+        self.overall = 'pmrows' if layout == 'pairs' else 'omrows'
+        self.lock = threading.RLock()
+        self.version = current_version()
+        self.building = None
+        self.ready = False
+
+    def warm_up(self):
+        """Build the similarity unless a version of it was already flipped
+        to, by this or another worker, then mark the backend as ready.
+
+        Raises RuntimeError if similarity rows lack their pair key, which the
+        rebuilds and updates match rows on, until migrate-pairs is run.
+        """
+        unkeyed = unkeyed_pairs()
+        if unkeyed != []:
+            raise RuntimeError(
+                'Similarity rows without a pair key in {0}, run '
+                'manage.py migrate-pairs'.format(', '.join(unkeyed)))
+
+        self.sync_version()
+        if self.version == 0:
+            # Any completed rebuild will do, even one which started earlier.
+            self.rebuild_version(
+                self.rebuild_similarity, 'similarity',
+                carry=self.storage == 'stats', since=datetime.min)
+
+        self.ready = True
+
+    def get_matches(self, pid, sort_sim=None, limit=None):
+        """Get and return all matches for the given profile, from the current
+        version of the similarity.
+        """
+        version = current_version()
+        if self.topk and sort_sim == DESCENDING and limit is not None and \
+                limit <= self.topk:
+            top = self.collection('topk', version).find_one({'_id': pid})
+            if top is None:
+                return []
+            return [(m['profile'], m['similarity'])
+                    for m in top['matches'][:limit]]
 
-    def get_matches(self, pid, sort_sim=None):
-        """Get and return all matches for the given profile."""
         matches = []
 
-        found = mongo.db.omrows.find({'pair': pid})
+        overall = self.collection(self.overall, version)
+        found = overall.find(self.overall_query(pid))
         if sort_sim is not None:
-            found = mongo.db.omrows.find(
-                {'pair': pid}).sort('similarity', sort_sim)
+            found = overall.find(
+                self.overall_query(pid)).sort('similarity', sort_sim)
+        if limit is not None:
+            found = found.limit(limit)
 
         for sim in found:
             matches.append(
@@ -31,139 +133,1250 @@ class MongoRecommenderSystem(object):
 
         return matches
 
+    def similarity_version(self):
+        """Get the version of the similarity served by get_matches."""
+        return current_version()
+
+    def collection(self, name, version=None):
+        """Get a versioned similarity collection, by default of the version
+        being rebuilt, if any, else of the version last synced.
+        """
+        if version is None:
+            version = self.building if self.building is not None \
+                else self.version
+        return mongo.db[versioned_name(name, version)]
+
+    def sync_version(self):
+        """Pick up the current version, which another worker may have
+        flipped.
+        """
+        self.version = current_version()
+
     def add_reaction(self, rid):
         """Add a new reaction to the statement similarity matrix.
         Rows are only added if two or more users have reacted to the statment.
+        Only the pairs formed with the other profiles that reacted to the
+        statement are updated, and only in the statement's category.
         """
-        r = mongo.db.reactions.find_one({"_id": rid})
-        rows = self.statement_rows(r['statement'], filter_by=r['profile'])
+        with self.lock:
+            self.sync_version()
+            r = mongo.db.reactions.find_one({"_id": rid})
+            rows = self.statement_rows(r['statement'], filter_by=r['profile'])
 
-        if rows != []:
-            mongo.db.smrows.insert_many(rows)
+            if rows != []:
+                if self.storage != 'stats':
+                    mongo.db.smrows.bulk_write(upserts(rows, ('statement',)))
+
+                self.update_pairs(
+                    [row['pair'] for row in rows], rows[0]['category'])
+
+            return r['profile']
+
+    def change_reaction(self, reaction, value):
+        """Update the statement similarity after the value of a reaction
+        changed. Only the pairs formed with the other profiles that reacted to
+        the statement are updated, and only in the statement's category.
+        """
+        with self.lock:
+            self.sync_version()
+            s = mongo.db.statements.find_one({'_id': reaction['statement']})
+            if s is None:
+                return
+
+            profile = reaction['profile']
+            others = self.co_reactions(reaction['statement'], profile)
+            if self.storage != 'stats':
+                for partner, other in others:
+                    mongo.db.smrows.update_one(
+                        {
+                            'key': pair_key(profile, partner),
+                            'statement': reaction['statement']
+                        },
+                        {'$set': {'distance': abs(value - other)}}
+                    )
+
+            self.update_pairs(
+                [[profile, x[0]] for x in others], s['category'])
+
+    def remove_reaction(self, reaction):
+        """Update the statement similarity after a reaction was removed. Only
+        the pairs formed with the other profiles that reacted to the statement
+        are updated, and only in the statement's category.
+        """
+        with self.lock:
+            self.sync_version()
+            s = mongo.db.statements.find_one({'_id': reaction['statement']})
+            if s is None:
+                return
+
+            profile = reaction['profile']
+            others = self.co_reactions(reaction['statement'], profile)
+            if self.storage != 'stats':
+                mongo.db.smrows.remove(
+                    {'pair': profile, 'statement': reaction['statement']})
+
+            self.update_pairs(
+                [[profile, x[0]] for x in others], s['category'])
+
+    def remove_statement(self, statement, reactions):
+        """Update the similarities after a statement and its reactions were
+        removed. Only the pairs which co-reacted to the statement are updated,
+        and only in the statement's category.
+        """
+        with self.lock:
+            self.sync_version()
+            pairs = self.statement_pairs(reactions)
+            if self.storage != 'stats':
+                mongo.db.smrows.remove({'statement': statement['_id']})
+
+            self.update_pairs([x[0] for x in pairs], statement['category'])
+
+    def move_statement(self, statement, category):
+        """Update the similarities after a statement was moved to another
+        category. Only the pairs which co-reacted to the statement are
+        updated, in the old and the new category.
+        """
+        with self.lock:
+            self.sync_version()
+            if statement['category'] == category:
+                return
+
+            pairs = self.statement_pairs(mongo.db.reactions.find(
+                {'statement': statement['_id']},
+                {'profile': 1, 'reaction': 1}))
+            if self.storage != 'stats':
+                mongo.db.smrows.update_many(
+                    {'statement': statement['_id']},
+                    {'$set': {'category': category}}
+                )
+
+            self.update_pairs([x[0] for x in pairs], statement['category'])
+            self.update_pairs([x[0] for x in pairs], category)
+
+    def update_pairs(self, pairs, category):
+        """Recompute the category similarity of the given pairs, then their
+        overall similarity.
+        """
+        self.apply_changes(
+            [{'pairs': chunk, 'category': category}
+             for chunk in chunked(pairs, self.batch_size)])
+
+    def apply_changes(self, changes):
+        """Apply incremental changes to the current version. While another
+        worker rebuilds, they are logged for it to replay first. Changes
+        which raced the flip to a new version are applied to it again.
+        """
+        building = building_version()
+        if building is not None and building != self.building:
+            log_changes(building, changes)
+
+        version = self.version
+        for change in changes:
+            self.write_change(change)
+
+        self.sync_version()
+        if self.version != version:
+            self.apply_changes(changes)
+
+    def write_change(self, change):
+        """Write an incremental change, a set of pairs to recompute in a
+        category or an orphaned profile to remove. The running sums and
+        counts of the pairs are recounted from the reactions rather than
+        adjusted, so changes made at once by several workers, or applied
+        twice, cannot make them drift.
+        """
+        if 'orphan' in change:
+            return self.remove_orphan(change['orphan'])
+
+        if self.storage == 'stats':
+            self.recount_stats(change['pairs'], change['category'])
+        self.write_pairs(change['pairs'], change['category'])
+
+    def replay_changes(self, version):
+        """Apply the changes logged while a version was rebuilt, which the
+        rebuild may have missed, then discard them.
+        """
+        for change in logged_changes(version):
+            self.write_change(change)
+        discard_changes(version)
+
+    def write_pairs(self, pairs, category):
+        """Recompute the category similarity of the given pairs in the
+        current version, then set their overall similarity from their
+        category rows.
+        """
+        if self.layout == 'pairs':
+            return self.update_pair_documents(pairs, category)
+
+        cm_ops = []
+        for pair in pairs:
+            key = pair_key(*pair)
+
+            # Collect the sum and count of the pair's scores.
+            old = self.collection('cmrows').find_one(
+                {'key': key, 'category': category})
+            if self.storage == 'stats':
+                total = old['sum'] if old is not None else 0.0
+                count = old['count'] if old is not None else 0
+            else:
+                total, count = 0.0, 0
+                for entry in mongo.db.smrows.find(
+                        {'key': key, 'category': category}, {'distance': 1}):
+                    total += self.distance_score(1.0, entry['distance'])
+                    count += 1
+
+            # Replace the category row of the pair.
+            values = {'mean': total / count if count > 0 else 0.0}
+            if self.storage != 'stats':
+                values['count'] = count
+
+            if count == 0:
+                if old is not None:
+                    cm_ops.append(DeleteOne({'_id': old['_id']}))
+            else:
+                cm_ops.append(UpdateOne(
+                    {'key': key, 'category': category},
+                    {'$set': values, '$setOnInsert': {'pair': pair}},
+                    upsert=True))
+
+        if cm_ops != []:
+            self.collection('cmrows').bulk_write(cm_ops)
+
+        # The overall similarity is set from the category rows rather than
+        # adjusted by the change of one category, which the workers updating
+        # the same pair at once would each apply to the same old value.
+        om_ops = self.overall_updates(pairs)
+        if om_ops != []:
+            self.collection('omrows').bulk_write(om_ops)
+
+        self.update_topk(pairs)
+
+    def update_pair_documents(self, pairs, category):
+        """Recompute the category score of the given pairs in their pair
+        documents, along with their overall similarity.
+        """
+        weights = self.category_weights()
+        for pair in pairs:
+            self.update_pair_document(pair, category, weights)
+
+        self.update_topk(pairs)
+
+    def update_pair_document(self, pair, category, weights):
+        """Recompute the category score of a pair in its pair document, then
+        set its overall similarity from its scores. With the stats storage
+        the score was already set from the recounted sum and count.
+        """
+        if self.storage != 'stats':
+            total, count = 0.0, 0
+            for entry in mongo.db.smrows.find(
+                    {'key': pair_key(*pair), 'category': category},
+                    {'distance': 1}):
+                total += self.distance_score(1.0, entry['distance'])
+                count += 1
+
+            self.set_score(pair, category, {
+                'mean': total / count,
+                'count': count
+            } if count > 0 else None)
+
+        self.update_pair_similarity(pair_key(*pair), weights)
+
+    def set_score(self, pair, category, values):
+        """Set the score of a pair in a category in place in its pair
+        document, creating the document if needed. A score without values
+        is removed. Every change of the scores bumps the revision of the
+        document.
+        """
+        pmrows = self.collection('pmrows')
+        key = pair_key(*pair)
+        if values is None:
+            pmrows.update_one(
+                {'key': key, 'scores.category': category},
+                {
+                    '$pull': {'scores': {'category': category}},
+                    '$inc': {'rev': 1}
+                })
+            return
+
+        for attempt in range(SCORE_ATTEMPTS):
+            found = pmrows.update_one(
+                {'key': key, 'scores.category': category},
+                {
+                    '$set': dict(('scores.$.' + k, v)
+                                 for k, v in values.items()),
+                    '$inc': {'rev': 1}
+                })
+            if found.matched_count == 1:
+                return
+
+            try:
+                pmrows.update_one(
+                    {'key': key, 'scores.category': {'$ne': category}},
+                    {
+                        '$push': {'scores': dict(values, category=category)},
+                        '$inc': {'rev': 1},
+                        '$setOnInsert': {'pair': pair, 'similarity': 0.0}
+                    },
+                    upsert=True)
+                return
+            except DuplicateKeyError:
+                # Added by another worker meanwhile, set in place instead.
+                if attempt == SCORE_ATTEMPTS - 1:
+                    raise
+
+    def update_pair_similarity(self, key, weights):
+        """Set the overall similarity of a pair document from its scores.
+
+        The similarity is only written if the scores did not change since
+        they were read. If they did, the worker which changed them sets the
+        similarity after its own change, from scores read after this
+        worker's, so the update is not tried again.
+        """
+        pmrows = self.collection('pmrows')
+        doc = pmrows.find_one({'key': key}, {'scores': 1, 'rev': 1})
+        if doc is None:
+            return
+
+        scores = doc.get('scores', [])
+        values = {
+            'similarity': sum(weights.get(x['category'], 0.0) * x['mean']
+                              for x in scores)
+        }
+        if self.sparse:
+            values['shared'] = sum(x.get('count', 0) for x in scores)
+
+        pmrows.update_one(
+            {'_id': doc['_id'], 'rev': doc.get('rev')}, {'$set': values})
+
+    def overall_updates(self, pairs):
+        """Get the writes setting the overall similarity of the given pairs
+        from their category rows. A pair without category rows keeps an
+        overall row without similarity, in sparse mode the pairs which are
+        not kept are removed instead.
+        """
+        weights = self.category_weights()
+        keys = [pair_key(*pair) for pair in pairs]
+
+        sims, shared = {}, {}
+        for row in self.collection('cmrows').find(
+                {'key': {'$in': keys}},
+                {'key': 1, 'category': 1, 'mean': 1, 'count': 1}):
+            sims[row['key']] = sims.get(row['key'], 0.0) + \
+                weights.get(row['category'], 0.0) * row['mean']
+            shared[row['key']] = shared.get(row['key'], 0) + \
+                row.get('count', 0)
+
+        ops = []
+        for key, pair in zip(keys, pairs):
+            if not self.sparse:
+                ops.append(UpdateOne(
+                    {'key': key},
+                    {
+                        '$set': {'similarity': sims.get(key, 0.0)},
+                        '$setOnInsert': {'pair': pair}
+                    },
+                    upsert=True))
+            elif self.kept(sims.get(key, 0.0), shared.get(key, 0)):
+                ops.append(UpdateOne(
+                    {'key': key},
+                    {
+                        '$set': {
+                            'similarity': sims[key],
+                            'shared': shared[key]
+                        },
+                        '$setOnInsert': {'pair': pair}
+                    },
+                    upsert=True))
+            else:
+                ops.append(DeleteOne({'key': key}))
+
+        return ops
+
+    def kept(self, similarity, shared):
+        """Check whether a pair has an overall similarity in sparse mode."""
+        return shared >= self.min_shared and \
+            similarity >= self.min_similarity
+
+    def overall_query(self, profile=None):
+        """Query of the overall rows of a profile, or of all profiles. Pair
+        documents which are not kept in sparse mode are left out.
+        """
+        query = {} if profile is None else {'pair': profile}
+        if self.sparse and self.layout == 'pairs':
+            query['shared'] = {'$gte': self.min_shared}
+            query['similarity'] = {'$gte': self.min_similarity}
+        return query
+
+    def recount_stats(self, pairs, category):
+        """Set the running sums and counts of the given pairs in a category
+        from the reactions, read once for all of them.
+        """
+        values = {}
+        profiles = list(set(p for pair in pairs for p in pair))
+        for r in mongo.db.reactions.find(
+                {'profile': {'$in': profiles}},
+                {'profile': 1, 'statement': 1, 'reaction': 1}):
+            values.setdefault(r['profile'], {}).setdefault(
+                r['statement'], r['reaction'])
+
+        statements = set(s for x in values.values() for s in x)
+        found = mongo.db.statements.find(
+            {'_id': {'$in': list(statements)}, 'category': category},
+            {'_id': 1})
+        statements = set(s['_id'] for s in found)
+
+        for pair in pairs:
+            r0, r1 = values.get(pair[0], {}), values.get(pair[1], {})
+            shared = statements.intersection(r0).intersection(r1)
+            total = sum(self.distance_score(1.0, abs(r0[s] - r1[s]))
+                        for s in shared)
+            self.set_stats(pair, category, total, len(shared))
+
+    def set_stats(self, pair, category, total, count):
+        """Set the running sum and count of a pair in a category. A row is
+        only created when there are scores. Pair documents get the mean of
+        the score along with them.
+        """
+        if self.layout == 'pairs':
+            self.set_score(pair, category, {
+                'sum': total,
+                'count': count,
+                'mean': total / count
+            } if count > 0 else None)
+            return
+
+        self.collection('cmrows').update_one(
+            {'key': pair_key(*pair), 'category': category},
+            {
+                '$set': {'sum': total, 'count': count},
+                '$setOnInsert': {'pair': pair, 'mean': 0.0}
+            },
+            upsert=count > 0)
+
+    def statement_pairs(self, reactions):
+        """Get every pair of profiles among the given reactions to a single
+        statement along with their distance.
+        """
+        return [
+            ([r0['profile'], r1['profile']], abs(r0['reaction'] - r1['reaction']))
+            for r0, r1 in itertools.combinations(reactions, 2)
+        ]
+
+    def co_reactions(self, statement, profile):
+        """Get the other profiles that reacted to a statement along with their
+        reaction values.
+        """
+        if self.buckets and readable():
+            return [x for x in statement_reactors(statement) if x[0] != profile]
 
-        return r['profile']
+        found = mongo.db.reactions.find(
+            {'statement': statement, 'profile': {'$ne': profile}},
+            {'profile': 1, 'reaction': 1})
+        return [(r['profile'], r['reaction']) for r in found]
 
     def update_similarity(self, filter_by=None):
-        """Update category and overall similarity matrices."""
+        """Update category and overall similarity matrices. A full update is
+        rebuilt into a new version, the rows of a filter object are updated
+        in place.
+        """
+        if filter_by is None:
+            return self.rebuild_version(
+                self.rebuild_similarity, 'similarity',
+                carry=self.storage == 'stats')
+
+        with self.lock:
+            self.sync_version()
+            # Pairs which lose their overall row are looked up beforehand.
+            pairs = self.profile_pairs(filter_by)
+            self.rebuild_similarity(filter_by=filter_by)
+            pairs.update(self.profile_pairs(filter_by))
+            self.update_topk(list(pairs))
+
+    def recount_similarity(self):
+        """Rebuild the similarity into a new version from the reactions
+        alone, after reactions were removed behind the back of the backend.
+        The statement rows are generated again and the running sums and
+        counts are recounted rather than carried over.
+        """
+        self.rebuild_version(self.rebuild_from_reactions, 'similarity')
+
+    def rebuild_from_reactions(self):
+        """Rebuild category and overall similarity matrices, along with the
+        statement rows they are built from.
+        """
+        mongo.db.smrows.remove({})
+        self.rebuild_similarity()
+
+    def rebuild_version(self, rebuild, kind, carry=False, since=None):
+        """Run a full rebuild of the given kind under the rebuild lease, so
+        a single worker rebuilds at a time.
+
+        A worker asking for a rebuild while another one runs keeps serving
+        the current version and waits. It skips its own rebuild if one
+        which covers it completed meanwhile, that is a similarity rebuild or
+        one of the same kind, started after since, by default the time of
+        the request.
+        """
+        since = since or datetime.utcnow()
+        lease = Lease('rebuild', self.lease_seconds)
+        while not self.rebuilt_since(kind, since):
+            if not lease.acquire(kind=kind):
+                time.sleep(self.lease_seconds / 10.0)
+                continue
+
+            last = None
+            try:
+                # A rebuild may have completed just before the lease was
+                # taken.
+                if not self.rebuilt_since(kind, since):
+                    with self.lock:
+                        self.sync_version()
+                        version = self.build_version(
+                            rebuild, carry, lease)
+                    last = {
+                        'kind': kind,
+                        'started': lease.started,
+                        'finished': datetime.utcnow(),
+                        'version': version
+                    }
+            finally:
+                if last is not None:
+                    lease.release(last=last)
+                else:
+                    lease.release()
+
+            # With the lease lost, wait for the worker which took it over.
+            if not lease.lost:
+                break
+
+        self.sync_version()
+
+    def rebuilt_since(self, kind, since):
+        """Check whether a rebuild covering the given kind completed after
+        starting no earlier than since.
+        """
+        status = lease_status('rebuild')
+        last = status.get('last') if status is not None else None
+        return last is not None and last['started'] >= since and \
+            last['kind'] in (kind, 'similarity')
+
+    def rebuild_status(self):
+        """Get the state of the rebuild lease, shared by all workers, along
+        with the last completed rebuild. None if none ever ran.
+        """
+        status = lease_status('rebuild')
+        if status is None:
+            return None
+        return dict((k, v) for k, v in status.items() if k != '_id')
+
+    def build_version(self, rebuild, carry=False, lease=None):
+        """Run a full rebuild into a new version and flip to it once it is
+        complete, so readers never see a partial rebuild. With carry the
+        category rows of the current version are copied into the new one
+        first, for rebuilds that start from them. The version is dropped
+        instead if the lease it was rebuilt under was lost, as another
+        worker may be rebuilding meanwhile.
+
+        Returns the new version, None if a newer one was flipped to first
+        or the lease was lost.
+        """
+        version = allocate_version()
+        start_building(version)
+        self.building = version
+        try:
+            if carry:
+                rows = 'pmrows' if self.layout == 'pairs' else 'cmrows'
+                copy_version([rows], self.version, version)
+
+            rebuild()
+            self.build_topk()
+        except Exception:
+            drop_version(version)
+            discard_changes(version)
+            raise
+        finally:
+            self.building = None
+
+        if lease is not None and not lease.held():
+            drop_version(version)
+            discard_changes(version)
+            self.sync_version()
+            return None
+
+        if flip_version(version):
+            self.version = version
+            self.replay_changes(version)
+            collect_versions()
+            return version
+
+        # Another worker flipped to a newer version meanwhile.
+        drop_version(version)
+        discard_changes(version)
+        self.sync_version()
+        return None
+
+    def rebuild_similarity(self, filter_by=None):
+        """Rebuild category and overall similarity matrices."""
+        if self.storage == 'stats':
+            return self.update_stats_similarity(filter_by=filter_by)
+
         if mongo.db.smrows.count() == 0:
             self.build_statement_similarity()
             if mongo.db.smrows.count() == 0:
                 return
 
-        # Update category similarity.
-        rows = []
-        for c in mongo.db.categories.find():
-            # Get unique profiles to generate possible combinations.
-            profiles = set()
-            for sim in mongo.db.smrows.find({'category': c['_id']}):
-                [profiles.add(x) for x in sim['pair']]
-
-            # Iterate over all possible combinations.
-            for comb in itertools.combinations(profiles, 2):
-                # If filtering, check that the filter object is contained
-                # in the generatedd combination.
-                if filter_by is not None and filter_by not in comb:
+        if filter_by is None and self.rebuild == 'pipeline':
+            return self.update_pipeline_similarity()
+
+        categories = set(mongo.db.categories.distinct('_id'))
+        query = {} if filter_by is None else {'pair': filter_by}
+
+        # Update category similarity in a single pass over the statement rows
+        # sorted by pair, holding the scores of one pair at a time. The rows
+        # of a filter object are few enough to be sorted in memory.
+        found = mongo.db.smrows.find(
+            query, {'key': 1, 'pair': 1, 'category': 1, 'distance': 1})
+        if filter_by is None:
+            found = found.sort('key', 1)
+        else:
+            found = sorted(found, key=lambda entry: entry['key'])
+        rows = self.category_rows(found, categories)
+
+        if self.layout == 'pairs':
+            return self.write_rows(
+                self.collection('pmrows'), self.pair_documents(rows), (),
+                filter_by)
+
+        self.write_rows(
+            self.collection('cmrows'), rows, ('category',), filter_by)
+
+        # Update overall similarity.
+        self.update_overall(filter_by=filter_by)
+
+    def category_rows(self, found, categories):
+        """Generate the category rows of statement rows grouped by pair key.
+        Pairs without a shared statement in a category have no category
+        similarity.
+        """
+        for key, entries in itertools.groupby(found, key=lambda e: e['key']):
+            scores = {}
+            for entry in entries:
+                if entry['category'] not in categories:
                     continue
 
-                # Collect scores.
-                scores = []
-                for entry in mongo.db.smrows.find({'pair': {'$all':  list(comb)}}):
-                    scores.append(
-                        self.distance_score(c['weight'], entry['distance']))
-
-                # Finally add a new row with the mean of the collected scores.
-                rows.append({
-                    'pair': list(comb),
-                    'category': c['_id'],
-                    'score': np.mean(scores)
-                })
+                if entry['category'] not in scores:
+                    scores[entry['category']] = [entry['pair'], 0.0, 0]
+                score = scores[entry['category']]
+                score[1] += self.distance_score(1.0, entry['distance'])
+                score[2] += 1
+
+            for category, (pair, total, count) in scores.items():
+                yield {
+                    'key': key,
+                    'pair': pair,
+                    'category': category,
+                    'mean': total / count,
+                    'count': count
+                }
 
-        # If the pairs for just a single profile is being updated then remove
-        # all similarities for just that profile. Otherwise, remove all
-        # similarities and rebuild.
-        if filter_by is not None and mongo.db.cmrows.count() != 0:
-            mongo.db.cmrows.remove({'pair': filter_by})
+    def update_stats_similarity(self, filter_by=None):
+        """Update category and overall similarity matrices from the running
+        sums and counts of the category rows.
+        """
+        rows = self.collection(
+            'pmrows' if self.layout == 'pairs' else 'cmrows')
+        if rows.count() == 0:
+            self.build_statement_similarity()
+            if rows.count() == 0:
+                return
+
+        if filter_by is None and self.rebuild == 'pipeline':
+            return self.update_pipeline_similarity()
+
+        if self.layout == 'pairs':
+            return self.update_overall(filter_by=filter_by)
+
+        query = {} if filter_by is None else {'pair': filter_by}
+
+        # Update category similarity straight from the counters.
+        for row in self.collection('cmrows').find(query):
+            mean = row['sum'] / row['count'] if row['count'] > 0 else 0.0
+            if mean != row.get('mean'):
+                self.collection('cmrows').update_one(
+                    {'_id': row['_id']}, {'$set': {'mean': mean}})
+
+        # Update overall similarity.
+        self.update_overall(filter_by=filter_by)
+
+    def update_weights(self):
+        """Apply the current category weights to the overall similarity
+        matrix in a new version. Only the category rows are read.
+        """
+        self.rebuild_version(self.apply_weights, 'weights', carry=True)
+
+    def apply_weights(self):
+        """Recompute the overall similarity from the category rows."""
+        if self.rebuild == 'pipeline':
+            self.update_pipeline_overall()
         else:
-            mongo.db.cmrows.remove({})
+            self.update_overall()
 
-        if rows != []:
-            mongo.db.cmrows.insert_many(rows)
+    def update_pipeline_similarity(self):
+        """Rebuild category and overall similarity matrices with aggregation
+        pipelines, without any per pair query.
+        """
+        if self.layout == 'pairs':
+            return self.update_pipeline_pairs()
+
+        # Update category similarity.
+        if self.storage == 'stats':
+            self.collection('cmrows').aggregate([
+                {'$project': {
+                    'key': 1,
+                    'pair': 1,
+                    'category': 1,
+                    'sum': 1,
+                    'count': 1,
+                    'mean': {'$cond': [
+                        {'$gt': ['$count', 0]},
+                        {'$divide': ['$sum', '$count']},
+                        0.0
+                    ]}
+                }},
+                {'$out': self.collection('cmrows').name}
+            ], allowDiskUse=True)
+        else:
+            mongo.db.smrows.aggregate([
+                {'$group': {
+                    '_id': {'key': '$key', 'category': '$category'},
+                    'pair': {'$first': '$pair'},
+                    'mean': {'$avg': {
+                        '$divide': [1, {'$add': [1, '$distance']}]
+                    }},
+                    'count': {'$sum': 1}
+                }},
+                {'$project': {
+                    '_id': 0,
+                    'key': '$_id.key',
+                    'pair': 1,
+                    'category': '$_id.category',
+                    'mean': 1,
+                    'count': 1
+                }},
+                {'$out': self.collection('cmrows').name}
+            ], allowDiskUse=True)
 
         # Update overall similarity.
-        # Get unique profiles from category similarity matrix to generate
-        # possible combinations for the overall similarity matrix.
-        rows = []
-        profiles = set()
-        for sim in mongo.db.cmrows.find():
-            [profiles.add(x) for x in sim['pair']]
-
-        # Iterate over all possible combinations.
-        for comb in itertools.combinations(profiles, 2):
-            # If filtering, check that the filter object is contained
-            # in the generatedd combination.
-            if filter_by is not None and filter_by not in comb:
-                continue
+        self.update_pipeline_overall()
 
-            # Collect category similarities.
-            sims = []
-            for entry in mongo.db.cmrows.find({'pair': {'$all':  list(comb)}}):
-                sims.append(entry['score'])
+    def update_pipeline_pairs(self):
+        """Rebuild the pair documents with aggregation pipelines."""
+        if self.storage == 'stats':
+            self.collection('pmrows').aggregate([
+                {'$project': {
+                    'key': 1,
+                    'pair': 1,
+                    'similarity': 1,
+                    'scores': {'$map': {
+                        'input': '$scores',
+                        'as': 's',
+                        'in': {
+                            'category': '$$s.category',
+                            'sum': '$$s.sum',
+                            'count': '$$s.count',
+                            'mean': {'$cond': [
+                                {'$gt': ['$$s.count', 0]},
+                                {'$divide': ['$$s.sum', '$$s.count']},
+                                0.0
+                            ]}
+                        }
+                    }}
+                }},
+                {'$out': self.collection('pmrows').name}
+            ], allowDiskUse=True)
+            return self.update_pipeline_overall()
 
-            rows.append({
-                'pair': list(comb),
-                'similarity': np.sum(sims)
+        weight = self.weight_expression('$_id.category')
+        mongo.db.smrows.aggregate([
+            {'$group': {
+                '_id': {'key': '$key', 'category': '$category'},
+                'pair': {'$first': '$pair'},
+                'mean': {'$avg': {
+                    '$divide': [1, {'$add': [1, '$distance']}]
+                }},
+                'count': {'$sum': 1}
+            }},
+            {'$group': {
+                '_id': '$_id.key',
+                'pair': {'$first': '$pair'},
+                'scores': {'$push': {
+                    'category': '$_id.category',
+                    'mean': '$mean',
+                    'count': '$count'
+                }},
+                'similarity': {'$sum': {'$multiply': [weight, '$mean']}},
+                'shared': {'$sum': '$count'}
+            }},
+            {'$project': {
+                '_id': 0,
+                'key': '$_id',
+                'pair': 1,
+                'scores': 1,
+                'similarity': 1,
+                'shared': 1
+            }},
+            {'$out': self.collection('pmrows').name}
+        ], allowDiskUse=True)
+
+    def update_pipeline_overall(self):
+        """Rebuild the overall similarity matrix as the weighted sum of the
+        category similarities with an aggregation pipeline.
+        """
+        if self.layout == 'pairs':
+            weight = self.weight_expression('$$s.category')
+            self.collection('pmrows').aggregate([
+                {'$project': {
+                    'key': 1,
+                    'pair': 1,
+                    'scores': 1,
+                    'similarity': {'$sum': {'$map': {
+                        'input': '$scores',
+                        'as': 's',
+                        'in': {'$multiply': [weight, '$$s.mean']}
+                    }}},
+                    'shared': {'$sum': '$scores.count'}
+                }},
+                {'$out': self.collection('pmrows').name}
+            ], allowDiskUse=True)
+            return
+
+        weight = self.weight_expression('$category')
+        pipeline = [
+            {'$group': {
+                '_id': '$key',
+                'pair': {'$first': '$pair'},
+                'similarity': {'$sum': {'$multiply': [weight, '$mean']}},
+                'shared': {'$sum': '$count'}
+            }},
+            {'$project': {
+                '_id': 0,
+                'key': '$_id',
+                'pair': 1,
+                'similarity': 1,
+                'shared': 1
+            }}
+        ]
+        if self.sparse:
+            pipeline.append({'$match': {
+                'shared': {'$gte': self.min_shared},
+                'similarity': {'$gte': self.min_similarity}
+            }})
+        pipeline.append({'$out': self.collection('omrows').name})
+
+        self.collection('cmrows').aggregate(pipeline, allowDiskUse=True)
+
+    def weight_expression(self, field):
+        """Aggregation expression of the weight of the category in the given
+        field.
+        """
+        branches = []
+        for c in mongo.db.categories.find():
+            branches.append({
+                'case': {'$eq': [field, c['_id']]},
+                'then': c['weight']
             })
 
-        # If the pairs for just a single profile is being updated then remove
-        # all similarities for just that profile. Otherwise, remove all
-        # similarities and rebuild.
-        if filter_by is not None and mongo.db.omrows.count() != 0:
-            mongo.db.omrows.remove({'pair': filter_by})
+        if branches == []:
+            return 0.0
+        return {'$switch': {'branches': branches, 'default': 0.0}}
+
+    def category_weights(self):
+        """Map every category _id to its weight."""
+        weights = {}
+        for c in mongo.db.categories.find():
+            weights[c['_id']] = c['weight']
+        return weights
+
+    def update_overall(self, filter_by=None):
+        """Update the overall similarity matrix as the weighted sum of the
+        category similarities, in a single pass over the category rows.
+        """
+        if self.layout == 'pairs':
+            return self.update_pair_overall(filter_by=filter_by)
+
+        weights = self.category_weights()
+        omrows = self.collection('omrows')
+
+        query = {} if filter_by is None else {'pair': filter_by}
+        found = self.collection('cmrows').find(
+            query, {'key': 1, 'pair': 1, 'category': 1, 'mean': 1, 'count': 1})
+
+        # The category rows are read sorted by pair, one pair at a time.
+        if filter_by is None:
+            found = found.sort('key', 1)
         else:
-            mongo.db.omrows.remove({})
+            found = sorted(found, key=lambda row: row['key'])
+
+        # In sparse mode only the pairs with category rows are considered.
+        if self.sparse:
+            return self.write_rows(
+                omrows, self.overall_rows(found, weights), (), filter_by)
+
+        if filter_by is not None:
+            sims = dict((row['key'], row)
+                        for row in self.overall_rows(found, weights))
+            rows = ({
+                'key': pair_key(*comb),
+                'pair': list(comb),
+                'similarity': sims.get(pair_key(*comb), {}).get(
+                    'similarity', 0.0)
+            } for comb in self.profile_combinations(filter_by))
+            return self.write_rows(omrows, rows, (), filter_by)
+
+        # The pairs with category rows are written first, then a row without
+        # similarity is added for every other pair of profiles with category
+        # rows, so no more than a chunk of rows is held at a time.
+        omrows.remove({})
+        self.write_derived(omrows, self.overall_rows(found, weights))
+        self.write_derived(omrows, (UpdateOne(
+            {'key': pair_key(*comb)},
+            {'$setOnInsert': {'pair': list(comb), 'similarity': 0.0}},
+            upsert=True) for comb in self.profile_combinations()))
 
+    def profile_combinations(self, profile=None):
+        """Generate every pair of profiles with category rows, or only the
+        pairs of the given profile.
+        """
+        profiles = self.collection('cmrows').distinct('pair')
+        for comb in itertools.combinations(profiles, 2):
+            if profile is None or profile in comb:
+                yield comb
+
+    def overall_rows(self, found, weights):
+        """Generate the overall rows of category rows grouped by pair key. In
+        sparse mode only the pairs which are kept are generated, along with
+        their number of shared statements.
+        """
+        for key, group in itertools.groupby(found, key=lambda row: row['key']):
+            similarity, shared = 0.0, 0
+            for row in group:
+                similarity += weights.get(row['category'], 0.0) * row['mean']
+                shared += row.get('count', 0)
+
+            if not self.sparse:
+                yield {
+                    'key': key,
+                    'pair': row['pair'],
+                    'similarity': similarity
+                }
+            elif self.kept(similarity, shared):
+                yield {
+                    'key': key,
+                    'pair': row['pair'],
+                    'similarity': similarity,
+                    'shared': shared
+                }
+
+    def update_pair_overall(self, filter_by=None):
+        """Recompute the category means and the overall similarity of every
+        pair document on its own.
+        """
+        weights = self.category_weights()
+        query = {} if filter_by is None else {'pair': filter_by}
+
+        def updates(found):
+            for doc in found:
+                scores = doc.get('scores', [])
+                if self.storage == 'stats':
+                    for score in scores:
+                        score['mean'] = score['sum'] / score['count'] \
+                            if score['count'] > 0 else 0.0
+
+                values = {
+                    'scores': scores,
+                    'similarity': sum(
+                        weights.get(x['category'], 0.0) * x['mean']
+                        for x in scores)
+                }
+                if self.sparse:
+                    values['shared'] = sum(x.get('count', 0) for x in scores)
+                yield UpdateOne(
+                    {'_id': doc['_id']}, {'$set': values, '$inc': {'rev': 1}})
+
+        pmrows = self.collection('pmrows')
+        self.write_derived(
+            pmrows, updates(pmrows.find(query, {'scores': 1, 'similarity': 1})))
+
+    def pair_documents(self, rows):
+        """Generate the pair documents of category rows grouped by pair key,
+        with their overall similarity.
+        """
+        weights = self.category_weights()
+
+        for key, group in itertools.groupby(rows, key=lambda row: row['key']):
+            doc = {'key': key, 'scores': [], 'similarity': 0.0}
+            for row in group:
+                doc['pair'] = row['pair']
+
+                score = dict((k, v) for k, v in row.items()
+                             if k not in ('key', 'pair'))
+                doc['scores'].append(score)
+                doc['similarity'] += weights.get(row['category'], 0.0) * \
+                    row.get('mean', 0.0)
+                if self.sparse:
+                    doc['shared'] = doc.get('shared', 0) + row.get('count', 0)
+
+            yield doc
+
+    def write_rows(self, collection, rows, fields, filter_by=None):
+        """Write the rebuilt rows of a similarity collection. A full rebuild
+        replaces the collection, inserting the generated rows in chunks of
+        batch_size. When filtering, the rows of the filter object are upserted
+        and its rows missing from the rebuild are removed.
+        """
+        if filter_by is None or collection.count() == 0:
+            collection.remove({})
+            self.write_derived(collection, rows)
+            return
+
+        rows = list(rows)
         if rows != []:
-            mongo.db.omrows.insert_many(rows)
+            collection.bulk_write(upserts(rows, fields))
+
+        keep = [dict((f, row[f]) for f in ('key',) + fields) for row in rows]
+        stale = {'pair': filter_by}
+        if keep != []:
+            stale['$nor'] = keep
+        collection.remove(stale)
+
+    def write_derived(self, collection, rows):
+        """Write generated rows, or bulk write operations, of a derived
+        collection in chunks of batch_size, with unordered bulk writes using
+        the relaxed write concern of the derived collections.
+        """
+        with DerivedWriter(collection, w=self.write_concern,
+                           workers=self.write_workers) as write:
+            write_chunks(rows, self.batch_size, write, collection.name)
 
     def build_statement_similarity(self):
         """Build the statement similarity matrix."""
+        if self.storage == 'stats':
+            return self.build_category_stats()
+
         if mongo.db.smrows.count() > 0:
             return
 
-        dst = self.distinct_reaction_statements()
+        # Stream the reactions once and generate the rows of every statement
+        # from memory.
+        categories = statement_categories()
+        rows = (row for s, reactions in statement_reactions()
+                for row in self.pair_rows(s, categories.get(s), reactions))
 
-        if len(dst) == 0:
+        mongo.db.smrows.remove({})
+        self.write_derived(mongo.db.smrows, rows)
+
+    def build_category_stats(self):
+        """Build the running sums and counts of the category rows from the
+        statement rows, without storing the statement rows themselves. With
+        the 'pairs' layout the category rows are only used to build the pair
+        documents.
+        """
+        if self.layout == 'pairs':
+            if self.collection('pmrows').find_one(
+                    {'scores.sum': {'$exists': True}}) is not None:
+                return
+        elif self.collection('cmrows').find_one(
+                {'sum': {'$exists': True},
+                 'mean': {'$exists': True}}) is not None:
             return
 
-        rows = []
-        for s in dst:
-            rows = rows + self.statement_rows(s)
+        # Counters of up to batch_size pairs and categories are held at a
+        # time, then added to the category rows. The additions are written
+        # one chunk at a time, two chunks in flight could both insert the row
+        # of a pair.
+        categories = statement_categories()
 
+        def increments():
+            stats = {}
+            for s, reactions in statement_reactions():
+                category = categories.get(s)
+                for p0, p1, distance in reaction_pairs(reactions):
+                    key = pair_key(p0, p1)
+                    if (key, category) not in stats:
+                        stats[key, category] = [[p0, p1], 0.0, 0]
+                    counters = stats[key, category]
+                    counters[1] += self.distance_score(1.0, distance)
+                    counters[2] += 1
+
+                    if len(stats) >= self.batch_size:
+                        for op in self.stats_increments(stats):
+                            yield op
+                        stats = {}
+
+            for op in self.stats_increments(stats):
+                yield op
+
+        # Rows of the 'rows' storage are of no use here.
         mongo.db.smrows.remove({})
-        if rows != []:
-            mongo.db.smrows.insert_many(rows)
+        cmrows = self.collection('cmrows')
+        cmrows.remove({})
+        with DerivedWriter(cmrows, w=self.write_concern) as write:
+            write_chunks(increments(), self.batch_size, write, cmrows.name)
+
+        # The pair documents are generated from the category rows sorted by
+        # pair, which are then dropped.
+        if self.layout == 'pairs':
+            rows = (dict(row, mean=row['sum'] / row['count'])
+                    for row in cmrows.find({}, {'_id': 0}).sort('key', 1))
+            self.write_rows(
+                self.collection('pmrows'), self.pair_documents(rows), ())
+            cmrows.remove({})
+
+    def stats_increments(self, stats):
+        """Get the writes adding counters, keyed by pair key and category, to
+        the running sums and counts of the category rows. Rows are created
+        with a mean of zero, set when the similarity is updated from the
+        counters.
+        """
+        return [UpdateOne(
+            {'key': key, 'category': category},
+            {
+                '$inc': {'sum': total, 'count': count},
+                '$setOnInsert': {'pair': pair, 'mean': 0.0}
+            },
+            upsert=True)
+            for (key, category), (pair, total, count) in stats.items()]
+
+    def build_topk(self):
+        """Rebuild the best matches of every profile in a single pass over
+        the overall similarity.
+        """
+        if not self.topk:
+            return
+
+        rows = ((x['pair'], x['similarity'])
+                for x in self.collection(self.overall).find(
+                    self.overall_query(), {'pair': 1, 'similarity': 1}))
+        docs = ({
+            '_id': profile,
+            'matches': [{'profile': p, 'similarity': s} for p, s in matches]
+        } for profile, matches in best_matches(rows, self.topk).items())
+
+        self.collection('topk').remove({})
+        self.write_derived(self.collection('topk'), docs)
+
+    def update_topk(self, pairs):
+        """Update the best matches of the profiles of the given pairs with
+        their new overall similarity. Lists that lost an entry to a match
+        outside of them are backfilled from the overall similarity.
+        """
+        if not self.topk or pairs == []:
+            return
+
+        changes = {}
+        for p0, p1 in pairs:
+            changes.setdefault(p0, {})[p1] = None
+            changes.setdefault(p1, {})[p0] = None
+        query = self.overall_query()
+        query['key'] = {'$in': [pair_key(*x) for x in pairs]}
+        for row in self.collection(self.overall).find(
+                query, {'pair': 1, 'similarity': 1}):
+            p0, p1 = row['pair']
+            changes[p0][p1] = changes[p1][p0] = row['similarity']
+
+        tops = {}
+        for top in self.collection('topk').find(
+                {'_id': {'$in': list(changes)}}):
+            tops[top['_id']] = [(m['profile'], m['similarity'])
+                                for m in top['matches']]
+
+        ops = []
+        for profile, changed in changes.items():
+            matches = merge_matches(
+                tops.get(profile, []), changed, self.topk)
+            if matches is None:
+                matches = self.profile_topk(profile)
+
+            ops.append(UpdateOne(
+                {'_id': profile},
+                {'$set': {'matches': [{'profile': p, 'similarity': s}
+                                      for p, s in matches]}},
+                upsert=True))
+
+        self.collection('topk').bulk_write(ops)
+
+    def profile_pairs(self, profile):
+        """Get the pairs of a profile which have an overall row, as a set of
+        (profile, profile) tuples. Only read when best matches are kept.
+        """
+        if not self.topk:
+            return set()
+
+        found = self.collection(self.overall).find(
+            {'pair': profile}, {'pair': 1})
+        return set(tuple(x['pair']) for x in found)
+
+    def profile_topk(self, profile):
+        """Read the best matches of a profile from the overall similarity."""
+        found = self.collection(self.overall).find(
+            self.overall_query(profile), {'pair': 1, 'similarity': 1}
+        ).sort('similarity', DESCENDING).limit(self.topk)
+
+        return [([p for p in x['pair'] if p != profile][0], x['similarity'])
+                for x in found]
 
     def purge_similarity(self):
         """Purge all similarity matrices."""
-        # Statement similarity.
-        mongo.db.smrows.remove({})
+        with self.lock:
+            self.sync_version()
+            # Statement similarity.
+            mongo.db.smrows.remove({})
 
-        # Category similarity.
-        mongo.db.cmrows.remove({})
+            # Category similarity.
+            self.collection('cmrows').remove({})
 
-        # Overall similarity.
-        mongo.db.omrows.remove({})
+            # Overall similarity.
+            self.collection('omrows').remove({})
+
+            # Pair documents.
+            self.collection('pmrows').remove({})
+
+            # Best matches.
+            self.collection('topk').remove({})
 
     def clear_orphans(self, profile):
         """Remove orphaned similarities from all matrices."""
+        with self.lock:
+            self.sync_version()
+            self.apply_changes([{'orphan': profile}])
+
+    def remove_orphan(self, profile):
+        """Remove the similarities of a profile from the current version."""
         # Statement similarity.
         mongo.db.smrows.remove({'pair': profile})
 
         # Category similarity.
-        mongo.db.cmrows.remove({'pair': profile})
+        self.collection('cmrows').remove({'pair': profile})
 
         # Overall similarity.
-        mongo.db.omrows.remove({'pair': profile})
+        self.collection('omrows').remove({'pair': profile})
+
+        # Pair documents.
+        self.collection('pmrows').remove({'pair': profile})
+
+        # Best matches, backfilling the lists the profile was part of.
+        self.collection('topk').remove({'_id': profile})
+        if self.topk:
+            ops = []
+            for top in self.collection('topk').find(
+                    {'matches.profile': profile}, {'_id': 1}):
+                matches = self.profile_topk(top['_id'])
+                ops.append(UpdateOne(
+                    {'_id': top['_id']},
+                    {'$set': {'matches': [{'profile': p, 'similarity': s}
+                                          for p, s in matches]}}))
+            if ops != []:
+                self.collection('topk').bulk_write(ops)
 
     def profiles(self):
         """Get all profiles in the datastore and return them as a list."""
@@ -175,30 +1388,32 @@ class MongoRecommenderSystem(object):
         return [str(x) for x in mongo.db.statements.distinct("_id")]
 
     def statement_rows(self, statement, filter_by=None):
-        rows = []
-        cnt = mongo.db.reactions.find({'statement': statement}).count()
-        if cnt == 1:
-            return []
-
-        cid = mongo.db.statements.find_one({'_id': statement})['category']
-        profiles = mongo.db.reactions.find(
-            {'statement': statement}).distinct('profile')
-        for comb in itertools.combinations(profiles, 2):
-            if filter_by is not None and filter_by not in comb:
-                continue
+        """Generate the statement similarity rows of a single statement with
+        one query for its reactions and one for its category.
+        """
+        s = mongo.db.statements.find_one({'_id': statement}, {'category': 1})
+        if self.buckets and readable():
+            reactions = statement_reactors(statement)
+        else:
+            reactions = unique_reactions(mongo.db.reactions.find(
+                {'statement': statement}, {'profile': 1, 'reaction': 1}))
 
-            r0 = mongo.db.reactions.find_one(
-                {'statement': statement, 'profile': comb[0]})['reaction']
-            r1 = mongo.db.reactions.find_one(
-                {'statement': statement, 'profile': comb[1]})['reaction']
-            rows.append({
-                'pair': list(comb),
-                'statement': statement,
-                'category': cid,
-                'distance': abs(r0 - r1)
-            })
+        return self.pair_rows(
+            statement, s.get('category') if s is not None else None,
+            reactions, filter_by=filter_by)
 
-        return rows
+    def pair_rows(self, statement, category, reactions, filter_by=None):
+        """Generate statement similarity rows from the (profile, reaction)
+        tuples of a statement.
+        """
+        return [{
+            'key': pair_key(p0, p1),
+            'pair': [p0, p1],
+            'statement': statement,
+            'category': category,
+            'distance': distance
+        } for p0, p1, distance in reaction_pairs(
+            reactions, filter_by=filter_by)]
 
     def distinct_reaction_statements(self):
         """Get distinct statements from the reactions collection."""
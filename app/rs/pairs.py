@@ -0,0 +1,120 @@
+"""Canonical keys of the profile pairs in the similarity collections."""
+
+
+__all__ = ['migrate_pairs', 'pair_key', 'unkeyed_pairs', 'upserts']
+
+
+from bson import (
+    Binary, ObjectId,
+)
+from pymongo import UpdateOne
+
+
+from app import mongo
+from app.rs.versions import (
+    VERSIONED, current_version, versioned_name,
+)
+
+
+# Fields which, together with the pair key, identify a row of a collection.
+PAIR_FIELDS = {
+    'smrows': ('statement',),
+    'cmrows': ('category',),
+    'omrows': (),
+}
+
+
+def pair_key(p0, p1):
+    """Get the canonical key of an unordered pair of profiles, the binary
+    concatenation of their sorted ObjectIds.
+    """
+    lo, hi = sorted([ObjectId(p0), ObjectId(p1)])
+    return Binary(lo.binary + hi.binary)
+
+
+def upserts(rows, fields):
+    """Turn rows into upserts matching on their pair key and the given fields.
+    The pair list is only written when a row is inserted.
+    """
+    ops = []
+    for row in rows:
+        query = {'key': row['key']}
+        values = {}
+        for field, value in row.items():
+            if field in fields:
+                query[field] = value
+            elif field not in ('key', 'pair'):
+                values[field] = value
+
+        update = {'$setOnInsert': {'pair': row['pair']}}
+        if values != {}:
+            update['$set'] = values
+        ops.append(UpdateOne(query, update, upsert=True))
+
+    return ops
+
+
+def pair_collections():
+    """Get the current version of every similarity collection, by name."""
+    version = current_version()
+
+    collections = {}
+    for collection in PAIR_FIELDS:
+        if collection in VERSIONED:
+            collections[collection] = \
+                mongo.db[versioned_name(collection, version)]
+        else:
+            collections[collection] = mongo.db[collection]
+
+    return collections
+
+
+def unkeyed_pairs():
+    """Get the names of the similarity collections holding rows without a
+    pair key, left by a database written before the keys were added.
+    """
+    return sorted(
+        collection for collection, rows in pair_collections().items()
+        if rows.find_one({'key': {'$exists': False}}, {'_id': 1}) is not None)
+
+
+def migrate_pairs():
+    """Add the pair key to the similarity rows missing one and remove the
+    rows duplicating a key, in the current version of the versioned
+    collections.
+
+    Returns a report as a list of (collection, keyed, removed) tuples, one
+    per similarity collection.
+    """
+    collections = pair_collections()
+
+    report = []
+    for collection, fields in sorted(PAIR_FIELDS.items()):
+        rows = collections[collection]
+
+        ops = []
+        for row in rows.find({'key': {'$exists': False}}, {'pair': 1}):
+            ops.append(UpdateOne(
+                {'_id': row['_id']}, {'$set': {'key': pair_key(*row['pair'])}}))
+        if ops != []:
+            rows.bulk_write(ops)
+
+        group = {'key': '$key'}
+        for field in fields:
+            group[field] = '${0}'.format(field)
+
+        removed = 0
+        for dup in rows.aggregate([
+            {'$group': {
+                '_id': group,
+                'ids': {'$push': '$_id'},
+                'count': {'$sum': 1}
+            }},
+            {'$match': {'count': {'$gt': 1}}}
+        ], allowDiskUse=True):
+            removed += rows.delete_many(
+                {'_id': {'$in': dup['ids'][1:]}}).deleted_count
+
+        report.append((collection, len(ops), removed))
+
+    return report
@@ -0,0 +1,65 @@
+"""Bulk reads of the reactions collection shared by the recommender backends."""
+
+
+from app import mongo
+
+
+import itertools
+
+
+def statement_categories():
+    """Map every statement _id to its category _id."""
+    categories = {}
+    for s in mongo.db.statements.find({}, {'category': 1}):
+        categories[s['_id']] = s.get('category')
+    return categories
+
+
+def statement_reactions(query=None):
+    """Stream the reactions collection once, sorted by statement.
+
+    Yields a (statement, reactions) tuple per statement, where reactions is
+    a list of (profile, reaction) tuples. Only the first reaction of a
+    profile to a statement is kept.
+    """
+    found = mongo.db.reactions.find(
+        query or {},
+        {'_id': 0, 'statement': 1, 'profile': 1, 'reaction': 1}
+    ).sort('statement', 1)
+
+    for statement, group in itertools.groupby(
+            found, key=lambda r: r['statement']):
+        yield statement, unique_reactions(group)
+
+
+def unique_reactions(found):
+    """Collect (profile, reaction) tuples, keeping the first reaction of every
+    profile.
+    """
+    seen = set()
+    reactions = []
+    for r in found:
+        if r['profile'] not in seen:
+            seen.add(r['profile'])
+            reactions.append((r['profile'], r['reaction']))
+    return reactions
+
+
+def reaction_pairs(reactions, filter_by=None):
+    """Yield every pair among the reactions to a single statement as a
+    (profile, profile, distance) tuple. If filtering, only the pairs
+    containing the filter object are generated, with the filter object
+    first.
+    """
+    if filter_by is None:
+        for (p0, r0), (p1, r1) in itertools.combinations(reactions, 2):
+            yield p0, p1, abs(r0 - r1)
+        return
+
+    values = dict(reactions)
+    if filter_by not in values:
+        return
+
+    for p, r in reactions:
+        if p != filter_by:
+            yield filter_by, p, abs(values[filter_by] - r)
@@ -0,0 +1,143 @@
+"""Snapshots of the similarity state of the in-memory backends.
+
+A snapshot is an uncompressed npz file holding the arrays a backend returns
+from snapshot(), which use interned indices in place of ObjectIds, along
+with the ObjectIds of every interned index, the backend it was taken of and
+the mark of the inputs it reflects. Restoring it hands the arrays back to
+the backend's restore(), so the similarity is not recomputed.
+
+A snapshot is only restored on boot if the mark did not move past it, that
+is if no reaction, statement category or category weight changed since it
+was taken.
+"""
+
+
+__all__ = ['restore_on_boot', 'restore_snapshot', 'take_snapshot']
+
+
+from datetime import datetime
+import logging
+import os
+
+
+from bson import ObjectId
+import numpy as np
+
+
+from app.rs.interning import registry
+from app.rs.marks import current_mark
+
+
+logger = logging.getLogger(__name__)
+
+
+# Format of the creation time of a snapshot.
+CREATED = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def take_snapshot(rs, path):
+    """Load the data of a backend and write its similarity state to the
+    snapshot at path, replacing any snapshot there atomically.
+
+    Returns the backend, mark and creation time of the snapshot. Raises
+    ValueError if the backend does not support snapshots.
+    """
+    if getattr(rs, 'snapshot', None) is None:
+        raise ValueError('{0} does not support snapshots'.format(
+            type(rs).__name__))
+
+    # Taken before the data is loaded, so a change meanwhile makes the
+    # snapshot look older than it is, never newer.
+    mark = current_mark()
+    arrays = dict(rs.snapshot())
+
+    ids = registry()
+    for kind in ids.KINDS:
+        arrays['{0}_ids'.format(kind)] = np.array([
+            np.frombuffer(oid.binary if oid is not None else bytes(12),
+                          dtype=np.uint8)
+            for oid in (ids.object_id(kind, j) for j in range(ids.size(kind)))
+        ], dtype=np.uint8).reshape(-1, 12)
+
+    info = {
+        'backend': type(rs).__name__,
+        'mark': mark,
+        'created': datetime.utcnow()
+    }
+    arrays['backend'] = np.array(info['backend'])
+    arrays['mark'] = np.array(mark, dtype=np.int64)
+    arrays['created'] = np.array(info['created'].strftime(CREATED))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    return info
+
+
+def restore_snapshot(rs, path, force=False):
+    """Restore the similarity state of a backend from the snapshot at path.
+    Unless forced, a snapshot older than the mark is refused.
+
+    Returns the backend, mark and creation time of the snapshot. Raises
+    ValueError if the snapshot cannot be restored into the backend.
+    """
+    if getattr(rs, 'restore', None) is None:
+        raise ValueError('{0} does not support snapshots'.format(
+            type(rs).__name__))
+
+    with np.load(path, allow_pickle=False) as found:
+        arrays = dict((name, found[name]) for name in found.files)
+
+    info = {
+        'backend': str(arrays.pop('backend')),
+        'mark': int(arrays.pop('mark')),
+        'created': datetime.strptime(str(arrays.pop('created')), CREATED)
+    }
+    if info['backend'] != type(rs).__name__:
+        raise ValueError('snapshot of {0}, not {1}'.format(
+            info['backend'], type(rs).__name__))
+
+    mark = current_mark()
+    if not force and info['mark'] < mark:
+        raise ValueError('snapshot at mark {0} is older than mark {1}'.format(
+            info['mark'], mark))
+
+    # The arrays are addressed by interned indices, which must still map to
+    # the same ObjectIds.
+    ids = registry()
+    for kind in ids.KINDS:
+        for j, raw in enumerate(arrays.pop('{0}_ids'.format(kind))):
+            if raw.any() and ids.index(kind, ObjectId(raw.tobytes())) != j:
+                raise ValueError(
+                    'snapshot {0} indices do not match the registry'.format(
+                        kind))
+
+    rs.restore(arrays)
+    return info
+
+
+def restore_on_boot(rs, path):
+    """Restore the snapshot at path if it is usable, logging why not.
+
+    Returns True if it was restored.
+    """
+    try:
+        info = restore_snapshot(rs, path)
+    except (OSError, ValueError) as e:
+        logger.info('Snapshot {0} not restored: {1}'.format(path, e))
+        return False
+
+    logger.info('Restored snapshot {0} at mark {1}, taken {2}'.format(
+        path, info['mark'], info['created']))
+    return True
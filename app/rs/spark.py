@@ -2,14 +2,40 @@
 
 
 from app import mongo
+from app.rs.chunks import write_chunks
+from app.rs.interning import registry
+from app.rs.scan import (
+    reaction_pairs, statement_categories, statement_reactions,
+    unique_reactions,
+)
+from app.rs.snapshots import restore_on_boot
+from app.rs.topk import merge_matches
 
 
+import heapq
 import itertools
+import threading
 import numpy as np
 
 
 class SparkRecommenderSystem(object):
-    """Spark based recommender system."""
+    """Spark based recommender system.
+
+    Category similarity rows hold the unweighted mean of the statement
+    scores, the category weights are applied in the overall similarity.
+
+    With topk set the best matches of every profile are kept on the driver,
+    updated along with the overall similarity.
+
+    In sparse mode only pairs which share a category and reach
+    min_similarity have an overall similarity row.
+
+    Rows hold the interned indices of profiles, statements and categories
+    instead of their ObjectIds, which keeps them small to pickle and shuffle.
+
+    With a snapshot, warm_up parallelizes the rows of the snapshot instead
+    of loading the data if the snapshot is still current.
+    """
 
     # SparkContext.
     spark_context = None
@@ -23,25 +49,148 @@ class SparkRecommenderSystem(object):
     # Overall Similarity Matrix.
     osm = None
 
-    def __init__(self, spark_context):
+    def __init__(self, spark_context, topk=0, sparse=False,
+                 min_similarity=0.0, batch_size=1000, snapshot=None):
         """"""
 
         # Initialize SparkContext.
         self.spark_context = spark_context
 
-    def get_matches(self, pid):
+        # Interned indices of profiles, statements and categories.
+        self.ids = registry()
+
+        # Number of best matches kept per profile, keyed by profile.
+        self.topk = topk
+        self.top = {}
+
+        # Only store pairs with overlap reaching the minimum similarity.
+        self.sparse = sparse
+        self.min_similarity = min_similarity
+
+        # Number of full rebuilds of the similarity, served as its version.
+        self.version = 0
+
+        # Whether the data was loaded by warm_up.
+        self.ready = False
+
+        # Number of rows parallelized at once by load_data and restore.
+        self.batch_size = max(1, int(batch_size))
+
+        # Snapshot restored by warm_up, None to always load the data.
+        self.snapshot_path = snapshot
+
+        # Held while the matrices are replaced as a whole, by warm_up,
+        # snapshot and restore.
+        self.lock = threading.RLock()
+
+    def get_matches(self, pid, sort_sim=None, limit=None):
         """Get and return all matches for the given profile."""
-        if self.osm is None:
+        pid = self.ids.index('profile', pid)
+        if pid is None:
             return []
 
-        m_rows = self.osm.filter(lambda row: pid in row[0])
-        matches = []
-        for row in m_rows.collect():
-            matches.append(
-                (list(set(list(row[0])) - set([pid]))[0], row[1]))
-
-        m_rows.unpersist()
-        return sorted(matches, key=lambda x: x[1], reverse=True)
+        if self.topk and sort_sim == -1 and limit is not None and \
+                limit <= self.topk:
+            matches = self.top.get(pid, [])[:limit]
+        elif self.osm is None:
+            return []
+        else:
+            m_rows = self.osm.filter(lambda row: pid in row[0])
+            matches = []
+            for row in m_rows.collect():
+                matches.append(
+                    (list(set(list(row[0])) - set([pid]))[0], row[1]))
+
+            m_rows.unpersist()
+            matches = sorted(
+                matches, key=lambda x: x[1], reverse=sort_sim != 1)
+            if limit is not None:
+                matches = matches[:limit]
+
+        return [(self.ids.object_id('profile', p), s) for p, s in matches]
+
+    def warm_up(self):
+        """Restore the snapshot if it is still current, otherwise load the
+        data, then mark the backend as ready.
+        """
+        with self.lock:
+            if self.snapshot_path is None or \
+                    not restore_on_boot(self, self.snapshot_path):
+                self.load_data()
+        self.ready = True
+
+    def snapshot(self):
+        """Load the data and return the rows of every matrix as arrays.
+        Statement rows without a category hold category -1.
+        """
+        with self.lock:
+            self.load_data()
+            ssm = self.ssm.collect()
+            csm = self.csm.collect()
+            osm = self.osm.collect()
+
+        return {
+            'ssm_pairs': np.array([r[0] for r in ssm],
+                                  dtype=np.int32).reshape(-1, 2),
+            'ssm_statements': np.array([r[1] for r in ssm], dtype=np.int32),
+            'ssm_categories': np.array(
+                [-1 if r[2] is None else r[2] for r in ssm], dtype=np.int32),
+            'ssm_distances': np.array([r[3] for r in ssm], dtype=np.float64),
+            'csm_pairs': np.array([r[0] for r in csm],
+                                  dtype=np.int32).reshape(-1, 2),
+            'csm_categories': np.array([r[1] for r in csm], dtype=np.int32),
+            'csm_scores': np.array([r[2] for r in csm], dtype=np.float64),
+            'osm_pairs': np.array([r[0] for r in osm],
+                                  dtype=np.int32).reshape(-1, 2),
+            'osm_sims': np.array([r[1] for r in osm], dtype=np.float64),
+        }
+
+    def restore(self, arrays):
+        """Replace the matrices by the rows of a snapshot, then rebuild the
+        best matches.
+        """
+        ssm = zip(map(tuple, arrays['ssm_pairs'].tolist()),
+                  arrays['ssm_statements'].tolist(),
+                  (None if c < 0 else c
+                   for c in arrays['ssm_categories'].tolist()),
+                  arrays['ssm_distances'].tolist())
+        csm = zip(map(tuple, arrays['csm_pairs'].tolist()),
+                  arrays['csm_categories'].tolist(),
+                  arrays['csm_scores'].tolist())
+        osm = zip(map(tuple, arrays['osm_pairs'].tolist()),
+                  arrays['osm_sims'].tolist())
+
+        with self.lock:
+            self.purge_similarity()
+            self.ssm = self.parallelize_rows(ssm, 'ssm')
+            self.csm = self.parallelize_rows(csm, 'csm')
+            self.osm = self.parallelize_rows(osm, 'osm')
+            self.version += 1
+            self.build_topk()
+
+    def parallelize_rows(self, rows, label):
+        """Ship generated rows to the cluster in chunks of batch_size rows,
+        so the driver only holds one chunk of rows at a time, and return
+        their union coalesced into as many partitions as the default
+        parallelism of the context.
+        """
+        chunks = []
+        write_chunks(
+            rows, self.batch_size,
+            lambda chunk: chunks.append(self.spark_context.parallelize(chunk)),
+            label)
+        if chunks == []:
+            return self.spark_context.parallelize([])
+        return self.spark_context.union(chunks).coalesce(
+            self.spark_context.defaultParallelism)
+
+    def similarity_version(self):
+        """Get the version of the similarity served by get_matches."""
+        return self.version
+
+    def rebuild_status(self):
+        """Rebuilds are local to every worker, there is no shared status."""
+        return None
 
     def distance_score(self, weight, distance):
         """Calculate the Euclidean distance score between two users based on
@@ -49,39 +198,186 @@ class SparkRecommenderSystem(object):
         return weight / (1 + distance)
 
     def load_data(self):
-        dst = self.distinct_reaction_statements()
-        rows = []
-        for s in dst:
-            rows = rows + self.statement_rows(s)
-
-        self.ssm = self.spark_context.parallelize(rows)
+        """Build the statement similarity matrix from a single scan of the
+        reactions collection, then the category and overall matrices.
+        """
+        categories = statement_categories()
+        rows = (row for s, reactions in statement_reactions()
+                for row in self.pair_rows(s, categories.get(s), reactions))
+        self.ssm = self.parallelize_rows(rows, 'ssm')
         self.update_similarity()
 
     def add_reaction(self, rid):
         """Add a new reaction to the statement similarity matrix.
         Rows are only added if two or more users have reacted to the statment.
+        Only the pairs formed with the other profiles that reacted to the
+        statement are updated, and only in the statement's category.
         """
         reaction = mongo.db.reactions
         r = reaction.find_one({"_id": rid})
+        if self.ssm is None:
+            return r['profile']
+
         rows = self.statement_rows(r['statement'], filter_by=r['profile'])
         temp = self.spark_context.parallelize(rows)
         self.ssm = self.ssm.union(temp)
 
         temp.unpersist()
+
+        if rows != []:
+            self.update_pairs([row[0] for row in rows], rows[0][2])
+
         return r['profile']
 
+    def change_reaction(self, reaction, value):
+        """Update the statement similarity matrix after the value of a
+        reaction changed. Only the pairs formed with the other profiles that
+        reacted to the statement are updated, and only in the statement's
+        category.
+        """
+        if self.ssm is None:
+            return
+
+        rows = self.statement_rows(
+            reaction['statement'], filter_by=reaction['profile'])
+        profile = self.ids.intern('profile', reaction['profile'])
+        statement = self.ids.intern('statement', reaction['statement'])
+        temp = self.spark_context.parallelize(rows)
+        self.ssm = self.ssm.filter(
+            lambda row: row[1] != statement or profile not in row[0]
+        ).union(temp)
+
+        temp.unpersist()
+
+        if rows != []:
+            self.update_pairs([row[0] for row in rows], rows[0][2])
+
+    def remove_reaction(self, reaction):
+        """Update the statement similarity matrix after a reaction was
+        removed. Only the pairs formed with the other profiles that reacted to
+        the statement are updated, and only in the statement's category.
+        """
+        if self.ssm is None:
+            return
+
+        profile = self.ids.intern('profile', reaction['profile'])
+        statement = self.ids.intern('statement', reaction['statement'])
+        rows = self.ssm.filter(
+            lambda row: row[1] == statement and profile in row[0]).collect()
+        self.ssm = self.ssm.filter(
+            lambda row: row[1] != statement or profile not in row[0])
+
+        if rows != []:
+            self.update_pairs([row[0] for row in rows], rows[0][2])
+
+    def remove_statement(self, statement, reactions):
+        """Update the similarities after a statement and its reactions were
+        removed. Only the pairs which co-reacted to the statement are updated,
+        and only in the statement's category.
+        """
+        if self.ssm is None:
+            return
+
+        sid = self.ids.intern('statement', statement['_id'])
+        pairs = self.ssm.filter(
+            lambda row: row[1] == sid).map(lambda row: row[0]).collect()
+        self.ssm = self.ssm.filter(lambda row: row[1] != sid)
+
+        if pairs != []:
+            self.update_pairs(
+                pairs, self.category_index(statement['category']))
+
+    def move_statement(self, statement, category):
+        """Update the similarities after a statement was moved to another
+        category. Only the pairs which co-reacted to the statement are
+        updated, in the old and the new category.
+        """
+        if self.ssm is None or statement['category'] == category:
+            return
+
+        sid = self.ids.intern('statement', statement['_id'])
+        old = self.category_index(statement['category'])
+        new = self.category_index(category)
+        pairs = self.ssm.filter(
+            lambda row: row[1] == sid).map(lambda row: row[0]).collect()
+        self.ssm = self.ssm.map(
+            lambda row: (row[0], row[1], new, row[3])
+            if row[1] == sid else row)
+
+        if pairs != []:
+            self.update_pairs(pairs, old)
+            self.update_pairs(pairs, new)
+
+    def update_pairs(self, pairs, category):
+        """Recompute the category similarity of the given pairs in a single
+        category, then their overall similarity.
+        """
+        if self.ssm is None:
+            return
+
+        keys = set(frozenset(pair) for pair in pairs)
+        weights = self.category_weights()
+
+        # Category similarity.
+        rows = self.ssm.filter(
+            lambda row: row[2] == category and frozenset(row[0]) in keys
+        ).map(
+            lambda row: (frozenset(row[0]), (1.0 / (1 + row[3]), 1))
+        ).reduceByKey(
+            lambda a, b: (a[0] + b[0], a[1] + b[1])
+        ).map(
+            lambda kv: (tuple(kv[0]), category, kv[1][0] / kv[1][1])
+        ).collect()
+
+        temp = self.spark_context.parallelize(rows)
+        if self.csm is not None:
+            self.csm = self.csm.filter(
+                lambda row: row[1] != category or frozenset(row[0]) not in keys
+            ).union(temp)
+        else:
+            self.csm = temp
+
+        # Overall similarity.
+        rows = self.csm.filter(
+            lambda row: frozenset(row[0]) in keys
+        ).map(
+            lambda row: (frozenset(row[0]), weights.get(row[1], 0.0) * row[2])
+        ).reduceByKey(
+            lambda a, b: a + b
+        ).map(
+            lambda kv: (tuple(kv[0]), kv[1])
+        ).collect()
+        if self.sparse:
+            rows = [x for x in rows if x[1] >= self.min_similarity]
+        else:
+            # A pair which lost its last category row keeps an overall row
+            # without similarity, rather than its stale one.
+            found = set(frozenset(x[0]) for x in rows)
+            rows.extend((tuple(pair), 0.0) for pair in pairs
+                        if frozenset(pair) not in found)
+
+        temp = self.spark_context.parallelize(rows)
+        if self.osm is not None:
+            self.osm = self.osm.filter(
+                lambda row: frozenset(row[0]) not in keys).union(temp)
+        else:
+            self.osm = temp
+
+        self.update_topk(pairs, rows)
+
     def update_similarity(self, filter_by=None):
         """Update category and overall similarity matrices."""
 
         if self.ssm is None:
             return
 
-        category = mongo.db.categories
+        if filter_by is not None:
+            filter_by = self.ids.intern('profile', filter_by)
 
         # Category similarity.
         rows = []
-        for c in category.find():
-            c_rows = self.ssm.filter(lambda row: row[2] == c['_id'])
+        for cid in self.category_weights():
+            c_rows = self.ssm.filter(lambda row, cid=cid: row[2] == cid)
             profiles = set()
             for row in c_rows.collect():
                 [profiles.add(x) for x in row[0]]
@@ -94,11 +390,16 @@ class SparkRecommenderSystem(object):
                     lambda p_row, comb=comb: comb[0] in p_row[0] and comb[1] in p_row[0])
                 scores = []
                 for entry in p_rows.collect():
-                    scores.append(self.distance_score(c['weight'], entry[3]))
-                rows.append((comb, c['_id'], np.mean(scores)))
-
+                    scores.append(self.distance_score(1.0, entry[3]))
                 p_rows.unpersist()
 
+                # Pairs without a shared statement in this category have no
+                # category similarity.
+                if scores == []:
+                    continue
+
+                rows.append((comb, cid, np.mean(scores)))
+
             c_rows.unpersist()
 
         # Check this out in the future if any bottlenecks are noticed.
@@ -112,23 +413,39 @@ class SparkRecommenderSystem(object):
             self.csm = self.spark_context.parallelize(rows)
 
         # Overall similarity.
-        rows = []
-        profiles = set()
-        for row in self.csm.collect():
-            [profiles.add(x) for x in row[0]]
+        weights = self.category_weights()
+        if self.sparse:
+            min_similarity = self.min_similarity
+            rows = self.csm.filter(
+                lambda row: filter_by is None or filter_by in row[0]
+            ).map(
+                lambda row: (frozenset(row[0]),
+                             weights.get(row[1], 0.0) * row[2])
+            ).reduceByKey(
+                lambda a, b: a + b
+            ).filter(
+                lambda kv: kv[1] >= min_similarity
+            ).map(
+                lambda kv: (tuple(kv[0]), kv[1])
+            ).collect()
+        else:
+            rows = []
+            profiles = set()
+            for row in self.csm.collect():
+                [profiles.add(x) for x in row[0]]
 
-        for comb in itertools.combinations(profiles, 2):
-            if filter_by is not None and filter_by not in comb:
-                continue
+            for comb in itertools.combinations(profiles, 2):
+                if filter_by is not None and filter_by not in comb:
+                    continue
 
-            p_rows = self.csm.filter(
-                lambda p_row, comb=comb: comb[0] in p_row[0] and comb[1] in p_row[0])
-            sims = []
-            for entry in p_rows.collect():
-                sims.append(entry[2])
+                p_rows = self.csm.filter(
+                    lambda p_row, comb=comb: comb[0] in p_row[0] and comb[1] in p_row[0])
+                sims = []
+                for entry in p_rows.collect():
+                    sims.append(weights.get(entry[1], 0.0) * entry[2])
 
-            rows.append((comb, np.sum(sims)))
-            p_rows.unpersist()
+                rows.append((comb, np.sum(sims)))
+                p_rows.unpersist()
 
         # Check this out in the future if any bottlenecks are noticed.
         # May need to manually unpersist the replaced RDD.
@@ -139,6 +456,106 @@ class SparkRecommenderSystem(object):
             temp.unpersist()
         else:
             self.osm = self.spark_context.parallelize(rows)
+            self.version += 1
+
+        self.build_topk()
+
+    def update_weights(self):
+        """Apply the current category weights to the overall similarity
+        matrix. Only the category similarity matrix is read.
+        """
+        if self.csm is None or self.osm is None:
+            return
+
+        weights = self.category_weights()
+        sums = self.csm.map(
+            lambda row: (frozenset(row[0]), weights.get(row[1], 0.0) * row[2])
+        ).reduceByKey(
+            lambda a, b: a + b
+        )
+
+        if self.sparse:
+            # Pairs may enter or leave the sparse matrix with the weights.
+            min_similarity = self.min_similarity
+            temp = sums.filter(
+                lambda kv: kv[1] >= min_similarity
+            ).map(
+                lambda kv: (tuple(kv[0]), kv[1])
+            )
+        else:
+            temp = self.osm.map(
+                lambda row: (frozenset(row[0]), row[0])
+            ).leftOuterJoin(
+                sums
+            ).map(
+                lambda kv: (kv[1][0], kv[1][1] or 0.0)
+            )
+        self.osm.unpersist()
+        self.osm = temp
+        self.version += 1
+
+        self.build_topk()
+
+    def build_topk(self):
+        """Rebuild the best matches of every profile from the overall
+        similarity matrix.
+        """
+        self.top = {}
+        if not self.topk or self.osm is None:
+            return
+
+        k = self.topk
+        self.top = self.osm.flatMap(
+            lambda row: [(row[0][0], (row[0][1], row[1])),
+                         (row[0][1], (row[0][0], row[1]))]
+        ).groupByKey().mapValues(
+            lambda ms: heapq.nlargest(k, ms, key=lambda m: m[1])
+        ).collectAsMap()
+
+    def update_topk(self, pairs, rows):
+        """Update the best matches of the profiles of the given pairs with
+        their new overall similarity rows. Lists that lost an entry to a
+        match outside of them are backfilled from the overall matrix.
+        """
+        if not self.topk:
+            return
+
+        changes = {}
+        for p0, p1 in pairs:
+            changes.setdefault(p0, {})[p1] = None
+            changes.setdefault(p1, {})[p0] = None
+        for (p0, p1), similarity in rows:
+            changes[p0][p1] = changes[p1][p0] = similarity
+
+        for profile, changed in changes.items():
+            matches = merge_matches(
+                self.top.get(profile, []), changed, self.topk)
+            if matches is None:
+                matches = self.profile_topk(profile)
+            self.top[profile] = matches
+
+    def profile_topk(self, profile):
+        """Get the best matches of a profile from the overall matrix."""
+        if self.osm is None:
+            return []
+
+        return self.osm.filter(
+            lambda row, profile=profile: profile in row[0]
+        ).map(
+            lambda row, profile=profile: (
+                row[0][1] if row[0][0] == profile else row[0][0], row[1])
+        ).top(self.topk, key=lambda m: m[1])
+
+    def category_weights(self):
+        """Get the weight of every category keyed by its index."""
+        weights = {}
+        for c in mongo.db.categories.find():
+            weights[self.ids.intern('category', c['_id'])] = c['weight']
+        return weights
+
+    def category_index(self, cid):
+        """Get the index of a category, None for no category."""
+        return self.ids.intern('category', cid) if cid is not None else None
 
     def purge_similarity(self):
         """Purge all similarity matrices."""
@@ -158,20 +575,35 @@ class SparkRecommenderSystem(object):
             self.osm.unpersist()
             self.osm = None
 
+        # Best matches.
+        self.top = {}
+
     def clear_orphans(self, profile):
         """Remove orphaned similarities from all matrices."""
+        profile = self.ids.index('profile', profile)
+        if profile is None:
+            return
 
         # Statement similarity.
-        self.ssm = self.ssm.filter(
-            lambda row, profile=profile: profile not in row[0])
+        if self.ssm is not None:
+            self.ssm = self.ssm.filter(
+                lambda row, profile=profile: profile not in row[0])
 
         # Category similarity.
-        self.csm = self.csm.filter(
-            lambda row, profile=profile: profile not in row[0])
+        if self.csm is not None:
+            self.csm = self.csm.filter(
+                lambda row, profile=profile: profile not in row[0])
 
         # Overall similarity.
-        self.osm = self.osm.filter(
-            lambda row, profile=profile: profile not in row[0])
+        if self.osm is not None:
+            self.osm = self.osm.filter(
+                lambda row, profile=profile: profile not in row[0])
+
+        # Best matches, backfilling the lists the profile was part of.
+        self.top.pop(profile, None)
+        for other, matches in list(self.top.items()):
+            if profile in [m[0] for m in matches]:
+                self.top[other] = self.profile_topk(other)
 
     def profiles(self):
         """Get all profiles in the datastore and return them as a list."""
@@ -184,25 +616,31 @@ class SparkRecommenderSystem(object):
         return [str(x) for x in statement.distinct("_id")]
 
     def statement_rows(self, statement, filter_by=None):
-        reaction = mongo.db.reactions
-        rows = []
-        cnt = reaction.find({"statement": statement}).count()
-        if cnt == 1:
-            return []
-
-        cid = mongo.db.statements.find_one({"_id": statement})['category']
-        profiles = reaction.find({"statement": statement}).distinct("profile")
-        for c in itertools.combinations(profiles, 2):
-            if filter_by is not None and filter_by not in c:
-                continue
+        """Generate the statement similarity rows of a single statement with
+        one query for its reactions and one for its category.
+        """
+        s = mongo.db.statements.find_one({"_id": statement}, {"category": 1})
+        reactions = unique_reactions(mongo.db.reactions.find(
+            {"statement": statement}, {"profile": 1, "reaction": 1}))
 
-            r0 = reaction.find_one(
-                {"statement": statement, "profile": c[0]})['reaction']
-            r1 = reaction.find_one(
-                {"statement": statement, "profile": c[1]})['reaction']
-            rows.append((c, statement, cid, abs(r0 - r1)))
+        return self.pair_rows(
+            statement, s.get('category') if s is not None else None,
+            reactions, filter_by=filter_by)
 
-        return rows
+    def pair_rows(self, statement, category, reactions, filter_by=None):
+        """Generate statement similarity rows from the (profile, reaction)
+        tuples of a statement, holding interned indices.
+        """
+        statement = self.ids.intern('statement', statement)
+        category = self.category_index(category)
+        profiles = self.ids.intern_many('profile', [p for p, _ in reactions])
+        reactions = [(i, r) for i, (_, r) in zip(profiles, reactions)]
+        if filter_by is not None:
+            filter_by = self.ids.intern('profile', filter_by)
+
+        return [((p0, p1), statement, category, distance)
+                for p0, p1, distance in reaction_pairs(
+                    reactions, filter_by=filter_by)]
 
     def distinct_reaction_statements(self):
         """Get distinct statements from the reactions collection."""
@@ -0,0 +1,189 @@
+"""Similarity store in a memory-mapped file shared by the workers.
+
+The overall similarity is written by one builder as CSR neighbor arrays,
+the non-zero similarities of every profile row, along with the ObjectId of
+every row and the active profile flags. Every worker maps the file
+read-only, so the pages are shared by all of them and memory use does not
+grow with the number of workers.
+
+A new store is written to a temporary file next to the store and renamed
+over it, so a reader maps either the old or the new file as a whole. Readers
+notice the rename on their next read and map the new file, mappings of the
+old one stay valid until they are dropped. A read resolves everything
+against a single mapping, so a remap in another thread never mixes the rows
+of two stores.
+"""
+
+
+__all__ = ['SimilarityStore', 'write_store']
+
+
+import os
+import threading
+
+
+from bson import ObjectId
+import numpy as np
+
+
+# Arrays of a store, in file order.
+ARRAYS = ('version', 'ids', 'active', 'indptr', 'indices', 'data')
+
+
+def write_store(path, version, ids, active, osm):
+    """Write an overall similarity matrix to the store at path, replacing
+    the current store atomically.
+
+    ids are the ObjectIds of the matrix rows, None for unallocated rows, and
+    active flags the profiles which have matches.
+    """
+    n = osm.shape[0]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indices, data = [], []
+    for i in range(n):
+        j = np.flatnonzero(osm[i])
+        indices.append(j.astype(np.int32))
+        data.append(osm[i, j].astype(np.float32))
+        indptr[i + 1] = indptr[i] + j.size
+
+    arrays = {
+        'version': np.array([version], dtype=np.int64),
+        'ids': np.array([
+            np.frombuffer(oid.binary if oid is not None else bytes(12),
+                          dtype=np.uint8) for oid in ids
+        ], dtype=np.uint8).reshape(n, 12),
+        'active': np.asarray(active, dtype=bool),
+        'indptr': indptr,
+        'indices': np.concatenate(indices or [np.zeros(0, np.int32)]),
+        'data': np.concatenate(data or [np.zeros(0, np.float32)]),
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            for name in ARRAYS:
+                np.lib.format.write_array(f, arrays[name])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class SimilarityStore(object):
+    """Read-only mapping of the store at path, remapped when the store is
+    replaced.
+    """
+
+    def __init__(self, path):
+        """"""
+        self.path = path
+        self.key = None
+        self.arrays = None
+        self.rows = None
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        """Map the store if it was replaced since it was last mapped.
+
+        Returns False if there is no store.
+        """
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return self.arrays is not None
+
+            if (stat.st_dev, stat.st_ino, stat.st_mtime_ns) != self.key:
+                self.open()
+            return True
+
+    def mapping(self):
+        """Get the arrays of the store and the row of every profile ObjectId,
+        both of the same mapping, remapping the store first if it was
+        replaced. Returns None if there is no store.
+        """
+        with self.lock:
+            if not self.refresh():
+                return None
+
+            # Built on the first lookup after every remap.
+            if self.rows is None:
+                ids = self.arrays['ids']
+                self.rows = dict((ObjectId(ids[i].tobytes()), i)
+                                 for i in range(ids.shape[0]) if ids[i].any())
+            return self.arrays, self.rows
+
+    def open(self):
+        """Map every array of the store."""
+        arrays = {}
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            for name in ARRAYS:
+                major, _ = np.lib.format.read_magic(f)
+                if major == 1:
+                    header = np.lib.format.read_array_header_1_0(f)
+                else:
+                    header = np.lib.format.read_array_header_2_0(f)
+                shape, _, dtype = header
+
+                offset = f.tell()
+                if int(np.prod(shape)) == 0:
+                    arrays[name] = np.zeros(shape, dtype=dtype)
+                else:
+                    arrays[name] = np.memmap(f, dtype=dtype, mode='r',
+                                             offset=offset, shape=shape)
+                f.seek(offset + arrays[name].nbytes)
+
+        self.arrays = arrays
+        self.rows = None
+        self.key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+
+    def version(self):
+        """Get the version of the mapped store, 0 if there is none."""
+        if not self.refresh():
+            return 0
+        return int(self.arrays['version'][0])
+
+    def row(self, oid):
+        """Get the row of a profile ObjectId, None if it has none."""
+        mapping = self.mapping()
+        if mapping is None:
+            return None
+        return mapping[1].get(oid)
+
+    def matches(self, oid, sort_sim=None, limit=None):
+        """Get the matches of a profile ObjectId, as the backends do."""
+        mapping = self.mapping()
+        if mapping is None:
+            return []
+
+        arrays, rows = mapping
+        i = rows.get(oid)
+        active = arrays['active']
+        if i is None or i >= active.size or not active[i]:
+            return []
+
+        start, stop = arrays['indptr'][i], arrays['indptr'][i + 1]
+        row = np.zeros(active.size)
+        row[arrays['indices'][start:stop]] = arrays['data'][start:stop]
+
+        flags = np.array(active)
+        flags[i] = False
+        candidates = np.flatnonzero(flags)
+        sims = row[candidates]
+        if sort_sim is not None:
+            order = np.argsort(sims * sort_sim, kind='mergesort')
+            candidates = candidates[order]
+            sims = sims[order]
+
+        if limit is not None:
+            candidates, sims = candidates[:limit], sims[:limit]
+
+        ids = arrays['ids']
+        return [(ObjectId(ids[j].tobytes()), float(s))
+                for j, s in zip(candidates, sims)]
@@ -0,0 +1,52 @@
+"""Per profile lists of the best matches, kept by the recommender backends."""
+
+
+__all__ = ['best_matches', 'merge_matches']
+
+
+import heapq
+
+
+def best_matches(rows, k):
+    """Collect the k best matches of every profile in a single pass over
+    (pair, similarity) rows, with a bounded heap per profile.
+
+    Returns a dict mapping every profile to its list of (profile, similarity)
+    tuples, best first.
+    """
+    heaps = {}
+    for (p0, p1), similarity in rows:
+        for profile, partner in ((p0, p1), (p1, p0)):
+            heap = heaps.setdefault(profile, [])
+            if len(heap) < k:
+                heapq.heappush(heap, (similarity, partner))
+            elif similarity > heap[0][0]:
+                heapq.heapreplace(heap, (similarity, partner))
+
+    return dict(
+        (profile, [(partner, s) for s, partner in sorted(heap, reverse=True)])
+        for profile, heap in heaps.items())
+
+
+def merge_matches(matches, changes, k):
+    """Apply changed similarities to the list of best matches of a profile.
+
+    matches is the current list of (profile, similarity) tuples, best first,
+    and changes maps partners to their new similarity, None if the pair was
+    removed. Returns the new list, or None if matches outside of the list
+    may have moved into it and it has to be backfilled from the source.
+    """
+    full = len(matches) >= k
+    threshold = matches[-1][1] if matches != [] else None
+
+    merged = [m for m in matches if m[0] not in changes]
+    merged.extend((p, s) for p, s in changes.items() if s is not None)
+    merged.sort(key=lambda m: m[1], reverse=True)
+
+    # A list which was not full held every match of the profile. A full one
+    # stays valid as long as its k-th entry is not below the old threshold,
+    # since every match outside of it was at most the threshold.
+    if full and (len(merged) < k or merged[k - 1][1] < threshold):
+        return None
+
+    return merged[:k]
@@ -0,0 +1,182 @@
+"""Versions of the similarity collections.
+
+Full rebuilds write into a new set of collections, named after the version
+they belong to, and then flip the current version pointer with a single
+document update. Readers resolve the collections of the current version, so
+they keep seeing the previous similarity until the rebuild is complete.
+Version 0 uses the plain collection names.
+
+While a version is being built, the pointer names it as building and the
+incremental changes applied to the current version meanwhile are logged in
+the changes collection, so the rebuild can replay the ones it missed once
+it flipped to its version.
+"""
+
+
+__all__ = [
+    'VERSIONED', 'allocate_version', 'building_version', 'collect_versions',
+    'copy_version', 'current_version', 'discard_changes', 'drop_version',
+    'flip_version', 'log_changes', 'logged_changes', 'start_building',
+    'versioned_name',
+]
+
+
+from pymongo import ReturnDocument
+
+
+from app import mongo
+
+
+# Collections which are rebuilt as a whole and versioned.
+VERSIONED = ('cmrows', 'omrows', 'pmrows', 'topk')
+
+# _id of the current version pointer in the versions collection.
+POINTER = 'similarity'
+
+
+def versioned_name(name, version):
+    """Get the name of a collection in a version."""
+    if version == 0:
+        return name
+    return '{0}_{1}'.format(name, version)
+
+
+def current_version():
+    """Get the current version, 0 if none was flipped yet."""
+    pointer = mongo.db.versions.find_one({'_id': POINTER})
+    return pointer['current'] if pointer is not None else 0
+
+
+def building_version():
+    """Get the version being built, None if no rebuild is running."""
+    pointer = mongo.db.versions.find_one({'_id': POINTER})
+    return pointer.get('building') if pointer is not None else None
+
+
+def start_building(version):
+    """Name a version as the one being built, until it is flipped to or
+    dropped.
+    """
+    mongo.db.versions.update_one(
+        {'_id': POINTER},
+        {
+            '$set': {'building': version},
+            '$setOnInsert': {'current': 0, 'previous': None}
+        },
+        upsert=True)
+
+
+def log_changes(version, changes):
+    """Log incremental changes for the rebuild of a version to replay."""
+    if changes != []:
+        mongo.db.changes.insert_many(
+            [dict(change, version=version) for change in changes])
+
+
+def logged_changes(version):
+    """Get the changes logged for the rebuild of a version, in the order
+    they were logged.
+    """
+    for change in mongo.db.changes.find(
+            {'version': version}, {'_id': 0, 'version': 0}).sort('_id', 1):
+        yield change
+
+
+def discard_changes(version):
+    """Remove the changes logged for the rebuild of a version, and for any
+    older rebuild which did not complete.
+    """
+    mongo.db.changes.delete_many({'version': {'$lte': version}})
+
+
+def allocate_version():
+    """Allocate a new version number, never used by any worker before, and
+    create the indexed, empty collections of the version.
+    """
+    counter = mongo.db.counters.find_one_and_update(
+        {'_id': 'versions.{0}'.format(POINTER)},
+        {'$inc': {'next': 1}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    version = max(counter['next'], current_version() + 1)
+
+    # Imported here, the index specification resolves the current version.
+    from app.rs.indexes import INDEXES
+
+    drop_version(version)
+    for name in VERSIONED:
+        collection = mongo.db[versioned_name(name, version)]
+        for keys, options in INDEXES.get(name, []):
+            collection.create_index(keys, **options)
+
+    return version
+
+
+def copy_version(names, source, target):
+    """Copy collections of one version into another on the server."""
+    for name in names:
+        mongo.db[versioned_name(name, source)].aggregate([
+            {'$match': {}},
+            {'$out': versioned_name(name, target)}
+        ], allowDiskUse=True)
+
+
+def flip_version(version):
+    """Make a version the current one, keeping the replaced version as the
+    previous one. Versions older than the current one are never flipped to.
+
+    Returns True if the version became the current one.
+    """
+    mongo.db.versions.update_one(
+        {'_id': POINTER},
+        {'$setOnInsert': {'current': 0, 'previous': None}},
+        upsert=True)
+
+    old = mongo.db.versions.find_one_and_update(
+        {'_id': POINTER, 'current': {'$lt': version}},
+        {'$set': {'current': version}, '$unset': {'building': ''}})
+    if old is None:
+        return False
+
+    mongo.db.versions.update_one(
+        {'_id': POINTER, 'current': version},
+        {'$set': {'previous': old['current']}})
+    return True
+
+
+def drop_version(version):
+    """Drop the collections of a version, which is no longer being built."""
+    mongo.db.versions.update_one(
+        {'_id': POINTER, 'building': version}, {'$unset': {'building': ''}})
+    for name in VERSIONED:
+        mongo.db[versioned_name(name, version)].drop()
+
+
+def collect_versions():
+    """Drop the collections of the versions older than the current one,
+    except the previous version, which readers that resolved it just before
+    a flip may still be using. Newer versions may still be building and are
+    left alone.
+
+    Returns the list of versions dropped.
+    """
+    pointer = mongo.db.versions.find_one({'_id': POINTER})
+    if pointer is None:
+        return []
+    keep = (pointer['current'], pointer.get('previous'))
+
+    names = set(mongo.db.collection_names())
+    versions = set()
+    for name in names:
+        base, _, suffix = name.rpartition('_')
+        if base in VERSIONED and suffix.isdigit():
+            versions.add(int(suffix))
+    if any(name in names for name in VERSIONED):
+        versions.add(0)
+
+    dropped = []
+    for version in sorted(versions):
+        if version < pointer['current'] and version not in keep:
+            drop_version(version)
+            dropped.append(version)
+
+    return dropped
@@ -1,12 +1,29 @@
 """Flask-Script commands."""
 
 
+import os
+
+
 from flask_migrate import (
     init, migrate, upgrade,
 )
-from flask_script import Command
+from flask import current_app
+from flask_script import (
+    Command, Option, Server,
+)
 
 
+from app import warm_up_rs
+from app.rs.buckets import (
+    build_buckets, enabled as buckets_enabled,
+)
+from app.rs.indexes import (
+    ensure_indexes, remove_duplicate_reactions,
+)
+from app.rs.pairs import migrate_pairs
+from app.rs.snapshots import (
+    restore_snapshot, take_snapshot,
+)
 from app.utils.models import (
     Role, User,
 )
@@ -21,6 +38,15 @@ class InitDbCommand(Command):
         upgrade()
 
 
+class BuildBucketsCommand(Command):
+    """Rebuild the statement and profile reaction buckets."""
+
+    def run(self):
+        statements, profiles = build_buckets()
+        print('{0} statement buckets, {1} profile buckets'.format(
+            statements, profiles))
+
+
 class CreateAdminCommand(Command):
     """Create the admin user in the database."""
 
@@ -29,6 +55,125 @@ class CreateAdminCommand(Command):
         User.insert_admin_user()
 
 
+class DedupeReactionsCommand(Command):
+    """Remove duplicate reactions of a profile to the same statement, then
+    rebuild the buckets and recount the similarity derived from them.
+    """
+
+    def run(self):
+        removed = remove_duplicate_reactions()
+        print('{0} duplicate reactions removed'.format(removed))
+        if removed == 0:
+            return
+
+        if buckets_enabled():
+            statements, profiles = build_buckets()
+            print('{0} statement buckets, {1} profile buckets'.format(
+                statements, profiles))
+
+        # Only the mongo backend keeps the similarity where the workers read
+        # it, the in-memory backends rebuild their own.
+        if current_app.config['RS_BACKEND'] == 'mongo':
+            current_app.rs.recount_similarity()
+            print('Similarity recounted')
+        else:
+            print('Restart the workers to rebuild the similarity')
+
+
+class EnsureIndexesCommand(Command):
+    """Create the indexes of the recommender system collections."""
+
+    def run(self):
+        for collection, name, created, seconds in ensure_indexes():
+            print('{0}.{1}: {2} ({3:.3f}s)'.format(
+                collection, name, 'created' if created else 'exists', seconds))
+
+
+class MigratePairsCommand(Command):
+    """Add the canonical pair key to existing similarity rows, remove the
+    duplicates and create the unique indexes.
+    """
+
+    def run(self):
+        for collection, keyed, removed in migrate_pairs():
+            print('{0}: {1} keyed, {2} duplicates removed'.format(
+                collection, keyed, removed))
+
+        for collection, name, created, seconds in ensure_indexes():
+            print('{0}.{1}: {2} ({3:.3f}s)'.format(
+                collection, name, 'created' if created else 'exists', seconds))
+
+
+class ServeCommand(Server):
+    """Run the development server with the recommender system warmed up."""
+
+    def __call__(self, app, *args, **kwargs):
+        # With the reloader the server runs in a child process, the watching
+        # parent never serves.
+        reloader = kwargs.get('use_reloader')
+        if reloader is None:
+            reloader = app.debug
+        if not reloader or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            warm_up_rs(app)
+        return super(ServeCommand, self).__call__(app, *args, **kwargs)
+
+
+class SnapshotCommand(Command):
+    """Load the data and write a snapshot of the similarity state. The
+    command's own backend loads the data, it is not warmed up.
+    """
+
+    option_list = (
+        Option('--path', '-p', dest='path', default=None,
+               help='Snapshot file, RS_SNAPSHOT by default.'),
+    )
+
+    def run(self, path):
+        path = path or current_app.config['RS_SNAPSHOT']
+        try:
+            info = take_snapshot(current_app.rs, path)
+        except ValueError as e:
+            print('No snapshot written: {0}'.format(e))
+            return
+
+        print('{0}: {1} snapshot at mark {2}'.format(
+            path, info['backend'], info['mark']))
+
+
+class RestoreCommand(Command):
+    """Restore the similarity state from a snapshot into the store of the
+    numpy backend, publishing it to all workers.
+
+    Without a store the workers keep their own state, which a command cannot
+    reach. They restore the snapshot on boot with RS_SNAPSHOT_BOOT instead,
+    once restarted.
+    """
+
+    option_list = (
+        Option('--path', '-p', dest='path', default=None,
+               help='Snapshot file, RS_SNAPSHOT by default.'),
+        Option('--force', '-f', dest='force', action='store_true',
+               help='Restore a snapshot older than the reactions.'),
+    )
+
+    def run(self, path, force):
+        if getattr(current_app.rs, 'store', None) is None:
+            print('No snapshot restored: only the store of the numpy backend '
+                  'can be restored into, set RS_SNAPSHOT_BOOT and restart '
+                  'the workers instead')
+            return
+
+        path = path or current_app.config['RS_SNAPSHOT']
+        try:
+            info = restore_snapshot(current_app.rs, path, force=force)
+        except (OSError, ValueError) as e:
+            print('No snapshot restored: {0}'.format(e))
+            return
+
+        print('{0}: {1} snapshot at mark {2}, taken {3}'.format(
+            path, info['backend'], info['mark'], info['created']))
+
+
 class InstallCommand(Command):
     """Perform installation tasks."""
 
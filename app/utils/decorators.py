@@ -46,7 +46,7 @@ def confirmed_required(func):
     return decorator
 
 
-def async(func):
+def run_async(func):
     """Function should be asynchronous."""
     def decorator(*args, **kwargs):
         """Decorator."""
@@ -9,10 +9,10 @@ from flask_mail import Message
 
 from app import app
 from app import mailer
-from app.utils.decorators import async
+from app.utils.decorators import run_async
 
 
-@async
+@run_async
 def send_mail_async(msg):
     """Non-blocking mail sender."""
     with app.app_context():
@@ -11,6 +11,16 @@ BASEDIR = os.path.abspath(os.path.dirname(__file__))
 APP_PREFIX = 'TRAVELDELE'
 
 
+def env_flag(name, default=False):
+    """Read an on/off flag from the environment variable of the given name,
+    set by one of 1, true, yes or on, in any case, or the default if unset.
+    """
+    value = os.environ.get('{0}_{1}'.format(APP_PREFIX, name)) or ''
+    if value.strip() == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 class Config(object):
     """Base configuration class."""
 
@@ -49,6 +59,106 @@ class Config(object):
     # Recommender system backend.
     RS_BACKEND = os.environ.get('{0}_RS_BACKEND'.format(APP_PREFIX)) or 'mongo'
 
+    # Storage of the statement similarity in the mongo backend. 'rows' keeps
+    # one document per pair per statement, 'stats' keeps a running sum and
+    # count per pair per category.
+    RS_STORAGE = os.environ.get('{0}_RS_STORAGE'.format(APP_PREFIX)) or 'rows'
+
+    # Full rebuilds in the mongo backend. 'python' computes pairs in the
+    # application, 'pipeline' runs server side aggregation pipelines, which
+    # only give an overall row to the pairs sharing a category.
+    RS_REBUILD = os.environ.get('{0}_RS_REBUILD'.format(APP_PREFIX)) or 'python'
+
+    # Similarity layout of the mongo backend. 'rows' keeps a cmrows document
+    # per pair per category and an omrows document per pair, 'pairs' keeps a
+    # single pmrows document per pair with embedded category scores, updated
+    # in place.
+    RS_LAYOUT = os.environ.get('{0}_RS_LAYOUT'.format(APP_PREFIX)) or 'rows'
+
+    # Keep the reactions bucketed by statement and by profile alongside the
+    # reactions collection, the mongo backend then reads the reactors of a
+    # statement from its bucket. Existing reactions are bucketed by the
+    # build-buckets command.
+    RS_BUCKETS = env_flag('RS_BUCKETS')
+
+    # Number of best matches kept per profile by the mongo and spark
+    # backends, 0 disables. Match requests sorted by descending similarity
+    # with a limit up to this number, by query arguments of a GET or fields
+    # of a POST, are served from the kept lists. Other requests read every
+    # match of the profile.
+    RS_TOPK = int(os.environ.get('{0}_RS_TOPK'.format(APP_PREFIX)) or 0)
+
+    # Sparse overall similarity in the mongo and spark backends. Only pairs
+    # sharing at least RS_MIN_SHARED statements (mongo only) with at least
+    # RS_MIN_SIMILARITY are stored, missing pairs have no similarity.
+    RS_SPARSE = env_flag('RS_SPARSE')
+    RS_MIN_SIMILARITY = float(
+        os.environ.get('{0}_RS_MIN_SIMILARITY'.format(APP_PREFIX)) or 0.0)
+    RS_MIN_SHARED = int(
+        os.environ.get('{0}_RS_MIN_SHARED'.format(APP_PREFIX)) or 1)
+
+    # Warm the recommender system of a served app up in a 'background'
+    # thread, with the readiness reported by /1.0/ready, or 'blocking' until
+    # it is ready. Management commands never warm it up.
+    RS_WARM_UP = os.environ.get(
+        '{0}_RS_WARM_UP'.format(APP_PREFIX)) or 'background'
+
+    # Create missing recommender system indexes at startup, on unless set
+    # off, e.g. when the indexes are managed outside the app.
+    RS_ENSURE_INDEXES = env_flag('RS_ENSURE_INDEXES', True)
+
+    # Number of profile rows broadcast at once by the numpy backend.
+    RS_BLOCK_SIZE = int(
+        os.environ.get('{0}_RS_BLOCK_SIZE'.format(APP_PREFIX)) or 64)
+
+    # Aggregation of the profile pairs of the numpy backend. 'combinations'
+    # broadcasts every pair of reactions, 'buckets' aggregates the reactions
+    # one reaction value bucket at a time, for reactions of a few distinct
+    # values.
+    RS_PAIRS = os.environ.get(
+        '{0}_RS_PAIRS'.format(APP_PREFIX)) or 'combinations'
+
+    # Path of the similarity store of the numpy backend, a file mapped
+    # read-only by every worker and published by one of them on full
+    # updates. Unset keeps the similarity in the memory of every worker.
+    RS_STORE = os.environ.get('{0}_RS_STORE'.format(APP_PREFIX)) or None
+
+    # Seconds an incremental change waits before the store is published
+    # again, so the changes made meanwhile are published together. The store
+    # is rebuilt from all reactions on every publish, incremental changes are
+    # not applied to it, so this bounds how often a steady stream of changes
+    # rebuilds it.
+    RS_STORE_DELAY = float(
+        os.environ.get('{0}_RS_STORE_DELAY'.format(APP_PREFIX)) or 10)
+
+    # Path of the similarity snapshot of the numpy and spark backends,
+    # written by 'manage.py rs snapshot'. With RS_SNAPSHOT_BOOT the workers
+    # restore it on boot, unless the reactions changed since it was taken.
+    RS_SNAPSHOT = os.environ.get(
+        '{0}_RS_SNAPSHOT'.format(APP_PREFIX)) or 'rs-snapshot.npz'
+    RS_SNAPSHOT_BOOT = env_flag('RS_SNAPSHOT_BOOT')
+
+    # Number of rows written per chunk by the rebuilds of the mongo backend,
+    # and parallelized per chunk by the spark backend, bounding the rows
+    # held in memory. Rebuilds generate their rows lazily.
+    RS_BATCH_SIZE = int(
+        os.environ.get('{0}_RS_BATCH_SIZE'.format(APP_PREFIX)) or 1000)
+
+    # Write concern w and number of parallel chunk writers of the derived
+    # similarity collections of the mongo backend, which are not journaled.
+    # w must be at least 1, so a rebuild only completes once its writes
+    # were applied.
+    RS_WRITE_CONCERN = int(
+        os.environ.get('{0}_RS_WRITE_CONCERN'.format(APP_PREFIX)) or 1)
+    RS_WRITE_WORKERS = int(
+        os.environ.get('{0}_RS_WRITE_WORKERS'.format(APP_PREFIX)) or 1)
+
+    # Seconds of the leases on the rebuild lock of the mongo backend and the
+    # store lock of the numpy backend. The lock of a worker which died while
+    # rebuilding is free after this long.
+    RS_LEASE_SECONDS = int(
+        os.environ.get('{0}_RS_LEASE_SECONDS'.format(APP_PREFIX)) or 60)
+
     @staticmethod
     def init_app(app):
         """Configuration specific initialization."""
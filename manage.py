@@ -12,11 +12,12 @@ from flask_script import Manager
 
 
 from app import (
-    create_app, sql, get_app_prefix,
+    create_app, sql, get_app_prefix, warm_up_rs,
 )
 from app.utils.commands import (
-    CreateAdminCommand, InitDbCommand,
-    InstallCommand,
+    BuildBucketsCommand, CreateAdminCommand, DedupeReactionsCommand,
+    EnsureIndexesCommand, InitDbCommand, InstallCommand, MigratePairsCommand,
+    RestoreCommand, ServeCommand, SnapshotCommand,
 )
 import app.utils.context  # @UnusedImport Inject global template variables.
 
@@ -24,10 +25,19 @@ import app.utils.context  # @UnusedImport Inject global template variables.
 app = create_app(
     os.environ.get('{0}_CONFIG'.format(get_app_prefix()), 'default'))
 manager = Manager(app)
+rs_manager = Manager(usage='Snapshot and restore the recommender system.')
+rs_manager.add_command('restore', RestoreCommand)
+rs_manager.add_command('snapshot', SnapshotCommand)
+manager.add_command('build-buckets', BuildBucketsCommand)
 manager.add_command('create-admin', CreateAdminCommand)
 manager.add_command('db', MigrateCommand)
+manager.add_command('dedupe-reactions', DedupeReactionsCommand)
 manager.add_command('do-install', InstallCommand)
+manager.add_command('ensure-indexes', EnsureIndexesCommand)
 manager.add_command('initdb', InitDbCommand)
+manager.add_command('migrate-pairs', MigratePairsCommand)
+manager.add_command('rs', rs_manager)
+manager.add_command('runserver', ServeCommand)
 migrate = Migrate(app, sql)
 
 
@@ -41,3 +51,6 @@ def test():
 
 if __name__ == '__main__':
     manager.run()
+else:
+    # Loaded by uWSGI as its wsgi-file, in every worker with lazy-apps.
+    warm_up_rs(app)
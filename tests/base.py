@@ -0,0 +1,119 @@
+"""Shared setup of the unit tests which need the document store."""
+
+
+import itertools
+import unittest
+
+
+from bson import ObjectId
+
+
+from app import (
+    create_app, mongo,
+)
+import app.rs.interning as interning
+
+
+# Testing application, created once since the extensions can only be
+# initialized once per application.
+_app = None
+
+
+def object_ids(n):
+    """Make n distinct ObjectIds, in increasing order."""
+    return [ObjectId('5a{0:022x}'.format(i + 1)) for i in range(n)]
+
+
+def testing_app():
+    """Get the testing application, creating it on first use."""
+    global _app
+    if _app is None:
+        _app = create_app('testing')
+    return _app
+
+
+class MongoTestCase(unittest.TestCase):
+    """Test case running in an application context on an empty test
+    database.
+    """
+
+    def setUp(self):
+        """"""
+        self.app = testing_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.drop()
+
+    def tearDown(self):
+        """"""
+        self.drop()
+        self.app_context.pop()
+
+    def drop(self):
+        """Drop the test database and forget the interned indices."""
+        mongo.cx.drop_database(mongo.db.name)
+        interning._registry = None
+
+
+class SimilarityTestCase(MongoTestCase):
+    """Test case on six profiles reacting to five statements in two
+    categories, with the similarity the recommender backends compute.
+    """
+
+    # Reactions of every profile to every statement, None for no reaction.
+    # Profile 5 only reacts to a statement nobody else reacted to.
+    reactions = [
+        [1, 2, None, 5, None],
+        [2, 2, 4, None, None],
+        [5, None, 1, 3, None],
+        [None, 4, 4, 1, None],
+        [3, None, None, None, None],
+        [None, None, None, None, 2],
+    ]
+
+    def setUp(self):
+        """"""
+        super(SimilarityTestCase, self).setUp()
+        self.categories = object_ids(2)
+        self.statements = object_ids(len(self.reactions[0]))
+        self.profiles = object_ids(len(self.reactions))
+
+        mongo.db.categories.insert_many([
+            {'_id': self.categories[0], 'weight': 0.6},
+            {'_id': self.categories[1], 'weight': 0.4},
+        ])
+        mongo.db.statements.insert_many([
+            {'_id': s, 'category': self.categories[j % 2]}
+            for j, s in enumerate(self.statements)])
+        mongo.db.reactions.insert_many([
+            {'profile': p, 'statement': s, 'reaction': self.reactions[i][j]}
+            for i, p in enumerate(self.profiles)
+            for j, s in enumerate(self.statements)
+            if self.reactions[i][j] is not None])
+
+    def formula(self):
+        """Compute the overall similarity of every pair of profiles sharing a
+        statement from the stored documents: the mean score of the shared
+        statements per category, weighted by the category and summed.
+        Removed categories weigh nothing.
+        """
+        weights = dict((c['_id'], c['weight'])
+                       for c in mongo.db.categories.find())
+        categories = dict((s['_id'], s['category'])
+                          for s in mongo.db.statements.find())
+        values = dict(((r['profile'], r['statement']), r['reaction'])
+                      for r in mongo.db.reactions.find())
+
+        profiles = set(p for p, _ in values)
+        expected = {}
+        for p0, p1 in itertools.permutations(profiles, 2):
+            scores = {}
+            for s, c in categories.items():
+                if (p0, s) in values and (p1, s) in values:
+                    distance = abs(values[p0, s] - values[p1, s])
+                    scores.setdefault(c, []).append(1.0 / (1 + distance))
+            if scores != {}:
+                expected.setdefault(p0, {})[p1] = sum(
+                    weights.get(c, 0.0) * sum(v) / len(v)
+                    for c, v in scores.items())
+        return expected
@@ -0,0 +1,134 @@
+"""Tests of the reactions bucketed by statement and by profile."""
+
+
+from unittest import mock
+
+
+from app import mongo
+import app.rs.buckets as buckets
+from app.rs.mongo import MongoRecommenderSystem
+from tests.base import (
+    MongoTestCase, object_ids,
+)
+
+
+class BucketsTestCase(MongoTestCase):
+    """The buckets against the reactions collection."""
+
+    def setUp(self):
+        """"""
+        super(BucketsTestCase, self).setUp()
+        self.app.config['RS_BUCKETS'] = True
+        buckets._built = False
+        self.statements = object_ids(3)
+        self.profiles = object_ids(4)
+
+        mongo.db.statements.insert_many(
+            [{'_id': s, 'category': None} for s in self.statements])
+        self.react(self.profiles[0], self.statements[0], 1)
+        self.react(self.profiles[1], self.statements[0], 4)
+        self.react(self.profiles[1], self.statements[1], 2)
+        self.react(self.profiles[2], self.statements[1], 5)
+
+    def tearDown(self):
+        """"""
+        self.app.config.pop('RS_BUCKETS', None)
+        buckets._built = False
+        super(BucketsTestCase, self).tearDown()
+
+    def react(self, profile, statement, reaction):
+        """Write a reaction to the reactions collection only."""
+        mongo.db.reactions.update_one(
+            {'profile': profile, 'statement': statement},
+            {'$set': {'reaction': reaction}}, upsert=True)
+
+    def assertBucketed(self):
+        """Check both buckets against the reactions collection."""
+        for s in self.statements:
+            expected = sorted((r['profile'], r['reaction'])
+                              for r in mongo.db.reactions.find(
+                                  {'statement': s}))
+            self.assertEqual(sorted(buckets.statement_reactors(s)), expected)
+        for p in self.profiles:
+            expected = dict((r['statement'], r['reaction'])
+                            for r in mongo.db.reactions.find({'profile': p}))
+            self.assertEqual(buckets.profile_reactions(p), expected)
+
+    def test_not_readable(self):
+        """The buckets are only read once they were built."""
+        self.assertFalse(buckets.readable())
+        buckets.build_buckets()
+        self.assertTrue(buckets.readable())
+
+    def test_build_buckets(self):
+        """A build buckets every reaction and leaves no staging collection."""
+        self.assertEqual(buckets.build_buckets(), (2, 3))
+        self.assertBucketed()
+
+        names = set(mongo.db.collection_names())
+        for staging in buckets.STAGING.values():
+            self.assertNotIn(staging, names)
+        self.assertEqual(mongo.db.bucketlog.count(), 0)
+
+    def test_rebuild(self):
+        """A rebuild drops the buckets of removed reactions."""
+        buckets.build_buckets()
+        mongo.db.reactions.delete_many({'statement': self.statements[1]})
+        buckets.build_buckets()
+        self.assertBucketed()
+
+    def test_set_reaction(self):
+        """Set and unset reactions are kept in both buckets."""
+        buckets.build_buckets()
+
+        self.react(self.profiles[3], self.statements[2], 3)
+        buckets.set_reaction(self.profiles[3], self.statements[2], 3)
+        self.react(self.profiles[0], self.statements[0], 2)
+        buckets.set_reaction(self.profiles[0], self.statements[0], 2)
+        self.assertBucketed()
+
+        mongo.db.reactions.delete_one(
+            {'profile': self.profiles[1], 'statement': self.statements[1]})
+        buckets.unset_reaction(self.profiles[1], self.statements[1])
+        self.assertBucketed()
+
+    def test_drop_profile(self):
+        """A dropped profile leaves the statement buckets."""
+        buckets.build_buckets()
+        mongo.db.reactions.delete_many({'profile': self.profiles[1]})
+        buckets.drop_profile(self.profiles[1])
+        self.assertBucketed()
+
+    def test_changed_during_build(self):
+        """Changes made while the buckets are being built are kept."""
+        buckets.build_buckets()
+        swap_buckets = buckets.swap_buckets
+
+        def changed():
+            # Lands in the buckets about to be replaced.
+            self.react(self.profiles[3], self.statements[0], 5)
+            buckets.set_reaction(self.profiles[3], self.statements[0], 5)
+            mongo.db.reactions.delete_many({'profile': self.profiles[2]})
+            buckets.drop_profile(self.profiles[2])
+            swap_buckets()
+
+        with mock.patch.object(buckets, 'swap_buckets', changed):
+            buckets.build_buckets()
+
+        self.assertBucketed()
+        self.assertEqual(mongo.db.bucketlog.count(), 0)
+        self.assertIsNone(mongo.db.versions.find_one({'_id': buckets.BUILDING}))
+
+    def test_candidates(self):
+        """The mongo backend reads the same candidates from the buckets as
+        from the reactions collection.
+        """
+        rs = MongoRecommenderSystem(buckets=True)
+        expected = [rs.co_reactions(self.statements[0], self.profiles[0]),
+                    rs.statement_rows(self.statements[1])]
+
+        buckets.build_buckets()
+        mongo.db.reactions.delete_many({})
+        self.assertEqual(
+            [rs.co_reactions(self.statements[0], self.profiles[0]),
+             rs.statement_rows(self.statements[1])], expected)
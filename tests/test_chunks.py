@@ -0,0 +1,100 @@
+"""Tests of the chunked writes of generated rows."""
+
+
+import threading
+import unittest
+
+
+from pymongo import (
+    InsertOne, UpdateOne,
+)
+
+
+from app.rs.chunks import (
+    DerivedWriter, chunked, write_chunks,
+)
+
+
+class FakeCollection(object):
+    """Collection recording the bulk writes made to it."""
+
+    def __init__(self, fail=False):
+        """"""
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.writes = []
+        self.options = None
+
+    def with_options(self, write_concern=None):
+        """"""
+        self.options = write_concern
+        return self
+
+    def bulk_write(self, ops, ordered=True):
+        """"""
+        if self.fail:
+            raise RuntimeError('write failed')
+        with self.lock:
+            self.writes.append((ops, ordered))
+
+
+class WriteChunksTestCase(unittest.TestCase):
+    """chunked and write_chunks."""
+
+    def test_chunked(self):
+        """Rows are split into chunks of at most size rows."""
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+    def test_write_chunks(self):
+        """Every row is written once, in order, and counted."""
+        written = []
+        total = write_chunks((x for x in range(7)), 3, written.append, 'test')
+        self.assertEqual(total, 7)
+        self.assertEqual(written, [[0, 1, 2], [3, 4, 5], [6]])
+
+
+class DerivedWriterTestCase(unittest.TestCase):
+    """DerivedWriter."""
+
+    def test_relaxed_write_concern(self):
+        """The collection is written with w and without the journal."""
+        collection = FakeCollection()
+        DerivedWriter(collection, w=1)
+        self.assertEqual(collection.options.document, {'w': 1, 'j': False})
+
+    def test_unordered_writes(self):
+        """Documents become inserts, operations are written as they are."""
+        collection = FakeCollection()
+        update = UpdateOne({'_id': 1}, {'$set': {'x': 1}})
+        with DerivedWriter(collection) as write:
+            write([{'_id': 0}, update])
+
+        ops, ordered = collection.writes[0]
+        self.assertFalse(ordered)
+        self.assertIsInstance(ops[0], InsertOne)
+        self.assertIs(ops[1], update)
+
+    def test_workers(self):
+        """Every chunk is written by the workers before exit."""
+        collection = FakeCollection()
+        with DerivedWriter(collection, workers=3) as write:
+            total = write_chunks(({'_id': x} for x in range(20)), 3, write,
+                                 'test')
+
+        self.assertEqual(total, 20)
+        self.assertEqual(len(collection.writes), 7)
+        self.assertEqual(sum(len(ops) for ops, _ in collection.writes), 20)
+
+    def test_write_error(self):
+        """A failed write is raised on exit."""
+        with self.assertRaises(RuntimeError):
+            with DerivedWriter(FakeCollection(fail=True), workers=2) as write:
+                write([{'_id': 0}])
+
+    def test_body_error(self):
+        """An error raised by the body is not replaced by a write error."""
+        with self.assertRaises(KeyError):
+            with DerivedWriter(FakeCollection(fail=True), workers=2) as write:
+                write([{'_id': 0}])
+                raise KeyError('body')
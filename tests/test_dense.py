@@ -0,0 +1,165 @@
+"""Tests of the in-memory numpy backend."""
+
+
+import threading
+from unittest import mock
+
+
+import numpy as np
+
+
+from app import mongo
+from app.rs.dense import NumpyRecommenderSystem
+from tests.base import SimilarityTestCase
+
+
+class NumpyRecommenderSystemTestCase(SimilarityTestCase):
+    """NumpyRecommenderSystem against the similarity formula of the mongo
+    backend on a small fixture.
+    """
+
+    # Options of the backend under test.
+    options = {}
+
+    def setUp(self):
+        """"""
+        super(NumpyRecommenderSystemTestCase, self).setUp()
+        self.rs = NumpyRecommenderSystem(**self.options)
+        self.rs.load_data()
+
+    def assertFormula(self):
+        """Check the matches of every profile against the formula and the
+        cached active flags against a full recount.
+        """
+        expected = self.formula()
+        for p in self.profiles:
+            found = dict((q, s) for q, s in self.rs.get_matches(p)
+                         if s > 0)
+            want = dict((q, s) for q, s in expected.get(p, {}).items()
+                        if s > 0)
+            self.assertEqual(set(found), set(want))
+            for q, s in want.items():
+                self.assertAlmostEqual(found[q], s)
+
+        np.testing.assert_array_equal(self.rs.active,
+                                      self.rs.active_profiles())
+
+    def test_load_data(self):
+        """A full load matches the formula."""
+        self.assertFormula()
+
+    def test_inactive(self):
+        """A profile sharing no statement has no matches and is no match."""
+        self.assertEqual(self.rs.get_matches(self.profiles[5]), [])
+        for p in self.profiles[:5]:
+            self.assertNotIn(self.profiles[5],
+                             [q for q, _ in self.rs.get_matches(p)])
+
+    def test_sorted_matches(self):
+        """Matches are sorted by similarity and limited."""
+        found = self.rs.get_matches(self.profiles[0], sort_sim=-1, limit=2)
+        self.assertEqual(len(found), 2)
+        self.assertGreaterEqual(found[0][1], found[1][1])
+
+    def test_add_reaction(self):
+        """A new reaction sharing a statement activates its profile."""
+        rid = mongo.db.reactions.insert_one({
+            'profile': self.profiles[5],
+            'statement': self.statements[0],
+            'reaction': 4}).inserted_id
+        self.rs.add_reaction(rid)
+        self.assertTrue(self.rs.get_matches(self.profiles[5]))
+        self.assertFormula()
+
+    def test_change_reaction(self):
+        """A changed reaction updates the pairs of its statement."""
+        query = {'profile': self.profiles[0], 'statement': self.statements[1]}
+        reaction = mongo.db.reactions.find_one(query)
+        mongo.db.reactions.update_one(query, {'$set': {'reaction': 5}})
+        self.rs.change_reaction(reaction, 5)
+        self.assertFormula()
+
+    def test_remove_reaction(self):
+        """A removed reaction may deactivate its profile."""
+        query = {'profile': self.profiles[4]}
+        reaction = mongo.db.reactions.find_one(query)
+        mongo.db.reactions.delete_one(query)
+        self.rs.remove_reaction(reaction)
+        self.assertEqual(self.rs.get_matches(self.profiles[4]), [])
+        self.assertFormula()
+
+    def test_remove_statement(self):
+        """The pairs of a removed statement are updated."""
+        statement = mongo.db.statements.find_one(
+            {'_id': self.statements[0]})
+        query = {'statement': statement['_id']}
+        reactions = list(mongo.db.reactions.find(query))
+        mongo.db.statements.delete_one({'_id': statement['_id']})
+        mongo.db.reactions.delete_many(query)
+        self.rs.remove_statement(statement, reactions)
+        self.assertFormula()
+
+    def test_move_statement(self):
+        """The pairs of a moved statement are updated in both categories."""
+        statement = mongo.db.statements.find_one(
+            {'_id': self.statements[0]})
+        mongo.db.statements.update_one(
+            {'_id': statement['_id']},
+            {'$set': {'category': self.categories[1]}})
+        self.rs.move_statement(statement, self.categories[1])
+        self.assertFormula()
+
+    def test_clear_orphans(self):
+        """A removed profile is no match and frees its row."""
+        row = self.rs.profile_row(self.profiles[0])
+        mongo.db.reactions.delete_many({'profile': self.profiles[0]})
+        self.rs.clear_orphans(self.profiles[0])
+        self.assertEqual(self.rs.get_matches(self.profiles[0]), [])
+        self.assertIn(row, self.rs.free)
+        self.assertFormula()
+
+    def test_update_weights(self):
+        """New category weights apply, a removed category weighs nothing."""
+        mongo.db.categories.update_one(
+            {'_id': self.categories[1]}, {'$set': {'weight': 0.9}})
+        self.rs.update_weights()
+        self.assertFormula()
+
+        mongo.db.statements.update_many(
+            {'category': self.categories[0]}, {'$set': {'category': None}})
+        mongo.db.categories.delete_one({'_id': self.categories[0]})
+        self.rs.update_weights()
+        self.assertFormula()
+
+    def test_matches_during_load(self):
+        """The current matches are served while the data is reloaded."""
+        expected = self.rs.get_matches(self.profiles[0])
+        loading, served = threading.Event(), threading.Event()
+        waited = []
+        load_state = NumpyRecommenderSystem.load_state
+
+        def blocked(state):
+            loading.set()
+            waited.append(served.wait(5))
+            load_state(state)
+
+        def load():
+            with self.app.app_context():
+                self.rs.load_data()
+
+        with mock.patch.object(NumpyRecommenderSystem, 'load_state', blocked):
+            thread = threading.Thread(target=load)
+            thread.start()
+            loading.wait(5)
+            self.assertEqual(self.rs.get_matches(self.profiles[0]), expected)
+            served.set()
+            thread.join()
+
+        self.assertEqual(waited, [True])
+        self.assertFormula()
+
+
+class BucketsTestCase(NumpyRecommenderSystemTestCase):
+    """The aggregation of the pairs one reaction value bucket at a time."""
+
+    options = {'block_size': 2, 'pairs': 'buckets'}
@@ -0,0 +1,51 @@
+"""Tests of the index specification of the recommender collections."""
+
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+
+from app import mongo
+from app.rs.indexes import (
+    ensure_indexes, remove_duplicate_reactions,
+)
+from tests.base import (
+    MongoTestCase, object_ids,
+)
+
+
+class EnsureIndexesTestCase(MongoTestCase):
+    """ensure_indexes replacing the plain reactions index by a unique one."""
+
+    def setUp(self):
+        """"""
+        super(EnsureIndexesTestCase, self).setUp()
+        profile, statement = object_ids(2)
+        mongo.db.reactions.insert_many([
+            {'profile': profile, 'statement': statement, 'reaction': 1},
+            {'profile': profile, 'statement': statement, 'reaction': 2},
+        ])
+        self.index = mongo.db.reactions.create_index(
+            [('statement', ASCENDING), ('profile', ASCENDING)])
+
+    def test_duplicates(self):
+        """With duplicate reactions the plain index is kept."""
+        with self.assertRaises(OperationFailure):
+            ensure_indexes()
+
+        info = mongo.db.reactions.index_information()
+        self.assertIn(self.index, info)
+        self.assertFalse(info[self.index].get('unique'))
+
+    def test_replaced(self):
+        """Without duplicates the plain index is replaced by a unique one."""
+        self.assertEqual(remove_duplicate_reactions(), 1)
+        report = dict(((c, n), created)
+                      for c, n, created, _ in ensure_indexes())
+        self.assertTrue(report['reactions', self.index])
+        self.assertTrue(
+            mongo.db.reactions.index_information()[self.index]['unique'])
+
+        report = dict(((c, n), created)
+                      for c, n, created, _ in ensure_indexes())
+        self.assertFalse(any(report.values()))
@@ -0,0 +1,79 @@
+"""Tests of the persistent int32 indices of the ObjectIds."""
+
+
+from app import mongo
+from app.rs.indexes import ensure_indexes
+from app.rs.interning import IdRegistry
+from tests.base import (
+    MongoTestCase, object_ids,
+)
+
+
+class IdRegistryTestCase(MongoTestCase):
+    """IdRegistry."""
+
+    def setUp(self):
+        """"""
+        super(IdRegistryTestCase, self).setUp()
+        ensure_indexes()
+        self.ids = object_ids(4)
+        self.registry = IdRegistry()
+
+    def test_round_trip(self):
+        """Interned ObjectIds get dense indices which map back to them."""
+        indices = self.registry.intern_many('profile', self.ids[:3])
+        self.assertEqual(sorted(indices), [0, 1, 2])
+        self.assertEqual(self.registry.intern('profile', self.ids[3]), 3)
+        self.assertEqual(self.registry.size('profile'), 4)
+
+        for oid in self.ids:
+            index = self.registry.index('profile', oid)
+            self.assertEqual(self.registry.object_id('profile', index), oid)
+
+    def test_interned_once(self):
+        """Interning an ObjectId again keeps its index."""
+        first = self.registry.intern('profile', self.ids[0])
+        self.assertEqual(
+            list(self.registry.array('profile', [self.ids[0]] * 2)),
+            [first, first])
+        self.assertEqual(self.registry.size('profile'), 1)
+
+    def test_kinds(self):
+        """Every kind has its own indices."""
+        self.registry.intern('profile', self.ids[0])
+        self.assertEqual(self.registry.intern('statement', self.ids[1]), 0)
+        self.assertIsNone(self.registry.index('statement', self.ids[0]))
+
+    def test_reload(self):
+        """A new registry restores the stored indices and allocates after
+        them.
+        """
+        indices = self.registry.intern_many('profile', self.ids[:3])
+
+        registry = IdRegistry()
+        self.assertEqual(registry.size('profile'), 3)
+        self.assertEqual(
+            [registry.index('profile', oid) for oid in self.ids[:3]], indices)
+        self.assertEqual(registry.intern('profile', self.ids[3]), 3)
+
+    def test_other_worker(self):
+        """Indices allocated by another worker are looked up on demand, and
+        an ObjectId allocated by both keeps the first index stored.
+        """
+        other = IdRegistry()
+        index = other.intern('profile', self.ids[0])
+        self.assertEqual(self.registry.index('profile', self.ids[0]), index)
+        self.assertEqual(self.registry.object_id('profile', index),
+                         self.ids[0])
+
+        # Both registries miss ids[1], the later allocation loses.
+        mongo.db.ids.insert_one(
+            {'kind': 'profile', 'oid': self.ids[1], 'index': 7})
+        self.assertEqual(other.intern('profile', self.ids[1]), 7)
+
+    def test_unknown(self):
+        """Unknown ObjectIds and unallocated indices give None."""
+        self.assertIsNone(self.registry.index('profile', self.ids[0]))
+        self.assertIsNone(self.registry.object_id('profile', 0))
+        self.registry.intern('profile', self.ids[0])
+        self.assertIsNone(self.registry.object_id('profile', 5))
@@ -0,0 +1,76 @@
+"""Tests of the leases on named locks."""
+
+
+from datetime import (
+    datetime, timedelta,
+)
+import time
+from unittest import mock
+
+
+from app.rs.leases import (
+    Lease, lease_status,
+)
+from tests.base import MongoTestCase
+
+
+class LeaseTestCase(MongoTestCase):
+    """Lease."""
+
+    def test_acquire(self):
+        """A held lock is not taken by another lease."""
+        lease = Lease('test', 60)
+        self.assertTrue(lease.acquire(kind='full'))
+        self.assertFalse(Lease('test', 60).acquire())
+
+        status = lease_status('test')
+        self.assertEqual(status['owner'], lease.owner)
+        self.assertEqual(status['kind'], 'full')
+        lease.release()
+
+    def test_release(self):
+        """A released lock keeps the info stored on release and is taken by
+        the next lease.
+        """
+        lease = Lease('test', 60)
+        lease.acquire()
+        lease.release(last={'version': 1})
+
+        status = lease_status('test')
+        self.assertIsNone(status['owner'])
+        self.assertEqual(status['state'], 'idle')
+        self.assertEqual(status['last'], {'version': 1})
+        self.assertTrue(Lease('test', 60).acquire())
+
+    def test_renewed(self):
+        """A lease held for several times its period is renewed in the
+        background, so it is neither lost nor taken over.
+        """
+        lease = Lease('test', 0.3)
+        lease.acquire()
+        time.sleep(1.0)
+
+        self.assertFalse(lease.lost)
+        self.assertFalse(Lease('test', 0.3).acquire())
+        self.assertTrue(lease.held())
+        lease.release()
+
+    def test_expired(self):
+        """An expired lease is taken over, then flagged as lost."""
+        with mock.patch('app.rs.leases.datetime') as clock:
+            clock.utcnow.return_value = datetime(2020, 1, 1)
+            lease = Lease('test', 60)
+            lease.acquire()
+
+            clock.utcnow.return_value += timedelta(seconds=59)
+            self.assertFalse(Lease('test', 60).acquire())
+
+            clock.utcnow.return_value += timedelta(seconds=2)
+            other = Lease('test', 60)
+            self.assertTrue(other.acquire())
+            self.assertFalse(lease.held())
+            self.assertTrue(lease.lost)
+            other.release()
+            lease.release()
+
+        self.assertEqual(lease_status('test')['state'], 'idle')
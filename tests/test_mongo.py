@@ -0,0 +1,295 @@
+"""Tests of the mongo backend."""
+
+
+from app import mongo
+from app.rs.indexes import remove_duplicate_reactions
+from app.rs.mongo import MongoRecommenderSystem
+from app.rs.pairs import pair_key
+from app.rs.versions import (
+    current_version, logged_changes,
+)
+from tests.base import SimilarityTestCase
+
+
+class MongoRecommenderSystemTestCase(SimilarityTestCase):
+    """Incremental updates of MongoRecommenderSystem against the similarity
+    formula and a full rebuild of the same reactions.
+    """
+
+    # Options of the backend under test.
+    options = {}
+
+    def setUp(self):
+        """"""
+        super(MongoRecommenderSystemTestCase, self).setUp()
+        self.rs = self.backend()
+        self.rs.warm_up()
+
+    def backend(self):
+        """Make a backend with the options under test."""
+        return MongoRecommenderSystem(**self.options)
+
+    def matches(self, rs):
+        """Get the matches with a similarity of every profile, by profile."""
+        return dict((p, dict((q, s) for q, s in rs.get_matches(p) if s > 0))
+                    for p in self.profiles)
+
+    def expected(self):
+        """Get the matches the formula gives every profile, by profile. In
+        sparse mode only the pairs reaching the minimum similarity match.
+        """
+        least = self.options.get('min_similarity', 0.0) \
+            if self.options.get('sparse') else 0.0
+        expected = self.formula()
+        return dict((p, dict((q, s) for q, s in expected.get(p, {}).items()
+                             if s > 0 and s >= least))
+                    for p in self.profiles)
+
+    def assertMatches(self, found, expected):
+        """Check matches by profile against the expected ones."""
+        for p in self.profiles:
+            self.assertEqual(set(found[p]), set(expected[p]))
+            for q, s in expected[p].items():
+                self.assertAlmostEqual(found[p][q], s)
+
+    def assertRebuilt(self):
+        """Check the matches served after the incremental updates against
+        the formula and against the matches of a full rebuild from scratch.
+        """
+        found = self.matches(self.rs)
+        self.assertMatches(found, self.expected())
+
+        self.rs.purge_similarity()
+        rebuilt = self.backend()
+        rebuilt.update_similarity()
+        self.assertMatches(found, self.matches(rebuilt))
+
+    def add_reaction(self, profile, statement, value):
+        """Insert a reaction and add it to the backend."""
+        rid = mongo.db.reactions.insert_one({
+            'profile': self.profiles[profile],
+            'statement': self.statements[statement],
+            'reaction': value}).inserted_id
+        self.rs.add_reaction(rid)
+
+    def test_warm_up(self):
+        """Warming up builds the similarity."""
+        self.assertTrue(self.rs.ready)
+        # Profiles 0 and 1 agree on a statement of category 1, weighing
+        # 0.4, and are 1 apart on one of category 0, weighing 0.6.
+        found = dict(self.rs.get_matches(self.profiles[0]))
+        self.assertAlmostEqual(found[self.profiles[1]], 0.6 * 0.5 + 0.4)
+        self.assertRebuilt()
+
+    def test_add_reaction(self):
+        """New reactions update the pairs of their statement."""
+        self.add_reaction(5, 0, 4)
+        self.add_reaction(4, 4, 1)
+        self.add_reaction(1, 3, 5)
+        self.assertRebuilt()
+
+    def test_drifted_overall(self):
+        """An update sets the overall similarity of a pair from its category
+        rows, whatever it held, as after another worker updated the pair.
+        """
+        overall = self.rs.collection(self.rs.overall)
+        overall.update_one(
+            {'key': pair_key(self.profiles[0], self.profiles[1])},
+            {'$inc': {'similarity': 1.0}})
+        self.add_reaction(1, 3, 5)
+        self.assertRebuilt()
+
+    def test_change_reaction(self):
+        """A changed reaction updates the pairs of its statement."""
+        query = {'profile': self.profiles[0], 'statement': self.statements[1]}
+        reaction = mongo.db.reactions.find_one(query)
+        mongo.db.reactions.update_one(query, {'$set': {'reaction': 5}})
+        self.rs.change_reaction(reaction, 5)
+        self.assertRebuilt()
+
+    def test_concurrent_changes(self):
+        """Reactions to a statement changed at once by two workers, each
+        seeing the change of the other, update its pairs.
+        """
+        changes = []
+        for i, value in ((0, 5), (1, 1)):
+            query = {
+                'profile': self.profiles[i],
+                'statement': self.statements[1]
+            }
+            changes.append((mongo.db.reactions.find_one(query), value))
+            mongo.db.reactions.update_one(query, {'$set': {'reaction': value}})
+
+        for reaction, value in changes:
+            self.rs.change_reaction(reaction, value)
+        self.assertRebuilt()
+
+    def test_remove_reaction(self):
+        """A removed reaction updates the pairs of its statement."""
+        for query in ({'profile': self.profiles[4]},
+                      {'profile': self.profiles[2],
+                       'statement': self.statements[0]}):
+            reaction = mongo.db.reactions.find_one(query)
+            mongo.db.reactions.delete_one({'_id': reaction['_id']})
+            self.rs.remove_reaction(reaction)
+        self.assertRebuilt()
+
+    def test_clear_orphans(self):
+        """A removed profile is no match and has no matches."""
+        mongo.db.reactions.delete_many({'profile': self.profiles[0]})
+        self.rs.clear_orphans(self.profiles[0])
+        self.assertEqual(self.rs.get_matches(self.profiles[0]), [])
+        self.assertRebuilt()
+
+    def test_update_weights(self):
+        """New category weights apply to the overall similarity."""
+        mongo.db.categories.update_one(
+            {'_id': self.categories[0]}, {'$set': {'weight': 0.1}})
+        before = self.matches(self.rs)
+        self.rs.update_weights()
+        self.assertNotEqual(self.matches(self.rs), before)
+        self.assertRebuilt()
+
+    def test_remove_statement(self):
+        """The pairs of a removed statement are updated."""
+        statement = mongo.db.statements.find_one(
+            {'_id': self.statements[0]})
+        query = {'statement': statement['_id']}
+        reactions = list(mongo.db.reactions.find(query))
+        mongo.db.statements.delete_one({'_id': statement['_id']})
+        mongo.db.reactions.delete_many(query)
+        self.rs.remove_statement(statement, reactions)
+        self.assertRebuilt()
+
+    def test_move_statement(self):
+        """The pairs of a moved statement are updated in both categories."""
+        statement = mongo.db.statements.find_one(
+            {'_id': self.statements[0]})
+        mongo.db.statements.update_one(
+            {'_id': statement['_id']},
+            {'$set': {'category': self.categories[1]}})
+        self.rs.move_statement(statement, self.categories[1])
+        self.assertRebuilt()
+
+    def test_recount_similarity(self):
+        """Recounting after the duplicate reactions were removed forgets
+        what they added.
+        """
+        self.add_reaction(0, 0, 5)
+        self.assertEqual(remove_duplicate_reactions(), 1)
+        self.rs.recount_similarity()
+        self.assertRebuilt()
+
+    def test_replay_changes(self):
+        """Changes made while another worker rebuilds are replayed onto the
+        version it flips to.
+        """
+        builder = self.backend()
+
+        def rebuild():
+            builder.rebuild_similarity()
+            self.add_reaction(1, 3, 5)
+
+        version = builder.build_version(rebuild)
+        self.assertEqual(current_version(), version)
+        self.assertEqual(list(logged_changes(version)), [])
+        self.assertRebuilt()
+
+
+class StatsTestCase(MongoRecommenderSystemTestCase):
+    """The 'stats' storage, keeping running sums and counts."""
+
+    options = {'storage': 'stats'}
+
+
+class StatsBatchTestCase(MongoRecommenderSystemTestCase):
+    """The 'stats' storage built with counters flushed a few at a time."""
+
+    options = {'storage': 'stats', 'batch_size': 2}
+
+
+class PipelineTestCase(MongoRecommenderSystemTestCase):
+    """Full rebuilds with aggregation pipelines."""
+
+    options = {'rebuild': 'pipeline'}
+
+
+class StatsPipelineTestCase(MongoRecommenderSystemTestCase):
+    """Full rebuilds of the 'stats' storage with aggregation pipelines."""
+
+    options = {'storage': 'stats', 'rebuild': 'pipeline'}
+
+
+class PairsTestCase(MongoRecommenderSystemTestCase):
+    """The 'pairs' layout, one document per pair."""
+
+    options = {'layout': 'pairs'}
+
+    def test_reordered_scores(self):
+        """Scores stored with their fields in another order are updated in
+        place.
+        """
+        pmrows = self.rs.collection('pmrows')
+        doc = pmrows.find_one(
+            {'key': pair_key(self.profiles[0], self.profiles[1])})
+        pmrows.update_one({'_id': doc['_id']}, {'$set': {'scores': [
+            dict(reversed(list(score.items()))) for score in doc['scores']]}})
+
+        self.add_reaction(1, 3, 5)
+        self.assertEqual(len(pmrows.find_one(
+            {'_id': doc['_id']})['scores']), 2)
+        self.assertRebuilt()
+
+
+class StatsPairsTestCase(PairsTestCase):
+    """The 'pairs' layout with the 'stats' storage."""
+
+    options = {'layout': 'pairs', 'storage': 'stats'}
+
+
+class PipelinePairsTestCase(PairsTestCase):
+    """The 'pairs' layout rebuilt with aggregation pipelines."""
+
+    options = {'layout': 'pairs', 'rebuild': 'pipeline'}
+
+
+class TopkTestCase(MongoRecommenderSystemTestCase):
+    """Best matches kept per profile."""
+
+    options = {'topk': 2}
+
+    def matches(self, rs):
+        """Get the similarity of the best matches of every profile by rank,
+        served from the kept lists. Matches of equal similarity may come in
+        any order.
+        """
+        return dict((p, dict(enumerate(
+            s for _, s in rs.get_matches(p, sort_sim=-1, limit=2) if s > 0)))
+            for p in self.profiles)
+
+    def expected(self):
+        """Get the similarity of the best matches the formula gives every
+        profile by rank.
+        """
+        expected = super(TopkTestCase, self).expected()
+        return dict((p, dict(enumerate(sorted(
+            expected[p].values(), reverse=True)[:2])))
+            for p in self.profiles)
+
+
+class SparseTestCase(MongoRecommenderSystemTestCase):
+    """Sparse overall similarity."""
+
+    options = {'sparse': True, 'min_similarity': 0.3}
+
+
+class SparsePairsTestCase(PairsTestCase):
+    """Sparse overall similarity in the 'pairs' layout."""
+
+    options = {'sparse': True, 'min_similarity': 0.3, 'layout': 'pairs'}
+
+
+class StatsPairsBatchTestCase(PairsTestCase):
+    """The 'pairs' layout built with counters flushed a few at a time."""
+
+    options = {'layout': 'pairs', 'storage': 'stats', 'batch_size': 2}
@@ -0,0 +1,78 @@
+"""Tests of the canonical keys of profile pairs."""
+
+
+import unittest
+
+
+from bson import ObjectId
+
+
+from app import mongo
+from app.rs.pairs import (
+    migrate_pairs, pair_key, unkeyed_pairs,
+)
+from tests.base import MongoTestCase
+
+
+class PairKeyTestCase(unittest.TestCase):
+    """pair_key."""
+
+    p0 = ObjectId('5a0000000000000000000001')
+    p1 = ObjectId('5a0000000000000000000002')
+
+    def test_unordered(self):
+        """Both orders of a pair have the same key."""
+        self.assertEqual(pair_key(self.p0, self.p1),
+                         pair_key(self.p1, self.p0))
+
+    def test_sorted_concatenation(self):
+        """The key is the concatenation of the sorted ObjectIds."""
+        key = pair_key(self.p1, self.p0)
+        self.assertEqual(bytes(key), self.p0.binary + self.p1.binary)
+
+    def test_strings(self):
+        """ObjectIds given as strings have the same key."""
+        self.assertEqual(pair_key(str(self.p0), str(self.p1)),
+                         pair_key(self.p0, self.p1))
+
+    def test_distinct_pairs(self):
+        """Different pairs have different keys."""
+        p2 = ObjectId('5a0000000000000000000003')
+        self.assertNotEqual(pair_key(self.p0, self.p1),
+                            pair_key(self.p0, p2))
+
+
+class MigratePairsTestCase(MongoTestCase):
+    """unkeyed_pairs and migrate_pairs on rows written without a key."""
+
+    p0 = ObjectId('5a0000000000000000000001')
+    p1 = ObjectId('5a0000000000000000000002')
+
+    def setUp(self):
+        """"""
+        super(MigratePairsTestCase, self).setUp()
+        statement = ObjectId()
+        mongo.db.smrows.insert_many([
+            {'pair': [self.p0, self.p1], 'statement': statement,
+             'distance': 1},
+            {'pair': [self.p1, self.p0], 'statement': statement,
+             'distance': 1},
+        ])
+        mongo.db.omrows.insert_one(
+            {'pair': [self.p0, self.p1], 'similarity': 0.5})
+
+    def test_unkeyed_pairs(self):
+        """Collections with unkeyed rows are reported until migrated."""
+        self.assertEqual(unkeyed_pairs(), ['omrows', 'smrows'])
+        migrate_pairs()
+        self.assertEqual(unkeyed_pairs(), [])
+
+    def test_migrate_pairs(self):
+        """Rows get their pair key and duplicates of a key are removed."""
+        report = migrate_pairs()
+        self.assertEqual(report, [
+            ('cmrows', 0, 0), ('omrows', 1, 0), ('smrows', 2, 1)])
+
+        key = pair_key(self.p0, self.p1)
+        self.assertEqual(mongo.db.smrows.count({'key': key}), 1)
+        self.assertEqual(mongo.db.omrows.count({'key': key}), 1)
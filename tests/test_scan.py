@@ -0,0 +1,42 @@
+"""Tests of the pairs generated from the reactions to a statement."""
+
+
+import unittest
+
+
+from app.rs.scan import (
+    reaction_pairs, unique_reactions,
+)
+
+
+class ReactionPairsTestCase(unittest.TestCase):
+    """reaction_pairs and unique_reactions."""
+
+    reactions = [('a', 1), ('b', 4), ('c', 2)]
+
+    def test_all_pairs(self):
+        """Every pair is generated once with its distance."""
+        self.assertEqual(list(reaction_pairs(self.reactions)), [
+            ('a', 'b', 3), ('a', 'c', 1), ('b', 'c', 2)])
+
+    def test_filtered_pairs(self):
+        """Filtered pairs hold the filter object first."""
+        self.assertEqual(list(reaction_pairs(self.reactions, 'b')), [
+            ('b', 'a', 3), ('b', 'c', 2)])
+
+    def test_filter_without_reaction(self):
+        """Nothing is generated for a filter object without a reaction."""
+        self.assertEqual(list(reaction_pairs(self.reactions, 'd')), [])
+
+    def test_single_reaction(self):
+        """A single reaction forms no pair."""
+        self.assertEqual(list(reaction_pairs([('a', 1)])), [])
+
+    def test_unique_reactions(self):
+        """Only the first reaction of a profile is kept."""
+        found = [
+            {'profile': 'a', 'reaction': 1},
+            {'profile': 'b', 'reaction': 2},
+            {'profile': 'a', 'reaction': 5},
+        ]
+        self.assertEqual(unique_reactions(found), [('a', 1), ('b', 2)])
@@ -0,0 +1,40 @@
+"""Tests of the schemata of the API data."""
+
+
+import unittest
+
+
+import validictory
+
+
+from app.api_v1_0.schemata import schemata
+
+
+class PutReactionTestCase(unittest.TestCase):
+    """The put_reaction schema."""
+
+    def validate(self, data):
+        """Validate data against the schema."""
+        validictory.validate(data, schemata.put_reaction)
+
+    def test_reaction(self):
+        """An integer reaction is valid."""
+        self.validate({'reaction': 3})
+
+    def test_not_integer(self):
+        """A reaction which is not an integer is refused."""
+        for value in ('3', 3.5, None, True):
+            with self.assertRaises(ValueError):
+                self.validate({'reaction': value})
+
+    def test_missing(self):
+        """The reaction is required."""
+        with self.assertRaises(ValueError):
+            self.validate({})
+
+    def test_profile_and_statement(self):
+        """The profile and statement of a reaction cannot change."""
+        with self.assertRaises(ValueError):
+            self.validate({'reaction': 3, 'profile': 'x'})
+        with self.assertRaises(ValueError):
+            self.validate({'reaction': 3, 'statement': 'x'})
@@ -0,0 +1,84 @@
+"""Tests of the snapshots of the in-memory backends."""
+
+
+import os
+import shutil
+import tempfile
+
+
+from bson import ObjectId
+
+
+from app import mongo
+from app.rs.dense import NumpyRecommenderSystem
+from app.rs.marks import advance_mark
+from app.rs.snapshots import (
+    restore_on_boot, restore_snapshot, take_snapshot,
+)
+from tests.base import MongoTestCase
+
+
+class SnapshotTestCase(MongoTestCase):
+    """take_snapshot and restore_snapshot with the numpy backend."""
+
+    def setUp(self):
+        """"""
+        super(SnapshotTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.npz')
+
+        category = mongo.db.categories.insert_one(
+            {'weight': 1.0}).inserted_id
+        statements = [
+            mongo.db.statements.insert_one(
+                {'category': category}).inserted_id for _ in range(3)]
+        self.profiles = [ObjectId() for _ in range(4)]
+        mongo.db.reactions.insert_many([
+            {'profile': p, 'statement': s, 'reaction': (i + j) % 5 + 1}
+            for i, p in enumerate(self.profiles)
+            for j, s in enumerate(statements)])
+
+    def tearDown(self):
+        """"""
+        shutil.rmtree(self.directory)
+        super(SnapshotTestCase, self).tearDown()
+
+    def matches(self, rs):
+        """Get the matches of every profile."""
+        return [rs.get_matches(p) for p in self.profiles]
+
+    def test_round_trip(self):
+        """A restored snapshot serves the matches it was taken with."""
+        rs = NumpyRecommenderSystem()
+        info = take_snapshot(rs, self.path)
+        self.assertEqual(info['backend'], 'NumpyRecommenderSystem')
+        self.assertEqual(info['mark'], 0)
+
+        restored = NumpyRecommenderSystem()
+        found = restore_snapshot(restored, self.path)
+        self.assertEqual(found['mark'], 0)
+        self.assertEqual(self.matches(restored), self.matches(rs))
+        self.assertTrue(any(self.matches(restored)))
+
+    def test_older_than_mark(self):
+        """A snapshot older than the mark is only restored if forced."""
+        take_snapshot(NumpyRecommenderSystem(), self.path)
+        advance_mark()
+
+        rs = NumpyRecommenderSystem()
+        with self.assertRaises(ValueError):
+            restore_snapshot(rs, self.path)
+        self.assertFalse(restore_on_boot(rs, self.path))
+        restore_snapshot(rs, self.path, force=True)
+        self.assertTrue(any(self.matches(rs)))
+
+    def test_missing(self):
+        """A missing snapshot is not restored on boot."""
+        self.assertFalse(restore_on_boot(NumpyRecommenderSystem(), self.path))
+
+    def test_unsupported(self):
+        """Backends without snapshots are refused."""
+        with self.assertRaises(ValueError):
+            take_snapshot(object(), self.path)
+        with self.assertRaises(ValueError):
+            restore_snapshot(object(), self.path)
@@ -0,0 +1,187 @@
+"""Tests of the similarity store shared by the workers."""
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+
+from bson import ObjectId
+import numpy as np
+
+
+from app import mongo
+from app.rs.dense import NumpyRecommenderSystem
+from app.rs.store import (
+    SimilarityStore, write_store,
+)
+from tests.base import (
+    MongoTestCase, object_ids,
+)
+
+
+class SimilarityStoreTestCase(unittest.TestCase):
+    """write_store and SimilarityStore."""
+
+    ids = [
+        ObjectId('5a0000000000000000000001'),
+        None,
+        ObjectId('5a0000000000000000000002'),
+        ObjectId('5a0000000000000000000003'),
+    ]
+
+    osm = np.array([
+        [0.0, 0.0, 0.5, 0.25],
+        [0.0, 0.0, 0.0, 0.0],
+        [0.5, 0.0, 0.0, 0.0],
+        [0.25, 0.0, 0.0, 0.0],
+    ])
+
+    def setUp(self):
+        """"""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store.npy')
+
+    def tearDown(self):
+        """"""
+        shutil.rmtree(self.directory)
+
+    def test_missing(self):
+        """Nothing is served without a store."""
+        store = SimilarityStore(self.path)
+        self.assertEqual(store.version(), 0)
+        self.assertIsNone(store.row(self.ids[0]))
+        self.assertEqual(store.matches(self.ids[0]), [])
+
+    def test_round_trip(self):
+        """The rows, flags and similarities written are read back."""
+        write_store(self.path, 3, self.ids, [True, False, True, True],
+                    self.osm)
+        store = SimilarityStore(self.path)
+        self.assertEqual(store.version(), 3)
+        self.assertEqual(store.row(self.ids[2]), 2)
+        self.assertIsNone(store.row(ObjectId()))
+
+        self.assertEqual(store.matches(self.ids[0]), [
+            (self.ids[2], 0.5), (self.ids[3], 0.25)])
+        self.assertEqual(store.matches(self.ids[0], sort_sim=1, limit=1), [
+            (self.ids[3], 0.25)])
+        self.assertEqual(store.matches(self.ids[2]), [
+            (self.ids[0], 0.5), (self.ids[3], 0.0)])
+
+    def test_inactive(self):
+        """Inactive profiles have no matches and are no match."""
+        write_store(self.path, 1, self.ids, [True, False, True, False],
+                    self.osm)
+        store = SimilarityStore(self.path)
+        self.assertEqual(store.matches(self.ids[0]), [(self.ids[2], 0.5)])
+        self.assertEqual(store.matches(self.ids[3]), [])
+
+    def test_replaced(self):
+        """A replaced store is mapped on the next read."""
+        write_store(self.path, 1, self.ids, [True] * 4, self.osm)
+        store = SimilarityStore(self.path)
+        self.assertEqual(store.version(), 1)
+
+        write_store(self.path, 2, self.ids[:1], [False], np.zeros((1, 1)))
+        self.assertEqual(store.version(), 2)
+        self.assertIsNone(store.row(self.ids[2]))
+        self.assertEqual(store.matches(self.ids[0]), [])
+
+    def test_replaced_during_read(self):
+        """A store replaced while a read resolves the row of a profile is
+        not mapped by that read, so the row is not read from the new store.
+        """
+        write_store(self.path, 1, self.ids, [True, False, True, True],
+                    self.osm)
+        store = SimilarityStore(self.path)
+        refresh = store.refresh
+
+        # Row 0 of the first profile goes to the last one in the new store.
+        def replaced():
+            found = refresh()
+            write_store(self.path, 2, self.ids[3:] + self.ids[1:3] + [None],
+                        [True, False, True, False], self.osm * 0.5)
+            return found
+
+        with mock.patch.object(store, 'refresh', side_effect=replaced):
+            self.assertEqual(store.matches(self.ids[0]), [
+                (self.ids[2], 0.5), (self.ids[3], 0.25)])
+
+        self.assertEqual(store.version(), 2)
+        self.assertEqual(store.matches(self.ids[3]), [(self.ids[2], 0.25)])
+
+
+class StoreBackendTestCase(MongoTestCase):
+    """The numpy backend with a store."""
+
+    def setUp(self):
+        """"""
+        super(StoreBackendTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store.npy')
+
+        category, = object_ids(1)
+        self.profiles = object_ids(3)
+        mongo.db.categories.insert_one({'_id': category, 'weight': 1.0})
+        self.statement = mongo.db.statements.insert_one(
+            {'category': category}).inserted_id
+        mongo.db.reactions.insert_many([
+            {'profile': p, 'statement': self.statement, 'reaction': 3}
+            for p in self.profiles[:2]])
+
+    def tearDown(self):
+        """"""
+        shutil.rmtree(self.directory)
+        super(StoreBackendTestCase, self).tearDown()
+
+    def test_missing_store(self):
+        """A missing store is built even though a build ran before."""
+        rs = NumpyRecommenderSystem(store=self.path)
+        rs.warm_up()
+        self.assertEqual(rs.get_matches(self.profiles[0]),
+                         [(self.profiles[1], 1.0)])
+
+        os.remove(self.path)
+        rs = NumpyRecommenderSystem(store=self.path)
+        rs.warm_up()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(rs.get_matches(self.profiles[0]),
+                         [(self.profiles[1], 1.0)])
+
+    def test_changes_rebuild(self):
+        """Incremental changes are not applied to the store, the changes made
+        within the store delay are published by a single rebuild.
+        """
+        rs = NumpyRecommenderSystem(store=self.path, store_delay=0.5)
+        rs.warm_up()
+        version = rs.similarity_version()
+
+        load_state = NumpyRecommenderSystem.load_state
+        with mock.patch.object(NumpyRecommenderSystem, 'load_state',
+                               autospec=True, side_effect=load_state) as load:
+            for value in (1, 5):
+                mongo.db.reactions.delete_many({'profile': self.profiles[2]})
+                rid = mongo.db.reactions.insert_one({
+                    'profile': self.profiles[2],
+                    'statement': self.statement,
+                    'reaction': value}).inserted_id
+                rs.add_reaction(rid)
+                self.assertEqual(rs.similarity_version(), version)
+
+            for _ in range(50):
+                if rs.similarity_version() > version:
+                    break
+                time.sleep(0.1)
+            time.sleep(1.0)
+
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual(rs.similarity_version(), version + 1)
+        self.assertIsNone(rs.reactions)
+        found = dict(rs.get_matches(self.profiles[2]))
+        self.assertEqual(set(found), set(self.profiles[:2]))
+        for sim in found.values():
+            self.assertAlmostEqual(sim, 1 / 3.0, places=6)
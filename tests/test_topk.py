@@ -0,0 +1,64 @@
+"""Tests of the per profile lists of best matches."""
+
+
+import unittest
+
+
+from app.rs.topk import (
+    best_matches, merge_matches,
+)
+
+
+class BestMatchesTestCase(unittest.TestCase):
+    """best_matches."""
+
+    def test_best_first(self):
+        """Both profiles of a pair keep their k best partners, best first."""
+        rows = [
+            (('a', 'b'), 0.2),
+            (('a', 'c'), 0.9),
+            (('a', 'd'), 0.5),
+            (('b', 'c'), 0.4),
+        ]
+        matches = best_matches(rows, 2)
+        self.assertEqual(matches['a'], [('c', 0.9), ('d', 0.5)])
+        self.assertEqual(matches['b'], [('c', 0.4), ('a', 0.2)])
+        self.assertEqual(matches['d'], [('a', 0.5)])
+
+
+class MergeMatchesTestCase(unittest.TestCase):
+    """merge_matches."""
+
+    matches = [('b', 0.9), ('c', 0.5), ('d', 0.3)]
+
+    def test_raised_similarity(self):
+        """A raised similarity moves up the list."""
+        self.assertEqual(merge_matches(self.matches, {'d': 0.95}, 3),
+                         [('d', 0.95), ('b', 0.9), ('c', 0.5)])
+
+    def test_new_partner(self):
+        """A new partner above the threshold pushes the last one out."""
+        self.assertEqual(merge_matches(self.matches, {'e': 0.6}, 3),
+                         [('b', 0.9), ('e', 0.6), ('c', 0.5)])
+
+    def test_below_threshold(self):
+        """A new partner below the threshold of a full list stays out."""
+        self.assertEqual(merge_matches(self.matches, {'e': 0.1}, 3),
+                         self.matches)
+
+    def test_backfill_after_removal(self):
+        """A full list losing a partner has to be backfilled."""
+        self.assertIsNone(merge_matches(self.matches, {'c': None}, 3))
+
+    def test_backfill_after_drop(self):
+        """A full list whose partner drops below the threshold has to be
+        backfilled.
+        """
+        self.assertIsNone(merge_matches(self.matches, {'b': 0.1}, 3))
+
+    def test_partial_list(self):
+        """A list which was not full held every match, so it never has to
+        be backfilled.
+        """
+        self.assertEqual(merge_matches(self.matches, {'c': None}, 5),
+                         [('b', 0.9), ('d', 0.3)])
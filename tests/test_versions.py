@@ -0,0 +1,62 @@
+"""Tests of the versions of the similarity collections."""
+
+
+from app import mongo
+from app.rs.versions import (
+    allocate_version, building_version, collect_versions, current_version,
+    discard_changes, flip_version, log_changes, logged_changes,
+    start_building, versioned_name,
+)
+from tests.base import MongoTestCase
+
+
+class VersionsTestCase(MongoTestCase):
+    """Allocating, building, flipping and collecting versions."""
+
+    def test_versioned_name(self):
+        """Version 0 uses the plain collection names."""
+        self.assertEqual(versioned_name('omrows', 0), 'omrows')
+        self.assertEqual(versioned_name('omrows', 3), 'omrows_3')
+
+    def test_flip(self):
+        """A built version becomes the current one, an older one never
+        does.
+        """
+        self.assertEqual(current_version(), 0)
+        old, new = allocate_version(), allocate_version()
+        self.assertLess(old, new)
+
+        start_building(new)
+        self.assertEqual(building_version(), new)
+        self.assertTrue(flip_version(new))
+        self.assertEqual(current_version(), new)
+        self.assertIsNone(building_version())
+
+        self.assertFalse(flip_version(old))
+        self.assertEqual(current_version(), new)
+
+    def test_collect(self):
+        """Versions older than the previous one are dropped."""
+        versions = []
+        for _ in range(3):
+            version = allocate_version()
+            mongo.db[versioned_name('omrows', version)].insert_one({})
+            flip_version(version)
+            versions.append(version)
+
+        self.assertEqual(collect_versions(), [versions[0]])
+        names = mongo.db.collection_names()
+        self.assertNotIn(versioned_name('omrows', versions[0]), names)
+        for version in versions[1:]:
+            self.assertIn(versioned_name('omrows', version), names)
+
+    def test_changes(self):
+        """Changes are logged per version, in order, until discarded."""
+        changes = [{'orphan': 1}, {'orphan': 2}]
+        log_changes(4, changes)
+        log_changes(5, [{'orphan': 3}])
+        self.assertEqual(list(logged_changes(4)), changes)
+
+        discard_changes(4)
+        self.assertEqual(list(logged_changes(4)), [])
+        self.assertEqual(list(logged_changes(5)), [{'orphan': 3}])